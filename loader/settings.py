@@ -78,7 +78,12 @@ WSGI_APPLICATION = 'loader.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'NAME': os.environ.get('SCRAPER_DATABASE', os.path.join(BASE_DIR, 'db.sqlite3')),
+        'OPTIONS': {
+            # seconds writer waits for lock of other one, e.g. worker of scrape_data --workers, before
+            # "database is locked" error, sqlite has one writer at a time
+            'timeout': float(os.environ.get('SCRAPER_DATABASE_TIMEOUT', 60)),
+        },
     }
 }
 
@@ -0,0 +1,126 @@
+"""
+Time budget of load call
+
+Loader with budget stops taking new urls when url issued now would finish after deadline,
+then it drains urls in flight, pages and retries of started targets, and flushes saver.
+Optional target rate paces requests, so load spreads over the window instead of bursting.
+"""
+
+import threading
+import time
+
+from scraper.limiters import TokenBucket
+
+
+class LoadBudget(object):
+    """
+    Decides whether loader could issue next url before deadline
+
+    Finish of next url is projected from smoothed request duration, number of urls ahead of it,
+    concurrency of loader, target rate and the longest flush of saver. Duration of url itself
+    is taken with margin of smoothed deviation, as retransmission timeout of tcp, so slow tail does not overrun.
+
+    seconds: wall clock seconds load could take, None for no deadline
+    rate: target requests per second, None for no pacing
+    smoothing: weight of new request duration in its moving average
+    deviations: number of deviations added to duration of url
+    """
+
+    def __init__(self, seconds=None, rate=None, smoothing=0.2, deviations=4):
+        self.seconds = seconds
+        self.rate = rate
+        self.smoothing = smoothing
+        self.deviations = deviations
+        # one token bucket keeps requests evenly spaced
+        self.bucket = TokenBucket(rate, burst=1) if rate else None
+        self.request_seconds = None
+        self.request_deviation = 0
+        # set when the first duration is recorded
+        self.measured = threading.Event()
+        self.started_at = None
+        self.deadline = None
+        # seconds from start when new urls were stopped, None if budget was not exhausted
+        self.stopped_at = None
+        self._lock = threading.Lock()
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(seconds={!r}, rate={!r})'.format(self.__class__.__name__, self.seconds, self.rate)
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.deadline = None if self.seconds is None else self.started_at + self.seconds
+        self.stopped_at = None
+
+    def on_request(self, seconds):
+        """
+        Records duration of finished request, could be called from several fetch workers
+        """
+        with self._lock:
+            if self.request_seconds is None:
+                self.request_seconds = seconds
+                self.request_deviation = seconds / 2
+            else:
+                error = seconds - self.request_seconds
+                self.request_seconds += self.smoothing * error
+                self.request_deviation += self.smoothing * (abs(error) - self.request_deviation)
+        self.measured.set()
+
+    def project_finish(self, in_flight=0, concurrent=1, flush_seconds=0):
+        """
+        :param in_flight: int number of urls issued and not finished yet
+        :param concurrent: int number of urls fetched at once
+        :param flush_seconds: float expected duration of final flush of saver
+        :return: float monotonic time url issued now would be saved at
+        """
+        request_seconds = self.request_seconds or 0
+        wait = (in_flight // concurrent) * request_seconds
+        if self.rate:
+            # urls ahead and this one wait for their turns of rate
+            wait = max(wait, (in_flight + 1) / self.rate)
+        return time.monotonic() + wait + request_seconds + self.deviations * self.request_deviation + flush_seconds
+
+    def holds(self, in_flight=0, concurrent=1):
+        """
+        Finish could not be projected before the first request is done, so only one wave of urls is issued till then
+        :return: bool True if url should wait for duration of the first request
+        """
+        return self.deadline is not None and not self.measured.is_set() and in_flight >= concurrent
+
+    def wait_measured(self):
+        """
+        Waits for duration of the first request, but not longer than deadline
+        """
+        self.measured.wait(max(0, self.deadline - time.monotonic()))
+
+    def allow(self, in_flight=0, concurrent=1, flush_seconds=0):
+        """
+        :return: bool False if url issued now would finish after deadline, budget stays exhausted after that
+        """
+        if self.stopped_at is not None:
+            return False
+        if self.deadline is None or self.project_finish(in_flight, concurrent, flush_seconds) <= self.deadline:
+            return True
+        self.stopped_at = time.monotonic() - self.started_at
+        return False
+
+    def pace(self):
+        """
+        Waits for turn of next request if budget has target rate
+        """
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    async def async_pace(self):
+        if self.bucket is not None:
+            await self.bucket.async_acquire()
+
+    def get_stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at is not None else 0
+        return {
+            'budget_seconds': self.seconds,
+            'elapsed_seconds': round(elapsed, 3),
+            'stopped_at': None if self.stopped_at is None else round(self.stopped_at, 3),
+            'request_seconds': None if self.request_seconds is None else round(self.request_seconds, 4),
+            'request_deviation': round(self.request_deviation, 4),
+            'target_rate': self.rate,
+        }
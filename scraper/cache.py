@@ -0,0 +1,184 @@
+"""
+On disk cache of http responses
+
+Stores validators (ETag, Last-Modified) and compressed bodies keyed by url string,
+so repeated runs could send conditional requests and take unchanged bodies from disk.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+NOT_MODIFIED = 304
+
+
+class CacheEntry(object):
+    """Cached response of one url"""
+
+    def __init__(self, url, etag, last_modified, body, stored_at):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.body = body
+        self.stored_at = stored_at
+        self.fresh = False
+
+    def get_body(self):
+        """
+        :return: bytes of uncompressed response body
+        """
+        return zlib.decompress(self.body)
+
+    def get_data(self, loads=json.loads):
+        """
+        :param loads: callable that decodes json document from bytes
+        :return: dict decoded from response body
+        """
+        return loads(self.get_body())
+
+
+class ResponseCache(object):
+    """
+    Keeps responses in sqlite file
+
+    path: file name of cache database
+    max_size: max number of bytes of compressed bodies, least recently used entries are evicted above it
+    max_age: seconds entry is served without request, older entries are revalidated with conditional request
+    compress_level: zlib compression level
+    """
+
+    def __init__(self, path, max_size=500 * 1024 * 1024, max_age=0, compress_level=6):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # connection is shared by fetch threads, access is serialized by lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS response ('
+            'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB, size INTEGER, '
+            'stored_at REAL, accessed_at REAL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS response_accessed_at ON response (accessed_at)')
+        self.size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(path={!r}, max_size={!r}, max_age={!r})'.format(
+            self.__class__.__name__, self.path, self.max_size, self.max_age
+        )
+
+    def get(self, url):
+        """
+        Looks for cached response of url and marks it as recently used
+
+        entry.fresh is True if entry is younger than max_age and could be served without request.
+
+        :param url: str
+        :return: CacheEntry or None
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT url, etag, last_modified, body, stored_at FROM response WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE response SET accessed_at = ? WHERE url = ?', (now, url))
+            entry = CacheEntry(*row)
+            entry.fresh = now - entry.stored_at < self.max_age
+            if entry.fresh:
+                self.hits += 1
+        return entry
+
+    def get_conditional_headers(self, entry):
+        """
+        Builds validation headers for request of cached url
+        :param entry: CacheEntry or None
+        :return: dict
+        """
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def revalidate(self, url, headers):
+        """
+        Marks cached response as confirmed by server, takes updated validators from 304 response
+
+        :param url: str
+        :param headers: mapping of response headers
+        """
+        with self._lock:
+            self.revalidated += 1
+            self._conn.execute(
+                'UPDATE response SET etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), '
+                'stored_at = ? WHERE url = ?',
+                (headers.get('ETag'), headers.get('Last-Modified'), time.time(), url)
+            )
+
+    def store(self, url, headers, body):
+        """
+        Saves response body with its validators, evicts least recently used entries if cache is too big
+
+        Responses without validators are stored only when max_age allows to serve them without request.
+
+        :param url: str
+        :param headers: mapping of response headers
+        :param body: bytes
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not (etag or last_modified or self.max_age):
+            return
+        compressed = zlib.compress(body, self.compress_level)
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM response WHERE url = ?', (url,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO response (url, etag, last_modified, body, size, stored_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, compressed, len(compressed), now, now)
+            )
+            self.size += len(compressed) - (old[0] if old else 0)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until cache fits max_size, should be called under lock
+        """
+        rows = self._conn.execute('SELECT url, size FROM response ORDER BY accessed_at')
+        to_delete = []
+        for url, size in rows:
+            if self.size <= self.max_size:
+                break
+            to_delete.append((url,))
+            self.size -= size
+        self._conn.executemany('DELETE FROM response WHERE url = ?', to_delete)
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'size': self.size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,100 @@
+"""
+Cost aware ordering of targets
+
+Fetcher records cost of every target it fetches, tracker saves costs to TargetCost table after run,
+next runs order targets by expected cost. Target that takes long goes first, so it runs
+while other workers handle small targets instead of being the last one everybody waits for.
+"""
+
+import threading
+
+from django.db import transaction
+
+from scraper.models import TargetCost
+
+LONGEST_FIRST = 'longest'
+INTERLEAVE = 'interleave'
+SCHEDULES = (LONGEST_FIRST, INTERLEAVE)
+
+
+class CostTracker(object):
+    """
+    Keeps costs of targets of one stage measured in this run and loaded from earlier runs
+
+    Expected cost of target is seconds of its first request times number of pages.
+    Targets without history are expected to cost as median of known ones.
+
+    stage: name of stage, e.g. fetcher.stage
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        # target id and tuple of seconds, pages, objects, bytes measured in this run
+        self.measured = {}
+        self._lock = threading.Lock()
+        # target id and expected cost from earlier runs, loaded on first use
+        self.history = None
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(stage={!r}, measured={})'.format(self.__class__.__name__, self.stage, len(self.measured))
+
+    def record(self, target_id, seconds, pages=1, object_count=0, response_size=None):
+        """
+        Stores cost of fetched target, could be called from several fetch workers
+        """
+        with self._lock:
+            self.measured[target_id] = (seconds, pages, object_count, response_size)
+
+    def get_history(self):
+        if self.history is None:
+            costs = TargetCost.objects.filter(stage=self.stage).values_list('target_id', 'seconds', 'pages')
+            self.history = {target_id: seconds * pages for target_id, seconds, pages in costs.iterator()}
+        return self.history
+
+    def order(self, target_ids, schedule=LONGEST_FIRST):
+        """
+        :param target_ids: iterable of target ids
+        :param schedule: LONGEST_FIRST or INTERLEAVE, which alternates the most and the least expensive targets
+        :return: list of target ids
+        """
+        if schedule not in SCHEDULES:
+            raise ValueError('Unknown schedule {!r}, choose one of {}'.format(schedule, SCHEDULES))
+        history = self.get_history()
+        known = sorted(history.values())
+        default = known[len(known) // 2] if known else 0
+        ordered = sorted(target_ids, key=lambda target_id: history.get(target_id, default), reverse=True)
+        if schedule == LONGEST_FIRST:
+            return ordered
+        result = []
+        head, tail = 0, len(ordered) - 1
+        while head <= tail:
+            result.append(ordered[head])
+            if head != tail:
+                result.append(ordered[tail])
+            head += 1
+            tail -= 1
+        return result
+
+    def save(self, chunk_size=500):
+        """
+        Replaces costs of measured targets in TargetCost table
+        :return: int number of saved costs
+        """
+        with self._lock:
+            measured, self.measured = self.measured, {}
+        target_ids = list(measured)
+        for start in range(0, len(target_ids), chunk_size):
+            chunk = target_ids[start:start + chunk_size]
+            costs = []
+            for target_id in chunk:
+                seconds, pages, object_count, response_size = measured[target_id]
+                costs.append(TargetCost(
+                    stage=self.stage, target_id=target_id, seconds=seconds, pages=pages,
+                    object_count=object_count, response_size=response_size
+                ))
+            with transaction.atomic():
+                TargetCost.objects.filter(stage=self.stage, target_id__in=chunk).delete()
+                TargetCost.objects.bulk_create(costs)
+        if self.history is not None:
+            self.history.update((target_id, cost[0] * cost[1]) for target_id, cost in measured.items())
+        return len(measured)
@@ -0,0 +1,514 @@
+"""
+Database helpers used by savers
+
+upsert writes objects with native INSERT ... ON CONFLICT of database backend where it is supported.
+ColumnProjection turns api dicts into rows, so insert_rows and upsert_rows write them without model instances.
+mark_rows updates rows by big lists of keys with set based statement.
+BulkLoadProfile tunes database for big scrape runs.
+"""
+
+import logging
+import sqlite3
+import time
+from operator import attrgetter
+
+from django.db import connections, router
+from django.db.backends.signals import connection_created
+
+from scraper.utils import LoggingMixin
+
+# oldest sqlite that understands INSERT ... ON CONFLICT clause
+SQLITE_UPSERT_VERSION = (3, 24, 0)
+
+
+def get_connection(model):
+    return connections[router.db_for_write(model)]
+
+
+def supports_on_conflict(connection):
+    """
+    :param connection: django db connection
+    :return: bool True if backend has native upsert statement
+    """
+    if connection.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= SQLITE_UPSERT_VERSION
+    return connection.vendor in ('postgresql', 'mysql')
+
+
+def get_journal_mode(connection):
+    """
+    :param connection: django sqlite connection
+    :return: str journal mode of db
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        return cursor.fetchone()[0]
+
+
+def set_journal_mode(connection, mode):
+    """
+    Journal mode is stored in db file, so it applies to connections of other processes too
+
+    :param connection: django sqlite connection
+    :param mode: str journal mode, e.g. 'wal'
+    :return: str journal mode db has after change, leaving wal needs exclusive lock and could fail
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode = {}'.format(mode))
+        return cursor.fetchone()[0]
+
+
+def get_insert_fields(model):
+    """
+    :return: list of fields written by insert, auto primary key is left to db
+    """
+    return [field for field in model._meta.concrete_fields if not field.auto_created]
+
+
+def build_upsert_sql(connection, model, fields, row_count, key, update):
+    """
+    Builds multi row insert that skips or updates rows which key already exists
+
+    :param connection: django db connection
+    :param model: model class
+    :param fields: list of fields in order of values
+    :param row_count: int number of rows in statement
+    :param key: tuple of names of columns with unique index together
+    :param update: bool if True existing rows get new values, otherwise they are left as is
+    :return: str sql with %s placeholders
+    """
+    qn = connection.ops.quote_name
+    columns = [qn(field.column) for field in fields]
+    row = '({})'.format(', '.join(['%s'] * len(fields)))
+    sql = 'INSERT {}INTO {} ({}) VALUES {}'.format(
+        'IGNORE ' if connection.vendor == 'mysql' and not update else '',
+        qn(model._meta.db_table),
+        ', '.join(columns),
+        ', '.join([row] * row_count),
+    )
+    key_columns = [qn(column) for column in key]
+    updated = [column for column in columns if column not in key_columns]
+    if connection.vendor == 'mysql':
+        if update:
+            sql += ' ON DUPLICATE KEY UPDATE {}'.format(
+                ', '.join('{0} = VALUES({0})'.format(column) for column in updated)
+            )
+        return sql
+    if update:
+        return sql + ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+            ', '.join(key_columns), ', '.join('{0} = excluded.{0}'.format(column) for column in updated)
+        )
+    return sql + ' ON CONFLICT ({}) DO NOTHING'.format(', '.join(key_columns))
+
+
+def get_key_columns(model, key):
+    """
+    :param key: tuple of names of natural key fields
+    :return: tuple of their column names
+    """
+    return tuple(model._meta.get_field(name).column for name in key)
+
+
+def get_saved_keys(model, key, keys, chunk_size=500):
+    """
+    Selects which of keys are already in table, one query per chunk of keys
+
+    Composite keys are looked up by their first field and matched as a whole.
+
+    :param model: model class
+    :param key: tuple of names of natural key fields
+    :param keys: list of key values, tuples if key has several fields
+    :return: set of saved key values
+    """
+    lookup = key[0] + '__in'
+    flat = len(key) == 1
+    saved = set()
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start:start + chunk_size]
+        values = set(chunk) if flat else {value[0] for value in chunk}
+        rows = model.objects.filter(**{lookup: values}).values_list(*key, flat=flat)
+        saved.update(rows if flat else set(rows) & set(chunk))
+    return saved
+
+
+def upsert(model, objs, key, update=False):
+    """
+    Inserts objects, rows which key is already in table are skipped or updated
+
+    Objects should have unique keys. Backends without native upsert get the same result
+    with select of existing keys, bulk_create and update of every existing row.
+
+    :param model: model class, key fields should have unique index together
+    :param objs: list of model instances
+    :param key: tuple of names of natural key fields
+    :param update: bool if True existing rows get values of objects
+    :return: int number of rows reported as written by db
+    """
+    if not objs:
+        return 0
+    connection = get_connection(model)
+    if not supports_on_conflict(connection):
+        return fallback_upsert(model, objs, key, update)
+
+    fields = get_insert_fields(model)
+    key_columns = get_key_columns(model, key)
+    batch_size = max(1, connection.ops.bulk_batch_size(fields, objs))
+    written = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            params = []
+            for obj in batch:
+                params.extend(
+                    field.get_db_prep_save(field.pre_save(obj, add=True), connection=connection) for field in fields
+                )
+            cursor.execute(build_upsert_sql(connection, model, fields, len(batch), key_columns, update), params)
+            written += max(cursor.rowcount, 0)
+    return written
+
+
+def fallback_upsert(model, objs, key, update=False):
+    """
+    Upsert for backends without native statement, should be called inside transaction
+    """
+    get_key = attrgetter(*key)
+    # the last object wins if objects have the same key twice
+    objs = {get_key(obj): obj for obj in objs}
+    existing = get_saved_keys(model, key, list(objs))
+    new_objs = [obj for obj_key, obj in objs.items() if obj_key not in existing]
+    model.objects.bulk_create(new_objs)
+    if not update:
+        return len(new_objs)
+    fields = [field.attname for field in get_insert_fields(model) if field.name not in key]
+    for obj in objs.values():
+        if get_key(obj) in existing:
+            model.objects.filter(**{name: getattr(obj, name) for name in key}).update(
+                **{name: getattr(obj, name) for name in fields}
+            )
+    return len(objs)
+
+
+def insert_rows(model, fields, rows):
+    """
+    Inserts prepared rows with executemany, no model instances are created
+
+    :param model: model class
+    :param fields: list of fields in order of row values
+    :param rows: list of tuples of db values
+    :return: int number of inserted rows
+    """
+    if not rows:
+        return 0
+    connection = get_connection(model)
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        qn(model._meta.db_table),
+        ', '.join(qn(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+    return len(rows)
+
+
+def upsert_rows(model, fields, rows, key, update=False):
+    """
+    Same as upsert, but takes prepared rows and writes them with executemany
+
+    :param model: model class, key fields should have unique index together
+    :param fields: list of fields in order of row values
+    :param rows: list of tuples of db values with unique keys
+    :param key: tuple of names of natural key fields
+    :param update: bool if True existing rows get new values
+    :return: int number of rows reported as written by db
+    """
+    if not rows:
+        return 0
+    connection = get_connection(model)
+    if not supports_on_conflict(connection):
+        names = [field.attname for field in fields]
+        return fallback_upsert(model, [model(**dict(zip(names, row))) for row in rows], key, update)
+    sql = build_upsert_sql(connection, model, fields, 1, get_key_columns(model, key), update)
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+        return max(cursor.rowcount, 0)
+
+
+# temporary table that holds keys of set based updates, every connection has its own one
+KEY_TABLE = 'scraper_marked_keys'
+
+
+def mark_rows(model, key, keys, values, filters=None, chunk_size=500):
+    """
+    Sets values of rows which natural key is in keys
+
+    Up to chunk_size keys are updated with one IN statement. More keys go to temporary table on sqlite and
+    postgresql and rows are updated with one statement joined with it, so statement does not grow with
+    number of keys and stays below limit of bound variables. Other backends update rows by chunks of keys.
+
+    :param model: model class
+    :param key: str name of integer field with index
+    :param keys: list of int keys
+    :param values: dict of field name and new value
+    :param filters: dict of field name and value updated rows should also have
+    :param chunk_size: int max number of keys in IN statement
+    :return: int number of updated rows
+    """
+    if not keys:
+        return 0
+    filters = filters or {}
+    connection = get_connection(model)
+    if len(keys) <= chunk_size or connection.vendor not in ('sqlite', 'postgresql'):
+        queryset = model.objects.filter(**filters)
+        updated = 0
+        for start in range(0, len(keys), chunk_size):
+            updated += queryset.filter(**{key + '__in': keys[start:start + chunk_size]}).update(**values)
+        return updated
+    qn = connection.ops.quote_name
+    key_table = qn(KEY_TABLE)
+    fields = [model._meta.get_field(name) for name in values]
+    filter_fields = [model._meta.get_field(name) for name in filters]
+    sql = 'UPDATE {} SET {} WHERE {} IN (SELECT value FROM {})'.format(
+        qn(model._meta.db_table),
+        ', '.join('{} = %s'.format(qn(field.column)) for field in fields),
+        qn(model._meta.get_field(key).column),
+        key_table,
+    )
+    sql += ''.join(' AND {} = %s'.format(qn(field.column)) for field in filter_fields)
+    params = [field.get_db_prep_save(values[field.name], connection=connection) for field in fields]
+    params += [field.get_db_prep_save(filters[field.name], connection=connection) for field in filter_fields]
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS {} (value bigint)'.format(key_table))
+        # keys of update that failed before its cleanup are not applied again, table is emptied before insert
+        # and not in finally, statement after error would fail in aborted transaction of postgresql
+        cursor.execute('DELETE FROM {}'.format(key_table))
+        cursor.executemany('INSERT INTO {} (value) VALUES (%s)'.format(key_table), [(value,) for value in keys])
+        cursor.execute(sql, params)
+        updated = cursor.rowcount
+        cursor.execute('DELETE FROM {}'.format(key_table))
+    return updated
+
+
+class ColumnProjection(object):
+    """
+    Fixed column order of model insert, compiled once per model class
+
+    Converts dicts from api to tuples of db values without model instances,
+    values are prepared by the same field methods that bulk_create uses.
+    Keys that are not fields of model are dropped and counted in unknown_keys.
+
+    Usage:
+        projection = ColumnProjection.for_model(Course)
+        rows = [projection.to_row(obj) for obj in objs]
+        insert_rows(Course, projection.fields, rows)
+    """
+
+    # python types which values need no conversion for field internal type
+    native_types = {
+        'AutoField': int,
+        'IntegerField': int,
+        'PositiveIntegerField': int,
+        'PositiveSmallIntegerField': int,
+        'SmallIntegerField': int,
+        'BigIntegerField': int,
+        'CharField': str,
+        'TextField': str,
+        'FloatField': float,
+        'BooleanField': bool,
+        'NullBooleanField': bool,
+    }
+
+    _projections = {}
+
+    def __init__(self, model):
+        self.model = model
+        connection = get_connection(model)
+        self.fields = get_insert_fields(model)
+        self.positions = {}
+        for position, field in enumerate(self.fields):
+            self.positions[field.name] = position
+            self.positions[field.attname] = position
+        self.defaults = [field.get_default() for field in self.fields]
+        self.converters = [
+            (self.native_types.get(field.get_internal_type()), self.get_converter(field, connection))
+            for field in self.fields
+        ]
+        self.unknown_keys = {}
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(model={})'.format(self.__class__.__name__, self.model.__name__)
+
+    @classmethod
+    def for_model(cls, model):
+        projection = cls._projections.get(model)
+        if projection is None:
+            projection = cls._projections[model] = cls(model)
+        return projection
+
+    @staticmethod
+    def get_converter(field, connection):
+        return lambda value: field.get_db_prep_save(value, connection=connection)
+
+    def get_position(self, name):
+        """
+        :param name: str name of field
+        :return: int index of field value in row
+        """
+        return self.positions[name]
+
+    def to_row(self, obj):
+        """
+        :param obj: dict from api
+        :return: tuple of db values in order of fields
+        """
+        values = list(self.defaults)
+        positions = self.positions
+        for key, value in obj.items():
+            position = positions.get(key)
+            if position is None:
+                self.unknown_keys[key] = self.unknown_keys.get(key, 0) + 1
+                continue
+            values[position] = value
+        row = []
+        for value, (native_type, convert) in zip(values, self.converters):
+            if value is None or type(value) is native_type:
+                row.append(value)
+            else:
+                row.append(convert(value))
+        return tuple(row)
+
+
+# pragmas of sqlite connections during bulk load
+BULK_LOAD_PRAGMAS = (
+    # readers do not block writer and commit appends to log instead of rewriting pages
+    ('journal_mode', 'WAL'),
+    # fsync on checkpoints only, committed transaction could be lost on power failure but db stays consistent
+    ('synchronous', 'NORMAL'),
+    # negative value is size in KiB
+    ('cache_size', -256000),
+    ('mmap_size', 1024 ** 3),
+    ('temp_store', 'MEMORY'),
+)
+
+
+class BulkLoadProfile(LoggingMixin):
+    """
+    Database settings for big scrape runs
+
+    Between begin and finish every sqlite connection, including connections opened later by other threads,
+    gets BULK_LOAD_PRAGMAS. Indexes that are not unique could be dropped by begin and rebuilt by finish,
+    so rows are inserted without updating them. Unique indexes are kept, upsert depends on them.
+    finish updates planner statistics of tables. Other backends get statistics update only.
+    Journal mode is the only pragma stored in database file, finish sets back the mode db had before begin.
+
+    Usage:
+        with BulkLoadProfile([Course], drop_indexes=True):
+            ...load...
+
+    models: model classes which tables are loaded
+    drop_indexes: bool
+    pragmas: iterable of (name, value) pairs
+    """
+
+    def __init__(self, models, drop_indexes=False, pragmas=BULK_LOAD_PRAGMAS, logger=None):
+        super().__init__()
+        self.models = models
+        self.drop_indexes = drop_indexes
+        self.pragmas = pragmas
+        self.set_logger(logger=logger)
+        # (model, name, sql) of dropped indexes
+        self.dropped = []
+        # alias of sqlite db and its journal mode before begin
+        self.journal_modes = {}
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(models={!r}, drop_indexes={!r})'.format(
+            self.get_class_name(), [model.__name__ for model in self.models], self.drop_indexes
+        )
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+    def configure_connection(self, sender, connection, **kwargs):
+        """
+        Receiver of connection_created signal
+        """
+        if connection.vendor != 'sqlite':
+            return
+        with connection.cursor() as cursor:
+            for name, value in self.pragmas:
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+    def begin(self):
+        for connection in connections.all():
+            if connection.vendor == 'sqlite':
+                self.journal_modes[connection.alias] = get_journal_mode(connection)
+        connection_created.connect(self.configure_connection, weak=False)
+        for connection in connections.all():
+            # connections opened before begin do not get signal
+            if connection.connection is not None:
+                self.configure_connection(sender=connection.__class__, connection=connection)
+        if self.drop_indexes:
+            self.drop_secondary_indexes()
+
+    def finish(self):
+        connection_created.disconnect(self.configure_connection)
+        self.rebuild_indexes()
+        self.analyze()
+        self.restore_journal_modes()
+
+    def drop_secondary_indexes(self):
+        for model in self.models:
+            connection = get_connection(model)
+            if connection.vendor != 'sqlite':
+                continue
+            table = model._meta.db_table
+            with connection.cursor() as cursor:
+                # indexes of unique and primary key constraints have no sql
+                cursor.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL",
+                    [table]
+                )
+                indexes = [(name, sql) for name, sql in cursor.fetchall() if not sql.upper().startswith('CREATE UNIQUE')]
+                for name, sql in indexes:
+                    cursor.execute('DROP INDEX {}'.format(connection.ops.quote_name(name)))
+                    self.dropped.append((model, name, sql))
+                    self.log('Drop index {} of {}'.format(name, table))
+
+    def restore_journal_modes(self):
+        while self.journal_modes:
+            alias, mode = self.journal_modes.popitem()
+            # db stays in wal if other connection still uses it
+            restored = set_journal_mode(connections[alias], mode)
+            if restored.lower() != mode.lower():
+                self.log('Journal mode of {} stays {}, it could not be set back to {}'.format(alias, restored, mode),
+                         level=logging.WARNING)
+
+    def rebuild_indexes(self):
+        while self.dropped:
+            model, name, sql = self.dropped.pop()
+            start = time.monotonic()
+            with get_connection(model).cursor() as cursor:
+                cursor.execute(sql)
+            self.log('Rebuild index {} in {:.2f}s'.format(name, time.monotonic() - start))
+
+    def analyze(self):
+        """
+        Updates planner statistics of loaded tables
+        """
+        start = time.monotonic()
+        for model in self.models:
+            connection = get_connection(model)
+            table = connection.ops.quote_name(model._meta.db_table)
+            with connection.cursor() as cursor:
+                if connection.vendor == 'mysql':
+                    cursor.execute('ANALYZE TABLE {}'.format(table))
+                else:
+                    cursor.execute('ANALYZE {}'.format(table))
+                if connection.vendor == 'sqlite':
+                    cursor.execute('PRAGMA optimize')
+        self.log('Analyze in {:.2f}s'.format(time.monotonic() - start))
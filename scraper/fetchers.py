@@ -6,11 +6,23 @@ All necessary logic is in AbstractUrlFetcher class
 Classes PaginatedFetcher, DepartmentFetcher, CourseFetcher, ProfessorFetcher are derived from this abstract class
 """
 
+import asyncio
+import copy
+import heapq
+import itertools
+import logging
 import sys
+import threading
+import time
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import wait, FIRST_COMPLETED
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
-from scraper.utils import LoggingMixin, Url
-from scraper.models import School, Department
+from django.db.models import F
+
+from scraper.streaming import JsonStreamExtractor
+from scraper.utils import LoggingMixin, PageGroup, Url
+from scraper.models import School, Department, ScrapeTask
 
 API_URL = 'https://www.myedu.com/adms'
 SCHOOL_PATH = '/school/'
@@ -36,14 +48,148 @@ class AbstractUrlFetcher(LoggingMixin, metaclass=ABCMeta):
     key = ''
     # if None than get_urls should know how to get urls for processing
     fetch_class = None
-
-    def __init__(self, url_class=Url):
+    # field of fetch_class which value is put to url_template, objects of parent stage provide it to pipeline
+    target_field = None
+    # RateLimiter instance, set on this class to share it between all fetchers of process
+    rate_limiter = None
+    # RetryPolicy instance, if None failed urls are not retried
+    retry_policy = None
+    # if True remaining pages are requested when first response contains pagination block
+    paginate = True
+    # if True response body is parsed incrementally and only objects under key are decoded
+    stream = False
+    # JsonDecoder instance set to created urls, if None url_class default decoder is used
+    decoder = None
+    # HedgePolicy instance, if set slow requests get duplicates and timeouts follow observed latency
+    hedge_policy = None
+    # name of loading stage in ScrapeTask table
+    stage = None
+    # TaskQueue instance, if set targets are claimed from it instead of scanning fetch_class flags
+    task_queue = None
+    # tuple of shard index and count of shards, if set only targets with target_field % count == index are loaded
+    shard = None
+    # CostTracker instance, if set cost of every fetched target is recorded
+    cost_tracker = None
+    # LONGEST_FIRST or INTERLEAVE, if set targets are ordered by cost recorded in earlier runs
+    schedule = None
+
+    def __init__(self, url_class=Url, rate_limiter=None, retry_policy=None, stream=None, decoder=None,
+                 hedge_policy=None, task_queue=None, shard=None, cost_tracker=None, schedule=None):
         super().__init__()
         self.url_class = url_class
+        if stream is not None:
+            self.stream = stream
+        if decoder is not None:
+            self.decoder = decoder
+        if rate_limiter is not None:
+            self.rate_limiter = rate_limiter
+        if retry_policy is not None:
+            self.retry_policy = retry_policy
+        if hedge_policy is not None:
+            self.hedge_policy = hedge_policy
+        if task_queue is not None:
+            self.task_queue = task_queue
+        if shard is not None:
+            self.shard = shard
+        if cost_tracker is not None:
+            self.cost_tracker = cost_tracker
+        if schedule is not None:
+            self.schedule = schedule
+        if self.schedule is not None and self.cost_tracker is None:
+            raise ValueError('Schedule {!r} needs cost tracker'.format(self.schedule))
+        # heap of (due time, sequence number, url) for urls deferred by retry policy and pages of fetched urls
+        self.pending_queue = []
+        self._pending_counter = itertools.count()
+        self._pending_lock = threading.Lock()
 
     def __repr__(self, *args, **kwargs):
         return '{}(url_class={})'.format(self.get_class_name(), self.url_class.__name__)
 
+    def __getstate__(self):
+        # fetcher is pickled to be sent to process pool, pending queue stays in parent process
+        state = self.__dict__.copy()
+        state['pending_queue'] = []
+        del state['_pending_lock']
+        # costs measured in other process would be lost anyway
+        state.pop('cost_tracker', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pending_lock = threading.Lock()
+
+    def make_url(self, url_string, id_to_update=None, page=None):
+        """
+        Creates instance of url_class
+
+        :param url_string: str
+        :param id_to_update: id of fetch_class object that is marked as processed after save
+        :param page: int number of page, None for first request to url
+        :return: Instance of url_class
+        """
+        url = self.url_class(url_string, id_to_update=id_to_update)
+        url.page = page
+        if self.decoder is not None:
+            url.decoder = self.decoder
+        return url
+
+    def make_target_url(self, target_id):
+        """
+        :param target_id: value of target_field of fetch_class object
+        :return: Instance of url_class for objects of target
+        """
+        return self.make_url(self.url_template.format(target_id), id_to_update=target_id)
+
+    def get_page_url(self, url_string, page):
+        """
+        :param url_string: str
+        :param page: int
+        :return: str url_string with page query parameter
+        """
+        parts = urlsplit(url_string)
+        query = [(k, v) for k, v in parse_qsl(parts.query) if k != 'page']
+        query.append(('page', page))
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def get_page_count(self, data):
+        """
+        Reads number of pages from pagination block of response
+
+        :param data: dict from response
+        :return: int or None if response is not paginated
+        """
+        try:
+            return int(data['pagination']['pages'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def add_page_urls(self, url, data):
+        """
+        Creates urls for remaining pages if url is the first page of paginated response
+
+        Pages share PageGroup with the first one, fetch_class object is marked as processed with the last page saved.
+
+        :param url: Instance of url_class
+        :param data: dict from response
+        """
+        if self.paginate:
+            self.set_page_urls(url, self.get_page_count(data))
+
+    def set_page_urls(self, url, pages):
+        """
+        :param url: Instance of url_class
+        :param pages: int number of pages of response or None
+        """
+        if not pages or url.page not in (None, 1):
+            return
+        url.page_urls = [
+            self.make_url(self.get_page_url(url.url_string, page), page=page) for page in range(2, pages + 1)
+        ]
+        if url.page_urls and url.id_to_update is not None:
+            url.page_group = PageGroup(url.id_to_update, pages)
+            for page_url in url.page_urls:
+                page_url.page_group = url.page_group
+
     def get_objects_from_url(self, data):
         """
         Looks in response dict for objects that should be saved
@@ -74,6 +220,23 @@ class AbstractUrlFetcher(LoggingMixin, metaclass=ABCMeta):
         if self.fetch_class is None:
             return []
 
+    def count_backlog(self):
+        """
+        :return: int number of targets which are not processed yet, None if fetcher does not track them
+        """
+        return None
+
+    def filter_shard(self, queryset):
+        """
+        Keeps objects of fetcher shard, every process of sharded run gets deterministic part of targets
+        :param queryset: QuerySet of fetch_class
+        :return: QuerySet
+        """
+        if self.shard is None:
+            return queryset
+        index, count = self.shard
+        return queryset.annotate(shard_index=F(self.target_field) % count).filter(shard_index=index)
+
     @abstractmethod
     def get_urls(self):
         """
@@ -82,46 +245,510 @@ class AbstractUrlFetcher(LoggingMixin, metaclass=ABCMeta):
         """
         return self.get_values_queryset()
 
+    def throttle(self, url):
+        """
+        Waits until rate limiter allows request to url
+        :param url: Instance of url_class
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(url.url_string)
+
+    async def async_throttle(self, url):
+        """
+        Waits without blocking loop until rate limiter allows request to url
+        :param url: Instance of url_class
+        """
+        if self.rate_limiter is not None:
+            await self.rate_limiter.async_acquire(url.url_string)
+
+    def update_rate(self, url):
+        """
+        Passes rate limit headers of url response to rate limiter
+        :param url: Instance of url_class
+        """
+        if self.rate_limiter is not None and url.response_headers is not None:
+            self.rate_limiter.update_from_headers(url.url_string, url.status_code, url.response_headers)
+
+    def get_extractor(self):
+        """
+        :return: JsonStreamExtractor for objects under self.key, keeping pagination block
+        """
+        return JsonStreamExtractor(self.key, capture=('pagination',))
+
+    def append_streamed(self, url, objs):
+        for obj in objs:
+            url.append_fetched_dict(obj)
+
+    def stream_response(self, url):
+        """
+        Requests url and extracts objects from response body while it is downloaded
+        Objects are appended to url right away, so the whole response is never decoded.
+
+        :param url: Instance of url_class
+        :return: dict with top level values captured by extractor, it is used instead of response dict
+        """
+        extractor = self.get_extractor()
+        try:
+            url.feed_body(lambda chunk: self.append_streamed(url, extractor.feed(chunk)))
+            self.append_streamed(url, extractor.close())
+        except Exception:
+            url.fetched_dicts = []
+            raise
+        return extractor.captured
+
+    async def async_stream_response(self, url):
+        """
+        Asynchronous version of stream_response
+        """
+        extractor = self.get_extractor()
+        try:
+            await url.feed_body(lambda chunk: self.append_streamed(url, extractor.feed(chunk)))
+            self.append_streamed(url, extractor.close())
+        except Exception:
+            url.fetched_dicts = []
+            raise
+        return extractor.captured
+
+    def check_available(self, url):
+        """
+        Prepares url for next attempt, defers it if circuit breaker does not allow requests to its host
+
+        :param url: Instance of url_class
+        :return: bool True if request could be made
+        """
+        url.retry_delay = None
+        if self.retry_policy is not None:
+            wait = self.retry_policy.get_wait(url.url_string)
+            if wait > 0:
+                url.retry_delay = wait
+                return False
+        url.attempts += 1
+        return True
+
+    def process_response(self, url, resp_data=None, exc_info=None):
+        """
+        Saves objects from response to url, or defers url for retry, or marks it as failed
+        Should be called inside except block if request failed
+
+        :param url: Instance of url_class
+        :param resp_data: dict from response
+        :param exc_info: sys.exc_info() if request failed
+        """
+        self.update_rate(url)
+        if exc_info is not None:
+            if self.retry_policy is not None:
+                delay = self.retry_policy.on_failure(url, exc_info[1])
+                if delay is not None:
+                    url.retry_delay = delay
+                    self.log('Url: {}, retry in {:.2f}s after attempt {}, e_val: {!r}'.format(
+                        url.url_string, delay, url.attempts, exc_info[1]), level=logging.WARNING)
+                    return
+            url.handle_error(self.logger, *exc_info)
+            # fetch could run in worker or child process, failure is written to db by saver
+            url.failure = repr(exc_info[1])
+            objs = {}
+        else:
+            if self.retry_policy is not None:
+                self.retry_policy.on_success(url)
+            self.add_page_urls(url, resp_data)
+            # in streaming mode objects are already appended and resp_data has only captured values
+            objs = self.get_objects_from_url(resp_data)
+
+        url.append_fetched_dicts(objs=objs)
+
+    def get_response(self, url):
+        """
+        Makes single request to url
+        :param url: Instance of url_class
+        :return: dict from response, in streaming mode dict with captured top level values
+        """
+        if self.stream:
+            return self.stream_response(url)
+        return url.get_response()
+
+    async def async_get_response(self, url):
+        """
+        Asynchronous version of get_response
+        """
+        if self.stream:
+            return await self.async_stream_response(url)
+        return await url.get_response()
+
+    def timed_response(self, url):
+        """
+        Makes single request to url and records its latency if request succeeded
+        """
+        start = time.monotonic()
+        resp_data = self.get_response(url)
+        self.hedge_policy.record(self.get_class_name(), time.monotonic() - start)
+        return resp_data
+
+    async def async_timed_response(self, url):
+        """
+        Asynchronous version of timed_response
+        """
+        start = time.monotonic()
+        resp_data = await self.async_get_response(url)
+        self.hedge_policy.record(self.get_class_name(), time.monotonic() - start)
+        return resp_data
+
+    def copy_url(self, url):
+        """
+        Creates copy of url for one of hedged requests, so requests do not write response state to the same url
+        """
+        attempt = copy.copy(url)
+        attempt.fetched_dicts = []
+        attempt.page_urls = []
+        return attempt
+
+    def take_attempt(self, url, attempts, done):
+        """
+        Looks for successful request among finished ones and copies its response state to url
+
+        :param url: Instance of url_class
+        :param attempts: dict of future and url copy, the first item is primary request
+        :param done: iterable of finished futures
+        :return: future of successful request or None
+        """
+        primary = next(iter(attempts))
+        for future in done:
+            if future.cancelled() or future.exception() is not None:
+                continue
+            attempt = attempts[future]
+            url.status_code = attempt.status_code
+            url.response_headers = attempt.response_headers
+            url.response_size = attempt.response_size
+            url.fetched_dicts = attempt.fetched_dicts
+            if future is not primary:
+                self.hedge_policy.on_hedge_won()
+            return future
+        return None
+
+    def fail_attempts(self, url, attempts):
+        """
+        Copies response state of failed primary request to url and raises its exception
+        """
+        primary = next(iter(attempts))
+        attempt = attempts[primary]
+        url.status_code = attempt.status_code
+        url.response_headers = attempt.response_headers
+        return primary.result()
+
+    def hedged_response(self, url):
+        """
+        Requests url and sends second request if the first one takes longer than policy delay
+
+        First successful response is taken. Requests run in policy executor, so losing request is cancelled
+        only if it was not started yet, otherwise its result is dropped and its duration is bounded by url timeout.
+
+        :param url: Instance of url_class
+        :return: dict from response
+        """
+        policy = self.hedge_policy
+        delay = policy.get_delay(self.get_class_name())
+        if delay is None:
+            return self.timed_response(url)
+
+        executor = policy.get_executor()
+        primary = self.copy_url(url)
+        attempts = {executor.submit(self.timed_response, primary): primary}
+        done, _ = wait(attempts, timeout=delay)
+        if not done and policy.acquire_hedge():
+            self.throttle(url)
+            hedge = self.copy_url(url)
+            attempts[executor.submit(self.timed_response, hedge)] = hedge
+
+        pending = set(attempts)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = self.take_attempt(url, attempts, done)
+            if winner is not None:
+                for future in pending:
+                    future.cancel()
+                return winner.result()
+        return self.fail_attempts(url, attempts)
+
+    async def async_hedged_response(self, url):
+        """
+        Asynchronous version of hedged_response, losing request is cancelled
+        """
+        policy = self.hedge_policy
+        delay = policy.get_delay(self.get_class_name())
+        if delay is None:
+            return await self.async_timed_response(url)
+
+        primary = self.copy_url(url)
+        attempts = {asyncio.ensure_future(self.async_timed_response(primary)): primary}
+        try:
+            done, _ = await asyncio.wait(list(attempts), timeout=delay)
+            if not done and policy.acquire_hedge():
+                await self.async_throttle(url)
+                hedge = self.copy_url(url)
+                attempts[asyncio.ensure_future(self.async_timed_response(hedge))] = hedge
+
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = self.take_attempt(url, attempts, done)
+                if winner is not None:
+                    return winner.result()
+            return self.fail_attempts(url, attempts)
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    def prepare_request(self, url):
+        """
+        Sets url timeout from observed latency of its endpoint type
+        :param url: Instance of url_class
+        """
+        if self.hedge_policy is not None:
+            self.hedge_policy.on_request()
+            url.timeout = self.hedge_policy.get_timeout(self.get_class_name())
+
     async def async_fetch(self, url):
         """
         Makes asynchronous request to url and saves objects to provided instance of url_class
 
+        If url is deferred for retry, it is up to caller to wait url.retry_delay and fetch it again.
+        Urls of remaining pages are stored in url.page_urls and should be fetched by caller too.
+
         :param url: Instance of url_class
         :return: Instance of url_class
         """
+        if not self.check_available(url):
+            return url
+        await self.async_throttle(url)
+        self.prepare_request(url)
+        start = time.monotonic()
         try:
-            resp_data = await url.get_response()
+            if self.hedge_policy is not None:
+                resp_data = await self.async_hedged_response(url)
+            else:
+                resp_data = await self.async_get_response(url)
         except Exception as e:
-            url.handle_error(self.logger, *sys.exc_info())
-            objs = {}
+            self.process_response(url, exc_info=sys.exc_info())
         else:
-            objs = self.get_objects_from_url(resp_data)
+            self.process_response(url, resp_data=resp_data)
+            self.record_cost(url, time.monotonic() - start)
 
-        url.append_fetched_dicts(objs=objs)
+        return url
 
+    async def async_fetch_body(self, url):
+        """
+        Makes asynchronous request to url and keeps raw response body in url.body,
+        objects are extracted later by parse_body, e.g. in other process, and passed to process_parsed.
+        Failed request is processed as in async_fetch, hedging and streaming are not used.
+
+        :param url: Instance of url_class
+        :return: Instance of url_class
+        """
+        if not self.check_available(url):
+            return url
+        await self.async_throttle(url)
+        self.prepare_request(url)
+        start = time.monotonic()
+        try:
+            url.body = await url.get_body()
+        except Exception as e:
+            self.process_response(url, exc_info=sys.exc_info())
+        else:
+            url.body_seconds = time.monotonic() - start
         return url
 
+    def parse_body(self, url_string, body, projection):
+        """
+        Decodes response body and converts its objects to rows, counterpart of get_objects_from_url
+        Runs without db and url instances, so it could be called in other process.
+
+        :param url_string: str url of response, it is added to objects as source_url
+        :param body: bytes
+        :param projection: ColumnProjection of save class
+        :return: tuple of list of rows and number of pages or None
+        """
+        data = (self.decoder or self.url_class.decoder).loads(body)
+        pages = self.get_page_count(data) if self.paginate else None
+        rows = []
+        for obj in self.get_objects_from_url(data).values():
+            obj['source_url'] = url_string
+            rows.append(projection.to_row(obj))
+        return rows, pages
+
+    def process_parsed(self, url, rows, pages):
+        """
+        Stores rows of response parsed by parse_body, counterpart of process_response for successful request
+        :param url: Instance of url_class
+        :param rows: list of tuples
+        :param pages: int number of pages or None
+        """
+        self.update_rate(url)
+        if self.retry_policy is not None:
+            self.retry_policy.on_success(url)
+        self.set_page_urls(url, pages)
+        url.fetched_rows = rows
+        self.record_cost(url, url.body_seconds)
+
+    def process_parse_error(self, url, exc_info):
+        """
+        Marks url which body could not be parsed by parse_body as failed, counterpart of process_parsed
+        Response did arrive, so retry policy does not count failure against host and url is not retried,
+        the same body would fail again. Host is reported alive, so probe of half open circuit ends.
+
+        :param url: Instance of url_class
+        :param exc_info: sys.exc_info() of parse error
+        """
+        self.update_rate(url)
+        if self.retry_policy is not None:
+            self.retry_policy.on_success(url)
+        url.handle_error(self.logger, *exc_info)
+        url.failure = repr(exc_info[1])
+
     def fetch(self, url):
         """
         Makes request to url and saves objects to provided instance of url_class
 
+        Caller should pass returned url to reschedule, so retries and remaining pages are yielded by iter_urls.
+
         :param url: Instance of url_class
         :return: Instance of url_class
         """
+        if not self.check_available(url):
+            return url
+        self.throttle(url)
+        self.prepare_request(url)
+        start = time.monotonic()
         try:
             #  maybe define your own exception and raise it from this exceptions
-            resp_data = url.get_response()
-        # maybe add division by requests exceptions (requests.RequestException, Timeout, HTTPError, ConnectionError)
+            if self.hedge_policy is not None:
+                resp_data = self.hedged_response(url)
+            else:
+                resp_data = self.get_response(url)
         except Exception as e:
-            url.handle_error(self.logger, *sys.exc_info())
-            objs = {}
+            self.process_response(url, exc_info=sys.exc_info())
         else:
-            objs = self.get_objects_from_url(resp_data)
+            self.process_response(url, resp_data=resp_data)
+            self.record_cost(url, time.monotonic() - start)
 
-        url.append_fetched_dicts(objs=objs)
+        return url
+
+    def record_cost(self, url, seconds):
+        """
+        Passes cost of target to cost tracker, first page stands for all pages of target
+        :param url: Instance of url_class after successful request
+        :param seconds: float duration of request
+        """
+        if self.cost_tracker is None or url.id_to_update is None or url.page not in (None, 1):
+            return
+        # rows parsed out of process stand for objects
+        objects = url.fetched_dicts if url.fetched_rows is None else url.fetched_rows
+        self.cost_tracker.record(
+            url.id_to_update, seconds, pages=1 + len(url.page_urls), object_count=len(objects),
+            response_size=url.response_size
+        )
+
+    def push_pending(self, url, delay=0):
+        with self._pending_lock:
+            heapq.heappush(self.pending_queue, (time.monotonic() + delay, next(self._pending_counter), url))
+
+    def reschedule(self, url):
+        """
+        Puts urls produced by fetch to pending queue: url itself if it is deferred for retry and its remaining pages
+
+        :param url: Instance of url_class returned by fetch
+        :return: bool True if url is deferred and should not be counted as processed
+        """
+        for page_url in url.page_urls:
+            self.push_pending(page_url)
+        url.page_urls = []
+        if url.deferred:
+            self.push_pending(url, url.retry_delay)
+            return True
+        return False
+
+    def has_pending(self):
+        with self._pending_lock:
+            return bool(self.pending_queue)
+
+    def get_pending_delay(self):
+        """
+        :return: float seconds until the earliest url of pending queue is due, None if queue is empty
+        """
+        with self._pending_lock:
+            if not self.pending_queue:
+                return None
+            return max(0, self.pending_queue[0][0] - time.monotonic())
 
+    def pop_pending(self, block=False):
+        """
+        Takes url which time has come from pending queue
+
+        :param block: bool wait for the earliest url if no url is ready
+        :return: Instance of url_class or None
+        """
+        with self._pending_lock:
+            if not self.pending_queue:
+                return None
+            due_at, _, url = self.pending_queue[0]
+            wait = due_at - time.monotonic()
+            if wait <= 0 or block:
+                heapq.heappop(self.pending_queue)
+            else:
+                return None
+        if wait > 0:
+            time.sleep(wait)
         return url
 
+    def iter_urls(self, max_count=None, allow=None, idle=None, block=True):
+        """
+        Yields urls from get_urls, pending urls (retries and pages) are yielded in between
+        When get_urls is exhausted waits for urls in pending queue.
+
+        Every yielded url is one request, so retries and pages count against max_count as well as new targets.
+        Pending urls left when max_count is reached stay in pending queue, their targets are not marked
+        as processed and are loaded again by next run.
+
+        :param max_count: int number of requests or None for no limit
+        :param allow: callable, when it returns False no more urls are taken from get_urls,
+            pending urls of started targets are still yielded
+        :param idle: callable that waits until yielded urls are fetched and rescheduled, loaders that fetch urls
+            in other threads pass it, so urls rescheduled after pending queue became empty are yielded too
+        :param block: bool, if False None is yielded instead of waiting for pending url or idle,
+            caller should iterate again after some of its urls are fetched or pending url is due,
+            it decides itself when work is done, generator ends only at max_count
+        :return: Iterable
+        """
+        urls = iter(self.get_urls())
+        taken = 0
+        new = True
+        try:
+            while max_count is None or taken < max_count:
+                url = self.pop_pending()
+                if url is None and new:
+                    if allow is None or allow():
+                        url = next(urls, None)
+                    if url is None:
+                        new = False
+                        # claimed targets which were not taken are released by their generator
+                        if hasattr(urls, 'close'):
+                            urls.close()
+                if url is None:
+                    if not block:
+                        yield None
+                        continue
+                    url = self.pop_pending(block=True)
+                if url is None:
+                    if idle is None:
+                        break
+                    idle()
+                    if not self.has_pending():
+                        break
+                    continue
+                taken += 1
+                yield url
+        finally:
+            if hasattr(urls, 'close'):
+                urls.close()
+
     @classmethod
     def get_fetcher(cls, config):
         """
@@ -133,77 +760,87 @@ class AbstractUrlFetcher(LoggingMixin, metaclass=ABCMeta):
 
 
 class PaginatedFetcher(AbstractUrlFetcher):
-    """Handle urls with pagination"""
+    """
+    Handle urls with pagination
+
+    Only the first page is yielded by get_urls, remaining pages are added by fetch from pagination block of response.
+    """
 
     key = 'result.School'
     url_template = '{api_url}{obj_path}'.format(api_url=API_URL, obj_path=SCHOOL_PATH)
 
-    def __init__(self):
-        super().__init__()
-        self.pages = 1
-
-    def is_paginated(self, url_string):
-        """
-        Makes preflight requests to provided url and checks if paginated query differs from regular.
-
-        :param url_string: str
-        :return: bool
-        """
-
-        paged_url = '{url}{query}'.format(url=url_string, query='?page=1')
-        url = self.url_class(url=paged_url)
-        try:
-            resp_result = url.get_response()
-        except Exception as e:
-            url.handle_error(self.logger, *sys.exc_info())
-            raise
-        try:
-            pag_dict = resp_result['pagination']
-        except KeyError:
-            return False
-        else:
-            self.pages = pag_dict['pages']
-            return True
-
     def get_urls(self):
-        query_url = self.url_template
-        if self.is_paginated(query_url):
-            page = 1
-            while page <= self.pages:
-                yield self.url_class('{url}?page={page}'.format(url=query_url, page=page))
-                page += 1
-        else:
-            yield self.url_class(query_url)
+        yield self.make_url(self.get_page_url(self.url_template, 1), page=1)
 
 
 class DepartmentFetcher(AbstractUrlFetcher):
     url_template = '{api_url}{obj_path}'.format(api_url=API_URL, obj_path=DEPARTMENT_PATH)
     key = 'result.Department'
     fetch_class = School
+    target_field = 'school_id'
+    stage = 'department'
 
     def get_values_queryset(self):
-        return self.fetch_class.objects.filter(department_scraped=False).values_list('school_id', flat=True)
+        return self.filter_shard(
+            self.fetch_class.objects.filter(department_scraped=False)
+        ).values_list(self.target_field, flat=True)
+
+    def get_target_ids(self):
+        """
+        :return: Iterable of ids of fetch_class objects, claimed from task queue if fetcher has one,
+            otherwise ordered by expected cost if fetcher has schedule
+        """
+        if self.task_queue is not None:
+            return self.task_queue.iter_claimed()
+        if self.schedule is not None:
+            return self.cost_tracker.order(self.get_values_queryset(), self.schedule)
+        return self.get_values_queryset()
+
+    def count_backlog(self):
+        if self.task_queue is not None:
+            stats = self.task_queue.get_stats()
+            return stats.get(ScrapeTask.PENDING, 0) + stats.get(ScrapeTask.CLAIMED, 0)
+        return self.get_values_queryset().count()
+
+    def enqueue_tasks(self):
+        """
+        Creates tasks for objects of fetch_class which are not processed yet
+        :return: int number of created tasks
+        """
+        return self.task_queue.enqueue(self.get_values_queryset())
 
     def get_urls(self):
-        values_queryset = self.get_values_queryset()
-        for v in values_queryset:
-            query_url = self.url_template.format(v)
-            yield self.url_class(query_url, id_to_update=v)
+        target_ids = iter(self.get_target_ids())
+        try:
+            for v in target_ids:
+                yield self.make_target_url(v)
+        finally:
+            # claimed targets are released when generator of task queue is closed, not when it is collected
+            if hasattr(target_ids, 'close'):
+                target_ids.close()
 
 
 class CourseFetcher(DepartmentFetcher):
     url_template = '{api_url}{obj_path}'.format(api_url=API_URL, obj_path=COURSE_PATH)
     key = 'result.Course'
     fetch_class = Department
+    target_field = 'department_id'
+    stage = 'course'
 
     def get_values_queryset(self):
-        return self.fetch_class.objects.filter(course_scraped=False).values_list('department_id', flat=True)
+        return self.filter_shard(
+            self.fetch_class.objects.filter(course_scraped=False)
+        ).values_list(self.target_field, flat=True)
 
 
 class ProfessorFetcher(DepartmentFetcher):
     url_template = '{api_url}{obj_path}'.format(api_url=API_URL, obj_path=PROFESSOR_PATH)
     key = 'result.Professor'
     fetch_class = Department
+    target_field = 'department_id'
+    stage = 'professor'
 
     def get_values_queryset(self):
-        return self.fetch_class.objects.filter(professor_scraped=False).values_list('department_id', flat=True)
\ No newline at end of file
+        return self.filter_shard(
+            self.fetch_class.objects.filter(professor_scraped=False)
+        ).values_list(self.target_field, flat=True)
\ No newline at end of file
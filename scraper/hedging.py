@@ -0,0 +1,183 @@
+"""
+Classes cut tail latency of requests
+
+LatencyTracker keeps rolling latency samples of every endpoint type.
+HedgePolicy uses them to decide when duplicate request should be sent and what timeout requests get.
+"""
+
+import math
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LatencyTracker(object):
+    """
+    Keeps last window latencies of successful requests for every key
+
+    Percentiles are not reported until key has min_samples samples.
+    """
+
+    def __init__(self, window=500, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(window={!r}, min_samples={!r})'.format(self.__class__.__name__, self.window, self.min_samples)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, key, latency):
+        """
+        :param key: str endpoint type
+        :param latency: float seconds
+        """
+        with self._lock:
+            samples = self.samples.get(key)
+            if samples is None:
+                samples = self.samples[key] = deque(maxlen=self.window)
+            samples.append(latency)
+
+    def get_percentile(self, key, percentile):
+        """
+        :param key: str endpoint type
+        :param percentile: float from 0 to 100
+        :return: float seconds or None if there are not enough samples
+        """
+        with self._lock:
+            samples = self.samples.get(key)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        # nearest rank
+        rank = max(1, math.ceil(percentile / 100 * len(ordered)))
+        return ordered[rank - 1]
+
+    def get_stats(self):
+        stats = {}
+        for key in list(self.samples):
+            stats[key] = {
+                'count': len(self.samples[key]),
+                'p50': self.get_percentile(key, 50),
+                'p95': self.get_percentile(key, 95),
+                'p99': self.get_percentile(key, 99),
+            }
+        return stats
+
+
+class HedgePolicy(object):
+    """
+    Decides when second request to slow url should be sent and how long requests could take
+
+    Request that is still running after percentile of latency of its endpoint type gets a duplicate,
+    first successful response is taken and the other request is cancelled.
+    Number of duplicates is kept below budget ratio of all requests.
+
+    percentile: latency percentile after which hedge request is sent
+    budget: max ratio of hedge requests to all requests
+    timeout_percentile, timeout_multiplier: request timeout is this latency percentile multiplied by multiplier
+    min_timeout, max_timeout: bounds of request timeout in seconds, max_timeout is used until samples are taken
+    window, min_samples: settings of LatencyTracker
+    max_workers: number of threads that run requests of blocking fetch, should be at least
+        twice number of fetch workers, because every hedged fetch could have two requests in flight
+    """
+
+    def __init__(self, percentile=95, budget=0.05, timeout_percentile=99, timeout_multiplier=3, min_timeout=1,
+                 max_timeout=10, window=500, min_samples=20, max_workers=32):
+        self.percentile = percentile
+        self.budget = budget
+        self.timeout_percentile = timeout_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_workers = max_workers
+        self.tracker = LatencyTracker(window=window, min_samples=min_samples)
+        self.request_count = 0
+        self.hedge_count = 0
+        self.hedge_wins = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(percentile={!r}, budget={!r}, max_timeout={!r})'.format(
+            self.__class__.__name__, self.percentile, self.budget, self.max_timeout
+        )
+
+    def __getstate__(self):
+        # policy is pickled with fetcher for process pool, every process gets its own executor
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def get_delay(self, key):
+        """
+        :param key: str endpoint type
+        :return: float seconds after which hedge request is sent or None if there are not enough samples
+        """
+        return self.tracker.get_percentile(key, self.percentile)
+
+    def get_timeout(self, key):
+        """
+        :param key: str endpoint type
+        :return: float seconds request to endpoint could take
+        """
+        latency = self.tracker.get_percentile(key, self.timeout_percentile)
+        if latency is None:
+            return self.max_timeout
+        return max(self.min_timeout, min(self.max_timeout, latency * self.timeout_multiplier))
+
+    def record(self, key, latency):
+        self.tracker.record(key, latency)
+
+    def on_request(self):
+        with self._lock:
+            self.request_count += 1
+
+    def acquire_hedge(self):
+        """
+        Takes place for hedge request from budget
+        :return: bool True if hedge request could be sent
+        """
+        with self._lock:
+            if self.hedge_count + 1 > self.request_count * self.budget:
+                return False
+            self.hedge_count += 1
+            return True
+
+    def on_hedge_won(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def get_stats(self):
+        return {
+            'requests': self.request_count,
+            'hedges': self.hedge_count,
+            'hedge_wins': self.hedge_wins,
+            'latency': self.tracker.get_stats(),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
@@ -0,0 +1,74 @@
+"""
+Filters of natural keys that are already saved
+
+Upsert savers check keys of fetched objects against filter, so rows known to exist skip db round trip.
+KeySet is exact and keeps every key, BloomFilter has fixed size and could answer maybe for new key.
+"""
+
+import hashlib
+import math
+
+
+class KeySet(object):
+    """
+    Exact filter backed by set
+
+    exact: True means positive answer is reliable and object could be skipped without db check
+    """
+    exact = True
+
+    def __init__(self):
+        self.keys = set()
+
+    def __repr__(self, *args, **kwargs):
+        return '{}()'.format(self.__class__.__name__)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        self.keys.add(key)
+
+    def might_contain(self, key):
+        return key in self.keys
+
+
+class BloomFilter(object):
+    """
+    Bloom filter for runs where set of all keys does not fit memory
+
+    Negative answer is reliable, positive answer should be confirmed by db.
+
+    capacity: expected number of keys
+    error_rate: probability of false positive when capacity keys are added
+    """
+    exact = False
+
+    def __init__(self, capacity=10 ** 7, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(capacity={!r}, error_rate={!r})'.format(self.__class__.__name__, self.capacity, self.error_rate)
+
+    def __len__(self):
+        return self.count
+
+    def get_positions(self, key):
+        # double hashing, two halves of one digest give all positions
+        digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self.get_positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def might_contain(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(key))
@@ -0,0 +1,377 @@
+"""
+Classes limit load that is put on api
+
+AIMDLimit and GradientLimit calculate concurrency limit from observed latency and errors.
+AdaptiveLimiter and AsyncAdaptiveLimiter apply this limit to threads and coroutines.
+RateLimiter caps request rate to each host with token buckets.
+"""
+
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+TOO_MANY_REQUESTS = 429
+
+
+class AIMDLimit(object):
+    """
+    Additive increase, multiplicative decrease of concurrency limit
+
+    Limit grows by one after each successful request that was made while limit was utilized
+    and is multiplied by backoff_ratio after error or request slower than timeout.
+    """
+
+    def __init__(self, initial=10, min_limit=1, max_limit=100, backoff_ratio=0.9, timeout=5.0):
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.timeout = timeout
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(initial={!r}, min_limit={!r}, max_limit={!r})'.format(
+            self.__class__.__name__, self.initial, self.min_limit, self.max_limit
+        )
+
+    def update(self, limit, latency, error, in_flight):
+        """
+        Calculates new limit from request sample
+
+        :param limit: float current limit
+        :param latency: float seconds request took
+        :param error: bool if request failed
+        :param in_flight: int number of requests in flight when sample was taken
+        :return: float new limit
+        """
+        if error or latency > self.timeout:
+            limit = limit * self.backoff_ratio
+        elif in_flight * 2 >= limit:
+            # grow only when limit is actually used, otherwise it would grow without bounds
+            limit = limit + 1
+        return max(self.min_limit, min(self.max_limit, limit))
+
+
+class GradientLimit(object):
+    """
+    Adjusts concurrency limit by ratio of long term latency to current latency
+
+    When current latency rises above long term average, requests start queueing on api side and limit goes down.
+    sqrt(limit) is added as allowed queue, so limit could grow while latency is stable.
+    """
+
+    def __init__(self, initial=10, min_limit=1, max_limit=100, smoothing=0.2, long_window=600, tolerance=1.5,
+                 backoff_ratio=0.9):
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.backoff_ratio = backoff_ratio
+        # exponential moving average factor of long term latency
+        self.long_factor = 2 / (long_window + 1)
+        self.long_latency = None
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(initial={!r}, min_limit={!r}, max_limit={!r})'.format(
+            self.__class__.__name__, self.initial, self.min_limit, self.max_limit
+        )
+
+    def update(self, limit, latency, error, in_flight):
+        """
+        Calculates new limit from request sample, see AIMDLimit.update for arguments
+        """
+        if error:
+            return max(self.min_limit, limit * self.backoff_ratio)
+
+        if self.long_latency is None:
+            self.long_latency = latency
+        else:
+            self.long_latency += (latency - self.long_latency) * self.long_factor
+
+        if in_flight * 2 < limit:
+            # app limited, sample tells nothing about api capacity
+            return limit
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_latency / max(latency, 1e-6)))
+        new_limit = limit * gradient + math.sqrt(limit)
+        new_limit = limit * (1 - self.smoothing) + new_limit * self.smoothing
+        return max(self.min_limit, min(self.max_limit, new_limit))
+
+
+class BaseAdaptiveLimiter(object):
+    """
+    Keeps number of requests in flight below limit calculated by limit algorithm
+
+    history contains (seconds since creation, limit) pairs for every change of integer limit.
+    """
+
+    def __init__(self, algorithm=None, history_size=1000):
+        self.algorithm = algorithm or AIMDLimit()
+        self.limit = self.algorithm.initial
+        self.in_flight = 0
+        self.started_at = time.monotonic()
+        self.history = deque([(0.0, int(self.limit))], maxlen=history_size)
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(algorithm={!r})'.format(self.__class__.__name__, self.algorithm)
+
+    @property
+    def max_limit(self):
+        return self.algorithm.max_limit
+
+    def get_limit(self):
+        return max(1, int(self.limit))
+
+    def on_sample(self, latency, error):
+        """
+        Recalculates limit, should be called with in_flight counter including sampled request
+        """
+        new_limit = self.algorithm.update(self.limit, latency, error, self.in_flight)
+        if int(new_limit) != int(self.limit):
+            self.history.append((time.monotonic() - self.started_at, int(new_limit)))
+        self.limit = new_limit
+
+    def get_stats(self):
+        limits = [limit for _, limit in self.history]
+        return {
+            'limit': self.get_limit(),
+            'min': min(limits),
+            'max': max(limits),
+            'changes': len(limits) - 1,
+        }
+
+
+class AdaptiveLimiter(BaseAdaptiveLimiter):
+    """
+    Adaptive limiter for threads
+
+    Usage:
+        start = limiter.acquire()
+        ...make request...
+        limiter.release(start, error=False)
+    """
+
+    def __init__(self, algorithm=None, history_size=1000):
+        super().__init__(algorithm=algorithm, history_size=history_size)
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Blocks until request could be made
+        :return: float start time that should be passed to release
+        """
+        with self._cond:
+            while self.in_flight >= self.get_limit():
+                self._cond.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start, error=False):
+        """
+        Takes sample of finished request and frees its place
+        :param start: float value returned by acquire
+        :param error: bool if request failed
+        """
+        latency = time.monotonic() - start
+        with self._cond:
+            self.on_sample(latency, error)
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+
+class AsyncAdaptiveLimiter(BaseAdaptiveLimiter):
+    """
+    Adaptive limiter for coroutines, has the same interface as AdaptiveLimiter but acquire should be awaited
+    """
+
+    def __init__(self, algorithm=None, history_size=1000):
+        super().__init__(algorithm=algorithm, history_size=history_size)
+        self._cond = None
+
+    def get_condition(self):
+        # condition is created lazily, so it is bound to loop that runs requests
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self):
+        cond = self.get_condition()
+        async with cond:
+            while self.in_flight >= self.get_limit():
+                await cond.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, start, error=False):
+        latency = time.monotonic() - start
+        cond = self.get_condition()
+        async with cond:
+            self.on_sample(latency, error)
+            self.in_flight -= 1
+            cond.notify_all()
+
+
+class TokenBucket(object):
+    """
+    Token bucket with sustained rate and burst
+
+    Thread safe. Tokens are reserved in advance, so caller could wait for its token either with time.sleep
+    or with asyncio.sleep without holding any lock.
+
+    rate: tokens added per second
+    burst: max number of tokens in bucket
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(rate={!r}, burst={!r})'.format(self.__class__.__name__, self.rate, self.burst)
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self):
+        """
+        Takes one token, tokens could go negative, which means that token is reserved in future
+
+        :return: float seconds caller should wait before request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(delay, self.paused_until - now)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def async_acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.refill(time.monotonic())
+            self.rate = rate
+
+    def pause(self, seconds):
+        """
+        Stops handing out tokens for provided number of seconds
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter(object):
+    """
+    Keeps token bucket for every host
+
+    One instance should be shared by all fetchers of process to limit total request rate,
+    e.g. by setting AbstractUrlFetcher.rate_limiter.
+
+    rate, burst: settings of every host bucket
+    adapt_to_headers: if True Retry-After and X-RateLimit-* response headers change bucket rate
+    min_rate: lowest rate headers could set
+    """
+
+    def __init__(self, rate=10, burst=10, adapt_to_headers=False, min_rate=0.1):
+        self.rate = rate
+        self.burst = burst
+        self.adapt_to_headers = adapt_to_headers
+        self.min_rate = min_rate
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(rate={!r}, burst={!r}, adapt_to_headers={!r})'.format(
+            self.__class__.__name__, self.rate, self.burst, self.adapt_to_headers
+        )
+
+    def get_bucket(self, url_string):
+        """
+        :param url_string: str
+        :return: TokenBucket of url host
+        """
+        host = urlsplit(url_string).netloc
+        with self._lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(rate=self.rate, burst=self.burst)
+        return bucket
+
+    def acquire(self, url_string):
+        """
+        Blocks until request to url_string is allowed
+        """
+        self.get_bucket(url_string).acquire()
+
+    async def async_acquire(self, url_string):
+        """
+        Waits without blocking loop until request to url_string is allowed
+        """
+        await self.get_bucket(url_string).async_acquire()
+
+    def update_from_headers(self, url_string, status_code, headers):
+        """
+        Adjusts host bucket to rate limit reported by api
+
+        :param url_string: str
+        :param status_code: int response status
+        :param headers: mapping of response headers
+        """
+        if not self.adapt_to_headers:
+            return
+        bucket = self.get_bucket(url_string)
+
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        if retry_after is not None:
+            bucket.pause(retry_after)
+        elif status_code == TOO_MANY_REQUESTS:
+            bucket.set_rate(max(self.min_rate, bucket.rate / 2))
+
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+        if reset > time.time():
+            # reset is epoch timestamp, not number of seconds
+            reset -= time.time()
+        if reset > 0:
+            bucket.set_rate(max(self.min_rate, min(self.rate, remaining / reset)))
+
+
+def parse_retry_after(value):
+    """
+    :param value: str value of Retry-After header, seconds or http date
+    :return: float seconds or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
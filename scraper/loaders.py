@@ -1,10 +1,19 @@
 import asyncio
+import logging
+import sys
+import time
 
-from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from queue import Queue
 from threading import Thread, Lock
 from abc import ABCMeta, abstractmethod
 
+import aiohttp
+from django.db import connections
+
+from scraper.budget import LoadBudget
+from scraper.db import ColumnProjection
 from scraper.utils import LoggingMixin
 
 
@@ -21,6 +30,8 @@ class Loader(AbstractLoader):
 
     load method is simple implementation of non concurrent loading.
     """
+    # adaptive concurrency limiter, used by concurrent loaders
+    limiter = None
 
     def __init__(self, fetcher, saver, logger=None):
         super().__init__()
@@ -30,6 +41,10 @@ class Loader(AbstractLoader):
         self.configure_logging(logger)
         self.req_count = 0
         self.error_count = 0
+        # budget of current load call, without deadline and rate until load starts it
+        self.budget = LoadBudget()
+        # number of targets left after load, None if fetcher does not track them
+        self.backlog = None
 
     def __repr__(self, *args, **kwargs):
         return '{}(fetcher={}(), saver={}())'.format(self.get_class_name(), self.fetcher.get_class_name(), self.saver.get_class_name())
@@ -52,163 +67,815 @@ class Loader(AbstractLoader):
         self.log('Fetcher: {}'.format(self.fetcher))
         self.log('Saver: {}'.format(self.saver))
 
-    def load(self, max_req_count=10):
+    def log_limiter_stats(self):
+        """
+        Dumps how concurrency limit changed during loading
+        """
+        if self.limiter is not None:
+            self.log('Concurrency limit {}'.format(self.limiter.get_stats()))
+
+    def start_budget(self, deadline=None, rate=None):
+        """
+        :param deadline: float seconds load call could take, None for no deadline
+        :param rate: float target requests per second, None for no pacing
+        """
+        self.budget = LoadBudget(seconds=deadline, rate=rate)
+        self.budget.start()
+
+    def get_concurrency(self):
+        """
+        :return: int number of urls fetched at once
+        """
+        return 1
+
+    def get_flush_seconds(self):
+        return getattr(self.saver, 'max_flush_seconds', 0)
+
+    def allow_url(self, in_flight=0):
+        """
+        Checks whether new url would be fetched and saved before deadline of budget
+        Waits for the first request to finish if one wave of urls is issued already.
+
+        :param in_flight: int number of urls issued and not fetched yet
+        :return: bool
+        """
+        if self.budget.holds(in_flight, self.get_concurrency()):
+            self.budget.wait_measured()
+        return self.budget.allow(in_flight, self.get_concurrency(), self.get_flush_seconds())
+
+    def fetch(self, url):
+        """
+        Fetches url after its turn of target rate
+        """
+        self.budget.pace()
+        return self.timed_fetch(url=url)
+
+    def timed_fetch(self, url):
+        """
+        Fetches url and records duration of request to budget
+        """
+        start = time.monotonic()
+        furl = self.fetcher.fetch(url=url)
+        self.budget.on_request(time.monotonic() - start)
+        return furl
+
+    def log_budget(self):
+        """
+        Dumps how load call used its budget and number of targets left, should be called after final db update
+        """
+        self.backlog = self.fetcher.count_backlog()
+        if self.budget.stopped_at is not None:
+            self.log('Stopped taking urls at {:.1f}s of {}s budget'.format(self.budget.stopped_at, self.budget.seconds))
+        if self.budget.seconds is not None or self.budget.rate is not None:
+            self.log('Budget {}'.format(self.budget.get_stats()))
+        self.log('Backlog {}'.format(self.backlog))
+
+    def load(self, max_req_count=10, deadline=None, rate=None):
         """
         Fetches objects from urls provided by fetcher class
         Saves fetched objects using saver class
-        :param max_req_count: int number of requests that should be emmited
+        :param max_req_count: int number of requests that should be emmited, None for no limit
+        :param deadline: float seconds load could take, new urls are not taken when they would finish later,
+            pages and retries of started targets are still fetched
+        :param rate: float target requests per second
         """
 
         self.log('Start data loading')
         self.log_configuration()
-        for url in self.fetcher.get_urls():
-            furl = self.fetcher.fetch(url=url)
+        self.start_budget(deadline, rate)
+        for url in self.fetcher.iter_urls(max_req_count, allow=self.allow_url):
+            furl = self.fetch(url=url)
+            if self.fetcher.reschedule(furl):
+                continue
             if furl.error:
                 self.error_count += 1
-            else:
-                self.saver.append(fetched_url=furl)
+            # failed url goes to saver too, it records failed task
+            self.saver.append(fetched_url=furl)
             self.req_count += 1
 
-            if self.req_count == max_req_count:
-                self.log('Hit max request at {}'.format(self.req_count))
-                break
+        if self.req_count == max_req_count:
+            self.log('Hit max request at {}'.format(self.req_count))
 
         # final db update
         self.saver.update_db()
 
         self.log('Requests issued {}. Errors {}'.format(self.req_count, self.error_count))
+        self.log_budget()
         self.log('Finish data loading')
 
 
 class ThreadedLoader(Loader):
     """
     Processes urls using threading module
+
+    Fetch workers take urls from fetch queue and put fetched urls to save queue, save workers append them
+    to savers. Both queues are bounded, so fetching stops while savers are behind.
+    Workers are stopped by None put to their queue after all urls are handled, save workers flush
+    their savers before exit, so loader could be used again without leaking threads.
+
+    concurrent: number of fetch workers
+    save_workers: number of save workers, every one has its own clone of saver,
+        more than one makes sense only for db backend that allows concurrent writes
+    limiter: AdaptiveLimiter instance, if provided number of workers is its ceiling
+        and number of simultaneous requests follows its limit
     """
     # multiplier for queue size
     concurrent_multiplier = 3
 
-    def __init__(self, fetcher, saver, concurrent=5, logger=None):
+    def __init__(self, fetcher, saver, concurrent=5, save_workers=1, limiter=None, logger=None):
         super().__init__(fetcher, saver, logger=logger)
-        self.concurrent = concurrent
+        if save_workers > 1 and not hasattr(saver, 'clone'):
+            raise ValueError('{} could not be cloned for {} save workers'.format(saver.get_class_name(), save_workers))
+        self.limiter = limiter
+        self.concurrent = concurrent if limiter is None else limiter.max_limit
+        self.save_workers = save_workers
         self.fq = Queue(maxsize=(self.concurrent * self.concurrent_multiplier))
-        self.sq = Queue()
+        self.sq = Queue(maxsize=(self.concurrent * self.concurrent_multiplier))
+        # guards counters updated by workers
+        self._lock = Lock()
+        # the largest number of urls waiting in queues and number of times fetch workers waited for save queue
+        self.max_fetch_depth = 0
+        self.max_save_depth = 0
+        self.save_full_count = 0
+        # urls put to fetch queue and not fetched yet, budget projects finish of next url from it
+        self.in_flight = 0
+        self.save_error = None
+        self.fetch_threads = []
+        self.save_threads = []
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(fetcher={}(), saver={}(), concurrent={!r}, save_workers={!r})'.format(
+            self.get_class_name(), self.fetcher.get_class_name(), self.saver.get_class_name(), self.concurrent,
+            self.save_workers
+        )
+
+    def get_concurrency(self):
+        return self.concurrent if self.limiter is None else self.limiter.get_limit()
+
+    def fetch(self, url):
+        """
+        Fetches url after its turn of target rate through limiter if it is provided
+        :param url: url instance
+        :return: url instance with fetched_dicts populated
+        """
+        # turn of target rate is awaited before limiter slot is taken, so waiting is not sampled as latency
+        self.budget.pace()
+        if self.limiter is None:
+            return self.timed_fetch(url=url)
+        start = self.limiter.acquire()
+        error = True
+        try:
+            furl = self.timed_fetch(url=url)
+            error = furl.error or furl.deferred
+        finally:
+            # slot is returned even if fetch raised, otherwise limit would shrink for good
+            self.limiter.release(start, error=error)
+        return furl
+
+    def get_in_flight(self):
+        with self._lock:
+            return self.in_flight
+
+    def put_fetched(self, furl):
+        """
+        Puts fetched url to save queue, blocks while queue is full
+        """
+        if self.sq.full():
+            with self._lock:
+                self.save_full_count += 1
+        self.sq.put(furl)
+        depth = self.sq.qsize()
+        with self._lock:
+            self.max_save_depth = max(self.max_save_depth, depth)
 
     def fetch_worker(self):
         """
         Fetches objects from urls provided by fetcher class and puts them to save queue
         """
-        l = Lock()
-
         while True:
             item = self.fq.get()
-            furl = self.fetcher.fetch(url=item)
-            if furl.error:
-                with l:
-                    self.error_count += 1
-            else:
-                self.sq.put(furl)
-
-            with l:
+            if item is None:
+                self.fq.task_done()
+                return
+            furl = self.fetch(url=item)
+            with self._lock:
+                self.in_flight -= 1
+            if self.fetcher.reschedule(furl):
+                self.fq.task_done()
+                continue
+            # failed url goes to saver too, it records failed task
+            self.put_fetched(furl)
+            with self._lock:
                 self.req_count += 1
+                if furl.error:
+                    self.error_count += 1
             self.fq.task_done()
 
-    def save_worker(self):
+    def save_worker(self, saver):
         """
         Saves fetched objects using saver class
+        Worker keeps draining queue after save failure, so fetch workers are not blocked, error is raised by load.
+
+        :param saver: saver of this worker
         """
         while True:
             item = self.sq.get()
-            self.saver.append(fetched_url=item)
-            self.sq.task_done()
+            try:
+                if item is None:
+                    saver.update_db()
+                elif self.save_error is None:
+                    saver.append(fetched_url=item)
+            except Exception as e:
+                self.log('Save failure', level=logging.ERROR, exc_info=True)
+                self.save_error = e
+            finally:
+                self.sq.task_done()
+            if item is None:
+                # save worker thread has its own db connection
+                connections.close_all()
+                return
+
+    def start_thread(self, target, *args):
+        thread = Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
 
     def create_workers(self):
         """
         Creates necessary workers
+        :return: list of savers of save workers
         """
-        for i in range(self.concurrent):
-            t = Thread(target=self.fetch_worker)
-            t.daemon = True
-            t.start()
-
-        st = Thread(target=self.save_worker, daemon=True)
-        st.start()
+        savers = [self.saver] + [self.saver.clone() for _ in range(self.save_workers - 1)]
+        self.fetch_threads = [self.start_thread(self.fetch_worker) for _ in range(self.concurrent)]
+        self.save_threads = [self.start_thread(self.save_worker, saver) for saver in savers]
+        return savers
 
-    def load(self, max_req_count=10):
+    def stop_workers(self):
+        """
+        Puts sentinel for every worker and waits until workers exit, fetch workers go first,
+        so save workers get sentinels after all fetched urls
+        """
+        for thread in self.fetch_threads:
+            self.fq.put(None)
+        for thread in self.fetch_threads:
+            thread.join()
+        for thread in self.save_threads:
+            self.sq.put(None)
+        for thread in self.save_threads:
+            thread.join()
+        self.fetch_threads = []
+        self.save_threads = []
+
+    def get_queue_stats(self):
+        return {
+            'fetch_queue': self.fq.qsize(),
+            'save_queue': self.sq.qsize(),
+            'max_fetch_queue': self.max_fetch_depth,
+            'max_save_queue': self.max_save_depth,
+            'save_queue_full': self.save_full_count,
+        }
+
+    def load(self, max_req_count=10, deadline=None, rate=None):
         """
         Creates workers and orchestrates their work
-        :param max_req_count: int number of requests that should be emmited
+        :param max_req_count: int number of requests that should be emmited, None for no limit
+        :param deadline: float seconds load could take, urls waiting in fetch queue are taken into account
+        :param rate: float target requests per second of all fetch workers
         """
-
-        self.create_workers()
+        self.save_error = None
+        savers = self.create_workers()
 
         self.log('Start data loading')
         self.log_configuration()
+        self.start_budget(deadline, rate)
+
+        try:
+            # workers reschedule urls after they are fetched, so pending queue is checked again when queue is done
+            urls = self.fetcher.iter_urls(
+                max_req_count, allow=lambda: self.allow_url(self.get_in_flight()), idle=self.fq.join
+            )
+            for url in urls:
+                with self._lock:
+                    self.in_flight += 1
+                self.fq.put(url)
+                self.max_fetch_depth = max(self.max_fetch_depth, self.fq.qsize())
+        finally:
+            # save workers write the rest of their objects
+            self.stop_workers()
+        for saver in savers[1:]:
+            self.saver.merge_counters(saver)
+        if self.save_error is not None:
+            raise self.save_error
+
+        self.log('Requests issued {}. Errors {}'.format(self.req_count, self.error_count))
+        self.log('Queues {}'.format(self.get_queue_stats()))
+        self.log_limiter_stats()
+        self.log_budget()
+        self.log('Finish data loading')
+
+
+def timed_call(func, url):
+    """
+    Calls func with url and measures its duration in worker of executor, module level so it could be pickled
+    :return: tuple of result and float seconds
+    """
+    start = time.monotonic()
+    result = func(url)
+    return result, time.monotonic() - start
+
+
+class ExecutorLoader(Loader):
+    """
+    Processes urls using concurrent.futures executors
+
+    backend: 'thread' runs fetcher.fetch in ThreadPoolExecutor,
+        'process' runs it in ProcessPoolExecutor, so json decoding and object extraction are done out of the GIL
+        and url instances come back with plain fetched dicts. Every child process would get its own copy
+        of rate limiter, retry policy and hedge policy, so fetcher with them could not use this backend.
+        Costs are recorded by parent from urls that come back.
+    concurrent: number of workers
+    """
+    executor_classes = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor,
+    }
+    # fetcher policies which state has to be shared by all requests
+    process_unsafe_policies = ('rate_limiter', 'retry_policy', 'hedge_policy')
+    # multiplier for number of futures in flight
+    concurrent_multiplier = 3
+
+    def __init__(self, fetcher, saver, concurrent=5, backend='thread', logger=None):
+        if backend not in self.executor_classes:
+            raise ValueError('Unknown backend {!r}, choose one of {}'.format(backend, sorted(self.executor_classes)))
+        if backend == 'process':
+            policies = [name for name in self.process_unsafe_policies if getattr(fetcher, name) is not None]
+            if policies:
+                raise ValueError('{} with {} could not be used with process backend'.format(
+                    fetcher.get_class_name(), ', '.join(policies)))
+        super().__init__(fetcher, saver, logger=logger)
+        self.concurrent = concurrent
+        self.backend = backend
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(fetcher={}(), saver={}(), concurrent={!r}, backend={!r})'.format(
+            self.get_class_name(), self.fetcher.get_class_name(), self.saver.get_class_name(), self.concurrent,
+            self.backend
+        )
+
+    def get_concurrency(self):
+        return self.concurrent
+
+    def create_executor(self):
+        return self.executor_classes[self.backend](max_workers=self.concurrent)
+
+    def handle_done(self, done, pending):
+        """
+        Propagates urls from completed futures to saver
+
+        :param done: iterable of completed futures
+        :param pending: dict of submitted future and its url, completed ones are removed
+        """
+        for future in done:
+            url = pending.pop(future)
+            try:
+                furl, seconds = future.result()
+            except Exception as e:
+                # fetch handles url errors itself, this is failure of executor (e.g. broken process pool)
+                self.log('Executor failure', level=logging.ERROR, exc_info=True)
+                url.handle_error(self.logger, *sys.exc_info())
+                url.failure = repr(e)
+                furl = url
+            else:
+                self.budget.on_request(seconds)
+                # cost tracker is not sent to child process, url came back with everything it needs
+                if self.backend == 'process' and not furl.error and not furl.deferred:
+                    self.fetcher.record_cost(furl, seconds)
+                if self.fetcher.reschedule(furl):
+                    continue
+            if furl.error:
+                self.error_count += 1
+            # failed url goes to saver too, it records failed task
+            self.saver.append(fetched_url=furl)
+            self.req_count += 1
+
+    def drain(self, pending):
+        """
+        Waits for all submitted futures and handles them
+        :param pending: dict of submitted future and its url
+        """
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            self.handle_done(done, pending)
+
+    def allow_submit(self, pending):
+        """
+        Checks whether new url would be fetched and saved before deadline of budget, counterpart of allow_url
+        Durations are recorded by this thread when futures are handled, so the first wave is waited for here.
 
-        urls = islice(self.fetcher.get_urls(), max_req_count)
-        for url in urls:
-            self.fq.put(url)
+        :param pending: dict of submitted future and its url
+        :return: bool
+        """
+        if self.budget.holds(len(pending), self.get_concurrency()):
+            done, _ = wait(
+                pending, timeout=max(0, self.budget.deadline - time.monotonic()), return_when=FIRST_COMPLETED
+            )
+            self.handle_done(done, pending)
+        return self.budget.allow(len(pending), self.get_concurrency(), self.get_flush_seconds())
+
+    def load(self, max_req_count=10, deadline=None, rate=None):
+        """
+        Submits urls to executor keeping bounded window of futures in flight
+        Saves urls in order of their completion
+        :param max_req_count: int number of requests that should be emmited, None for no limit
+        :param deadline: float seconds load could take, submitted urls are taken into account
+        :param rate: float target requests per second of all workers
+        """
+        self.log('Start data loading')
+        self.log_configuration()
+        self.start_budget(deadline, rate)
+
+        window = self.concurrent * self.concurrent_multiplier
+        # future of every submitted url and the url, so url of failed future is not lost
+        pending = {}
+        # urls are rescheduled when their futures are handled, so pending queue is checked again after drain
+        urls = self.fetcher.iter_urls(
+            max_req_count, allow=lambda: self.allow_submit(pending), idle=lambda: self.drain(pending)
+        )
+        with self.create_executor() as executor:
+            for url in urls:
+                if len(pending) >= window:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    self.handle_done(done, pending)
+                self.budget.pace()
+                pending[executor.submit(timed_call, self.fetcher.fetch, url)] = url
+            self.drain(pending)
 
-        self.fq.join()
-        self.sq.join()
         # final db update
         self.saver.update_db()
 
         self.log('Requests issued {}. Errors {}'.format(self.req_count, self.error_count))
+        self.log_budget()
         self.log('Finish data loading')
 
 
 class AsyncLoader(Loader):
     """
     Processes urls using asyncio module
+
+    All requests of one load call go through single aiohttp.ClientSession,
+    so connection pool, dns cache and keep-alive sockets are shared between urls.
+    Urls are taken from fetcher lazily, only window of them is scheduled at once,
+    next url is taken when one of scheduled urls is handled.
+
+    connections: max number of simultaneous requests and connections
+    limit_per_host: max number of connections to one host, 0 means no limit
+    ttl_dns_cache: seconds resolved addresses are cached
+    keepalive_timeout: seconds idle connection is kept open
+    window: max number of scheduled urls, fetched or waiting for connection, by default
+        window_multiplier times connections, so connections are not idle while fetched urls are saved
     """
+    # multiplier of connections for default window
+    window_multiplier = 2
 
-    def __init__(self, fetcher, saver, connections=100, logger=None):
+    def __init__(self, fetcher, saver, connections=100, limit_per_host=0, ttl_dns_cache=300, keepalive_timeout=30,
+                 limiter=None, window=None, logger=None):
         super().__init__(fetcher, saver, logger=logger)
         self.loop = asyncio.get_event_loop()
         self.sem = asyncio.Semaphore(connections)
+        # AsyncAdaptiveLimiter, replaces fixed semaphore if provided
+        self.limiter = limiter
+        if limiter is not None:
+            connections = max(connections, limiter.max_limit)
+        self.window = window or connections * self.window_multiplier
+        # the largest number of urls scheduled at once
+        self.max_in_flight = 0
+        self.connector_config = {
+            'limit': connections,
+            'limit_per_host': limit_per_host,
+            'ttl_dns_cache': ttl_dns_cache,
+            'keepalive_timeout': keepalive_timeout,
+        }
+        self.session = None
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(fetcher={}(), saver={}(), connections={!r}, window={!r})'.format(
+            self.get_class_name(), self.fetcher.get_class_name(), self.saver.get_class_name(),
+            self.connector_config['limit'], self.window
+        )
 
-    async def handle_fetched_url(self, futures):
+    def create_session(self):
+        """
+        Creates session shared by all urls of load call
+        :return: aiohttp.ClientSession
         """
-        Propagates fetched url object to saver
+        connector = aiohttp.TCPConnector(**self.connector_config)
+        # urls check response status themselves after reading its headers
+        return aiohttp.ClientSession(connector=connector)
 
-        :param futures: futures with urls to fetch through semaphore
+    async def open_session(self):
+        # session should be created inside running loop
+        self.session = self.create_session()
+
+    async def close_session(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def handle_fetched_url(self, max_req_count=None):
         """
+        Schedules urls keeping window of them in flight and propagates fetched url objects to saver
+        Urls come from fetcher.iter_urls, so remaining pages and retries go before new urls
+        and count against max_req_count the same way as in other loaders.
 
-        for f in asyncio.as_completed(futures, loop=self.loop):
-            furl = await f
+        :param max_req_count: int number of requests, None for no limit
+        """
+        pending = set()
+        # new targets are not started when they would not be saved before deadline
+        urls = self.fetcher.iter_urls(max_req_count, allow=lambda: self.allow_url(len(pending)), block=False)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.window:
+                    if self.budget.holds(len(pending), self.get_concurrency()):
+                        # the next wave waits for duration of the first requests, loop is not blocked
+                        break
+                    try:
+                        url = next(urls)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    # no url is ready, retries are not due yet or urls in flight could add pages
+                    if url is None:
+                        break
+                    pending.add(asyncio.ensure_future(self.sem_fetch(url), loop=self.loop))
+                # pending urls are not taken after max_req_count is reached
+                delay = None if exhausted else self.fetcher.get_pending_delay()
+                if not pending:
+                    if delay is None:
+                        return
+                    await asyncio.sleep(delay)
+                    continue
+                self.max_in_flight = max(self.max_in_flight, len(pending))
+                done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                await self.handle_done(done)
+        finally:
+            urls.close()
+
+    async def handle_done(self, done):
+        """
+        Propagates fetched url objects of completed tasks to saver, retries and pages go to pending queue
+        :param done: iterable of completed tasks
+        """
+        for f in done:
+            furl = f.result()
+            if self.fetcher.reschedule(furl):
+                continue
             if furl.error:
                 self.error_count += 1
-            else:
-                self.saver.append(fetched_url=furl)
+            # background saver waits here if its writer is behind, plain saver writes in loop,
+            # failed url goes to saver too, it records failed task
+            await self.saver.async_append(fetched_url=furl)
             self.req_count += 1
 
-    async def sem_fetch(self, url):
+    async def limited_fetch(self, url):
         """
-        Fetch urls using Semaphore
+        Fetch url using limiter if it is provided, otherwise using Semaphore
 
         :param url: url instance
         :return: url instance with fetched_dicts populated
         """
+        # turn of target rate is awaited before connection slot is taken
+        await self.budget.async_pace()
+        if self.limiter is not None:
+            start = await self.limiter.acquire()
+            error = True
+            try:
+                furl = await self.timed_fetch_url(url)
+                error = furl.error or furl.deferred
+            finally:
+                await self.limiter.release(start, error=error)
+            return furl
+
         async with self.sem:
-            furl = await self.fetcher.async_fetch(url)
+            furl = await self.timed_fetch_url(url)
             return furl
 
-    def load(self, max_req_count=10):
+    async def timed_fetch_url(self, url):
+        start = time.monotonic()
+        furl = await self.fetch_url(url)
+        self.budget.on_request(time.monotonic() - start)
+        return furl
+
+    async def fetch_url(self, url):
+        return await self.fetcher.async_fetch(url)
+
+    async def sem_fetch(self, url):
+        """
+        Fetch url, url deferred for retry is rescheduled by caller and waits in pending queue of fetcher
+        without holding semaphore, so fresh urls are fetched meanwhile
+
+        :param url: url instance
+        :return: url instance with fetched_dicts populated
+        """
+        url.session = self.session
+        # backpressure of saver, requests are not issued while its writer is behind
+        await self.saver.async_wait()
+        return await self.limited_fetch(url)
+
+    def get_concurrency(self):
+        return self.connector_config['limit'] if self.limiter is None else self.limiter.get_limit()
+
+    def load(self, max_req_count=10, deadline=None, rate=None):
         """
         Orchestrates loading process
-        :param max_req_count: int number of requests that should be emmited
+        :param max_req_count: int number of requests that should be emmited, None for no limit
+        :param deadline: float seconds load could take, scheduled urls are taken into account
+        :param rate: float target requests per second
         """
         self.log('Start data loading')
         self.log_configuration()
-        futures = []
-        urls = islice(self.fetcher.get_urls(), max_req_count)
-        for url in urls:
-            future = asyncio.ensure_future(self.sem_fetch(url))
-            futures.append(future)
-        self.loop.run_until_complete(self.handle_fetched_url(futures))
+        self.start_budget(deadline, rate)
+        self.loop.run_until_complete(self.open_session())
+        try:
+            self.loop.run_until_complete(self.handle_fetched_url(max_req_count))
+        finally:
+            self.loop.run_until_complete(self.close_session())
 
         # final db update
         self.saver.update_db()
 
-        self.log('Requests issued {}. Errors {}'.format(self.req_count, self.error_count))
+        self.log('Requests issued {}. Errors {}. Max in flight {}'.format(
+            self.req_count, self.error_count, self.max_in_flight))
+        self.log_limiter_stats()
+        self.log_budget()
         self.log('Finish data loading')
+
+
+# fetcher and projection of parser process, set by init_parser
+_parser = None
+
+
+def init_parser(fetcher, model):
+    """
+    Initializer of parser process
+    :param fetcher: fetcher instance which parse_body is used
+    :param model: save class of saver
+    """
+    global _parser
+    _parser = fetcher, ColumnProjection.for_model(model)
+
+
+def parse_bodies(items):
+    """
+    Parses chunk of response bodies in parser process
+
+    :param items: list of tuples of url string and body
+    :return: list of tuples of rows, number of pages, dict of unknown keys and their counts,
+        and exception if body could not be parsed
+    """
+    fetcher, projection = _parser
+    results = []
+    for url_string, body in items:
+        projection.unknown_keys = {}
+        try:
+            rows, pages = fetcher.parse_body(url_string, body, projection)
+        except Exception as e:
+            results.append(([], None, {}, e))
+        else:
+            results.append((rows, pages, projection.unknown_keys, None))
+    return results
+
+
+class HybridLoader(AsyncLoader):
+    """
+    Fetches response bodies in asyncio and parses them in process pool
+
+    Loop only reads bytes and appends ready rows to saver, json decoding, extraction of objects
+    and building of rows run in parser processes, so big payloads do not delay other requests of loop.
+    Bodies are sent to pool in chunks to save on inter-process calls.
+    Saver should be in raw mode, BackgroundSaver keeps db writes out of loop too.
+    Hedging and streaming of fetcher are not used.
+
+    processes: number of parser processes, number of cpus if None
+    chunk_size: max number of bodies sent to parser process in one call
+    chunk_delay: seconds body waits for others to fill chunk before chunk is sent anyway
+    """
+
+    def __init__(self, fetcher, saver, processes=None, chunk_size=4, chunk_delay=0.005, **kwargs):
+        super().__init__(fetcher, saver, **kwargs)
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        # background saver builds rows with its wrapped saver
+        self.save_class = getattr(saver, 'saver', saver).save_class
+        self.pool = None
+        # list of tuples of url and future of its parse result waiting to be sent to pool
+        self.chunk = []
+        self.chunk_handle = None
+        self.chunk_count = 0
+        self.parse_error_count = 0
+        self.pool_restarts = 0
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(fetcher={}(), saver={}(), connections={!r}, processes={!r}, chunk_size={!r})'.format(
+            self.get_class_name(), self.fetcher.get_class_name(), self.saver.get_class_name(),
+            self.connector_config['limit'], self.processes, self.chunk_size
+        )
+
+    async def fetch_url(self, url):
+        return await self.fetcher.async_fetch_body(url)
+
+    def send_chunk(self):
+        """
+        Sends waiting bodies to pool and resolves their futures when chunk is parsed
+        """
+        if self.chunk_handle is not None:
+            self.chunk_handle.cancel()
+            self.chunk_handle = None
+        chunk, self.chunk = self.chunk, []
+        if not chunk:
+            return
+        self.chunk_count += 1
+        items = [(url.url_string, url.body) for url, _ in chunk]
+        pool = self.pool
+        try:
+            pool_future = self.loop.run_in_executor(pool, parse_bodies, items)
+        except BrokenProcessPool:
+            # pool broke before its failed chunk was resolved
+            pool = self.restart_pool(pool)
+            pool_future = self.loop.run_in_executor(pool, parse_bodies, items)
+
+        def resolve(done):
+            # failure of pool, e.g. killed parser process, fails urls of chunk
+            if done.exception() is not None:
+                if isinstance(done.exception(), BrokenProcessPool):
+                    self.restart_pool(pool)
+                results = [([], None, {}, done.exception())] * len(chunk)
+            else:
+                results = done.result()
+            for (_, future), result in zip(chunk, results):
+                future.set_result(result)
+
+        pool_future.add_done_callback(resolve)
+
+    def restart_pool(self, pool):
+        """
+        Replaces broken pool, so chunks sent later are parsed, chunks of broken pool fail
+        :param pool: broken pool, it is replaced only once
+        :return: pool chunks should be sent to
+        """
+        if self.pool is pool:
+            self.pool_restarts += 1
+            self.log('Parser pool is broken, start new one', level=logging.ERROR)
+            self.pool = self.create_pool()
+            pool.shutdown(wait=False)
+        return self.pool
+
+    async def parse(self, url):
+        """
+        Parses body of url in pool and stores rows to url
+        :param url: url instance with body
+        """
+        future = self.loop.create_future()
+        self.chunk.append((url, future))
+        if len(self.chunk) >= self.chunk_size:
+            self.send_chunk()
+        elif self.chunk_handle is None:
+            self.chunk_handle = self.loop.call_later(self.chunk_delay, self.send_chunk)
+        rows, pages, unknown_keys, error = await future
+        url.body = None
+        if error is not None:
+            self.parse_error_count += 1
+            try:
+                raise error
+            except Exception:
+                self.fetcher.process_parse_error(url, exc_info=sys.exc_info())
+            return
+        self.fetcher.process_parsed(url, rows, pages)
+        projection = ColumnProjection.for_model(self.save_class)
+        for key, count in unknown_keys.items():
+            projection.unknown_keys[key] = projection.unknown_keys.get(key, 0) + count
+
+    async def sem_fetch(self, url):
+        """
+        Fetches body of url and parses it out of connection slot, so parsing does not hold other requests
+        """
+        furl = await super().sem_fetch(url)
+        if furl.body is not None:
+            await self.parse(furl)
+        return furl
+
+    def create_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.processes, initializer=init_parser, initargs=(self.fetcher, self.save_class)
+        )
+
+    def load(self, max_req_count=10, deadline=None, rate=None):
+        self.pool = self.create_pool()
+        try:
+            super().load(max_req_count=max_req_count, deadline=deadline, rate=rate)
+        finally:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        self.log('Parsed chunks {}, parse errors {}, pool restarts {}'.format(
+            self.chunk_count, self.parse_error_count, self.pool_restarts))
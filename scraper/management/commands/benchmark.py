@@ -0,0 +1,713 @@
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections, transaction
+from django.test.utils import override_settings
+
+from scraper.costs import CostTracker, INTERLEAVE, LONGEST_FIRST
+from scraper.db import BulkLoadProfile, mark_rows, set_journal_mode
+from scraper.fetchers import API_URL, CourseFetcher, DepartmentFetcher, PaginatedFetcher, ProfessorFetcher
+from scraper.loaders import AsyncLoader, HybridLoader, ThreadedLoader
+from scraper.models import Course, Department, Professor, School
+from scraper.pipeline import Pipeline, PipelineStage
+from scraper.savers import BackgroundSaver, CourseSaver, DepartmentSaver, FlushPolicy, ProfessorSaver, SchoolSaver
+from scraper.supervisor import Supervisor
+from scraper.utils import AsyncUrl, Url, get_decoder, get_decoder_names
+
+
+def make_course(i):
+    """
+    :param i: int id of course
+    :return: dict shaped as course object of api
+    """
+    return {
+        'UID': i,
+        'abbreviation': 'CSCE',
+        'average_class_size': 35,
+        'common_course_id': None,
+        'course_id': i,
+        'course_name': 'Programming Languages {}'.format(i),
+        'course_number': str(300 + i % 200),
+        'course_seo_url': '/TAMU-Texas-A-and-M-University/CSCE-{}/course/{}/'.format(300 + i % 200, i),
+        'course_seo_title': None,
+        'course_seo_description': 'Design and implementation of programming languages, part {}'.format(i),
+        'credit_hours': 3,
+        'datasource_code': 'EXP',
+        'datasource_id': 1,
+        'datasource_user_id': 15,
+        'department_id': 24542 + i % 500,
+        'dept_abbreviation': 'CSCE',
+        'dept_category_code': 'ENG',
+        'parent_dept_category_code': None,
+        'dept_name': 'Computer Science and Engineering',
+        'description': 'Study of programming language paradigms, semantics and implementation. ' * 3,
+        'grade_count': i % 50,
+        'import_id': None,
+        'overall_gpa': 3.1,
+        'quality_check': True,
+        'recommendation_count': i % 7,
+        'school_abbrev': 'TAMU',
+        'school_bucket': '1',
+        'school_id': 206,
+        'school_name': 'Texas A&M University',
+        'modified': '2017-07-20 10:00:00',
+    }
+
+
+def make_course_payload(count):
+    """
+    :param count: int number of courses
+    :return: bytes of course endpoint response
+    """
+    data = {
+        'status': 200,
+        'message': 'OK',
+        'result': {'Course': {str(i): make_course(i) for i in range(count)}},
+    }
+    return json.dumps(data).encode('utf-8')
+
+
+def measure(func):
+    """
+    :param func: callable without arguments
+    :return: tuple of seconds and peak of allocated memory in bytes
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_stream(options):
+    """
+    Peak memory of whole document decoding compared to streaming extraction
+    """
+    body = make_course_payload(options['objects'])
+    fetcher = CourseFetcher()
+    chunk_size = Url.chunk_size
+
+    def whole():
+        url = Url('bench')
+        url.append_fetched_dicts(fetcher.get_objects_from_url(json.loads(body.decode('utf-8'))))
+
+    def stream():
+        url = Url('bench')
+        extractor = fetcher.get_extractor()
+        for i in range(0, len(body), chunk_size):
+            fetcher.append_streamed(url, extractor.feed(body[i:i + chunk_size]))
+        fetcher.append_streamed(url, extractor.close())
+
+    yield 'payload {:.1f} MB, {} courses'.format(len(body) / 2 ** 20, options['objects'])
+    for name, func in (('whole document', whole), ('streaming', stream)):
+        elapsed, peak = measure(func)
+        yield '{:<16} {:8.3f} s  peak {:8.1f} MB'.format(name, elapsed, peak / 2 ** 20)
+
+
+def best_time(func, repeat):
+    """
+    :param func: callable without arguments
+    :param repeat: int number of runs
+    :return: float seconds of the fastest run
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_decode(options):
+    """
+    Decoding speed of json backends on course payload, compared to str decoding done by Response.json()
+    """
+    body = make_course_payload(options['objects'])
+    size = len(body) / 2 ** 20
+    cases = [('json from str', lambda: json.loads(body.decode('utf-8')))]
+    for name in get_decoder_names():
+        cases.append(('{} from bytes'.format(name), lambda loads=get_decoder(name).loads: loads(body)))
+
+    yield 'payload {:.1f} MB, {} courses, best of {}'.format(size, options['objects'], options['repeat'])
+    baseline = None
+    for name, func in cases:
+        elapsed = best_time(func, options['repeat'])
+        baseline = baseline or elapsed
+        yield '{:<18} {:8.3f} s  {:8.1f} MB/s  x{:.2f}'.format(name, elapsed, size / elapsed, baseline / elapsed)
+
+
+@contextmanager
+def temporary_database():
+    """
+    Points default connection to new sqlite file with migrated schema, so benchmarks do not touch real data
+    Child processes get the same file through SCRAPER_DATABASE variable.
+    """
+    settings_dict = connections.databases['default']
+    if settings_dict['ENGINE'] != 'django.db.backends.sqlite3':
+        raise CommandError('Benchmark needs sqlite database')
+    old_name = settings_dict['NAME']
+    old_variable = os.environ.get('SCRAPER_DATABASE')
+    directory = tempfile.mkdtemp()
+    connections['default'].close()
+    # connection keeps reference to the same settings dict
+    settings_dict['NAME'] = os.environ['SCRAPER_DATABASE'] = os.path.join(directory, 'benchmark.sqlite3')
+    try:
+        call_command('migrate', verbosity=0)
+        yield
+    finally:
+        connections['default'].close()
+        settings_dict['NAME'] = old_name
+        if old_variable is None:
+            del os.environ['SCRAPER_DATABASE']
+        else:
+            os.environ['SCRAPER_DATABASE'] = old_variable
+        shutil.rmtree(directory)
+
+
+def make_course_urls(count, per_url=100):
+    """
+    :return: list of urls with fetched course dicts
+    """
+    urls = []
+    for start in range(0, count, per_url):
+        url = Url('bench')
+        for i in range(start, min(count, start + per_url)):
+            url.append_fetched_dict(make_course(i))
+        urls.append(url)
+    return urls
+
+
+class TimedCourseSaver(CourseSaver):
+    """
+    Course saver that sums time spent in db writes
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_time = 0
+
+    def write_batch(self, save_list, success_ids, failed_tasks=()):
+        start = time.perf_counter()
+        super().write_batch(save_list, success_ids, failed_tasks)
+        self.write_time += time.perf_counter() - start
+
+
+def bench_bulkload(options):
+    """
+    Course saving with default database settings compared to bulk load profile
+    """
+    count = options['objects']
+    batch = options['batch']
+
+    def load(profile=None):
+        urls = make_course_urls(count)
+        with temporary_database():
+            saver = TimedCourseSaver(flush_policy=FlushPolicy(max_rows=batch), upsert=options['upsert'])
+            start = time.perf_counter()
+            if profile is not None:
+                profile.begin()
+            for url in urls:
+                saver.append(fetched_url=url)
+            saver.update_db()
+            finish_start = time.perf_counter()
+            if profile is not None:
+                profile.finish()
+            saver.write_time += time.perf_counter() - finish_start
+            elapsed = time.perf_counter() - start
+            assert Course.objects.count() == count
+        return elapsed, saver.write_time
+
+    yield '{} courses, {} rows per commit, upsert {}'.format(count, batch, options['upsert'])
+    baseline = None
+    for name, profile in (
+            ('default', None),
+            ('bulk load', BulkLoadProfile([Course])),
+            ('bulk load, drop indexes', BulkLoadProfile([Course], drop_indexes=True))):
+        elapsed, write_time = load(profile)
+        baseline = baseline or write_time
+        yield '{:<24} total {:7.3f} s  db writes {:7.3f} s  {:9.0f} rows/s  x{:.2f}'.format(
+            name, elapsed, write_time, count / write_time, baseline / write_time)
+
+
+def bench_rawsave(options):
+    """
+    Course saving through orm compared to raw saver with column projection and executemany
+    """
+    count = options['objects']
+    batch = options['batch']
+
+    def load(raw):
+        urls = make_course_urls(count)
+        with temporary_database():
+            saver = TimedCourseSaver(flush_policy=FlushPolicy(max_rows=batch), upsert=options['upsert'], raw=raw)
+            start = time.perf_counter()
+            for url in urls:
+                saver.append(fetched_url=url)
+            saver.update_db()
+            elapsed = time.perf_counter() - start
+            assert Course.objects.count() == count
+        return elapsed, saver.write_time
+
+    yield '{} courses, {} rows per commit, upsert {}'.format(count, batch, options['upsert'])
+    baseline = None
+    for name, raw in (('orm', False), ('raw', True)):
+        elapsed, write_time = load(raw)
+        baseline = baseline or elapsed
+        yield '{:<6} total {:7.3f} s  db writes {:7.3f} s  {:9.0f} rows/s  x{:.2f}'.format(
+            name, elapsed, write_time, count / elapsed, baseline / elapsed)
+
+
+def bench_marking(options):
+    """
+    Marking of processed departments with IN statement compared to set based update joined with key table
+    """
+    sizes = (10, 100, 1000, 10000, 100000)
+
+    def in_statement(keys):
+        Department.objects.filter(department_id__in=keys).update(course_scraped=True)
+
+    def key_table(keys):
+        mark_rows(Department, 'department_id', keys, {'course_scraped': True})
+
+    yield '{} departments, best of {}, time per flush and per key'.format(max(sizes), options['repeat'])
+    with temporary_database():
+        Department.objects.bulk_create([Department(UID=i, school_id=1, department_id=i) for i in range(max(sizes))])
+        for size in sizes:
+            keys = list(range(0, max(sizes), max(sizes) // size))
+            line = '{:>7} keys'.format(size)
+            for name, func in (('in', in_statement), ('key table', key_table)):
+                try:
+                    with transaction.atomic():
+                        elapsed = best_time(lambda: func(keys), options['repeat'])
+                except DatabaseError as e:
+                    line += '  {} fails: {}'.format(name, e)
+                    continue
+                line += '  {} {:8.2f} ms {:6.2f} us/key'.format(name, elapsed * 1000, elapsed / size * 10 ** 6)
+            yield line
+
+
+class SimulatedUrl(Url):
+    """
+    Url answered by synthetic api after fixed latency
+
+    Api has school pages, every school has departments and every department has courses and professors.
+    """
+    latency = 0.02
+    school_pages = 2
+    schools_per_page = 10
+    departments_per_school = 5
+    objects_per_department = 3
+
+    def get_response(self):
+        time.sleep(self.latency)
+        school_page = re.search(r'/school/\?page=(\d+)', self.url_string)
+        if school_page:
+            start = (int(school_page.group(1)) - 1) * self.schools_per_page
+            schools = {i: {'UID': i, 'school_id': i} for i in range(start + 1, start + self.schools_per_page + 1)}
+            return {'result': {'School': schools}, 'pagination': {'pages': self.school_pages}}
+        school_id = re.search(r'/school/(\d+)/department/', self.url_string)
+        if school_id:
+            school_id = int(school_id.group(1))
+            ids = range(school_id * 100, school_id * 100 + self.departments_per_school)
+            return {'result': {'Department': {i: {'UID': i, 'school_id': school_id, 'department_id': i} for i in ids}}}
+        department_id, kind = re.search(r'/department/(\d+)/(course|professor)/', self.url_string).groups()
+        department_id = int(department_id)
+        objs = {}
+        for i in range(department_id * 10, department_id * 10 + self.objects_per_department):
+            obj = {'UID': i, 'school_id': department_id // 100, 'department_id': department_id}
+            if kind == 'course':
+                obj['course_id'] = i
+            else:
+                obj.update(professor_id=i, grade_count=0)
+            objs[i] = obj
+        return {'result': {kind.capitalize(): objs}}
+
+
+def bench_pipeline(options):
+    """
+    Stages loaded one after another by threaded loaders compared to one pipeline of all stages
+    """
+    concurrent = options['concurrent']
+    SimulatedUrl.latency = options['latency'] / 1000
+
+    def make_stages():
+        fetchers = [
+            PaginatedFetcher(url_class=SimulatedUrl), DepartmentFetcher(url_class=SimulatedUrl),
+            CourseFetcher(url_class=SimulatedUrl), ProfessorFetcher(url_class=SimulatedUrl),
+        ]
+        savers = [SchoolSaver(save_count=10), DepartmentSaver(save_count=10), CourseSaver(save_count=10),
+                  ProfessorSaver(save_count=10)]
+        return list(zip(fetchers, savers))
+
+    def sequential():
+        for fetcher, saver in make_stages():
+            ThreadedLoader(fetcher=fetcher, saver=saver, concurrent=concurrent).load(max_req_count=10 ** 9)
+
+    def pipeline():
+        stages = [PipelineStage(fetcher.stage or 'school', fetcher, saver) for fetcher, saver in make_stages()]
+        stages[0].children = [stages[1]]
+        stages[1].children = stages[2:]
+        runner = Pipeline(stages[:1], concurrent=concurrent)
+        runner.load()
+        return runner
+
+    yield '{} workers, {:.0f} ms latency'.format(concurrent, options['latency'])
+    baseline = None
+    for name, func in (('sequential', sequential), ('pipeline', pipeline)):
+        with temporary_database():
+            start = time.perf_counter()
+            runner = func()
+            elapsed = time.perf_counter() - start
+            counts = [model.objects.count() for model in (School, Department, Course, Professor)]
+        baseline = baseline or elapsed
+        yield '{:<12} {:7.3f} s  x{:.2f}  schools/departments/courses/professors {}'.format(
+            name, elapsed, baseline / elapsed, '/'.join(map(str, counts)))
+        if runner is not None:
+            for stage in runner.stages:
+                yield '  {:<10} {}'.format(stage.name, stage.get_stats())
+
+
+class SimulatedAsyncUrl(AsyncUrl):
+    """
+    Course url of department answered by synthetic api after fixed latency, without network
+    """
+    latency = 0.02
+
+    async def request(self, session):
+        await asyncio.sleep(self.latency)
+        department_id = int(re.search(r'/department/(\d+)/course/', self.url_string).group(1))
+        return {'result': {'Course': {
+            i: {'UID': i, 'school_id': 1, 'department_id': department_id, 'course_id': i}
+            for i in range(department_id * 10, department_id * 10 + 3)
+        }}}
+
+
+class RangeCourseFetcher(CourseFetcher):
+    """
+    Fetcher of courses of given number of departments, which are not in db
+    """
+    count = 0
+
+    def get_target_ids(self):
+        return range(self.count)
+
+
+def bench_window(options):
+    """
+    Peak memory of async loader with bounded window of urls compared to all urls scheduled at once
+    """
+    SimulatedAsyncUrl.latency = options['latency'] / 1000
+    connections = options['concurrent'] * 10
+    yield '{} connections, {:.0f} ms latency'.format(connections, options['latency'])
+    for count in (options['objects'] // 10, options['objects']):
+        RangeCourseFetcher.count = count
+        for name, window in (('window', None), ('unbounded', count)):
+            # debug query log would grow with number of batches
+            with temporary_database(), override_settings(DEBUG=False):
+                loader = AsyncLoader(
+                    fetcher=RangeCourseFetcher(url_class=SimulatedAsyncUrl), saver=CourseSaver(save_count=100),
+                    connections=connections, window=window
+                )
+                elapsed, peak = measure(lambda: loader.load(max_req_count=count))
+            yield '{:>6} urls  {:<10} {:7.3f} s  peak {:7.1f} MB  max in flight {}'.format(
+                count, name, elapsed, peak / 2 ** 20, loader.max_in_flight)
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    """
+    Local api that answers course urls of departments with prepared bodies after fixed latency
+    """
+    latency = 0.02
+    # path and encoded body
+    bodies = {}
+
+    def do_GET(self):
+        body = self.bodies.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def mock_api(departments, per_department, latency):
+    """
+    Runs MockApiHandler in thread of this process
+    :return: str api url to replace real one
+    """
+    MockApiHandler.latency = latency
+    MockApiHandler.bodies = {}
+    for department_id in departments:
+        courses = {}
+        for i in range(department_id * per_department, (department_id + 1) * per_department):
+            courses[str(i)] = dict(make_course(i), department_id=department_id)
+        path = '/adms/department/{}/course/'.format(department_id)
+        MockApiHandler.bodies[path] = json.dumps({'result': {'Course': courses}}).encode('utf-8')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield 'http://127.0.0.1:{}/adms'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_shards(options):
+    """
+    Courses loaded by scrape_data in 1, 2 and 4 worker processes, each worker takes its shard of departments
+    """
+    departments = range(1, max(options['objects'] // 100, 4) + 1)
+    yield '{} departments, 100 courses each, {} fetch workers per process, {:.0f} ms latency, {} cpus'.format(
+        len(departments), options['concurrent'], options['latency'], os.cpu_count())
+    with mock_api(departments, 100, options['latency'] / 1000) as api_url:
+        command = [
+            sys.executable, os.path.abspath(sys.argv[0]), 'scrape_data', '--api-url', api_url,
+            '--reqs', str(len(departments)), '--concurrent', str(options['concurrent']), '--raw-save',
+        ]
+        baseline = None
+        for workers in (1, 2, 4):
+            with temporary_database():
+                Department.objects.bulk_create(
+                    Department(UID=i, school_id=1, department_id=i) for i in departments
+                )
+                # workers write to the same file, wal lets them read while other one commits
+                set_journal_mode(connections['default'], 'wal')
+                connections['default'].close()
+                report = Supervisor(command, workers, poll_interval=0.05).run()
+                count = Course.objects.count()
+            elapsed = report['wall_seconds']
+            baseline = baseline or elapsed
+            yield '{} workers {:7.3f} s  x{:.2f}  {:8.0f} rows/s  courses {}  requests {}  errors {}  restarts {}'.format(
+                workers, elapsed, baseline / elapsed, report['rows'] / elapsed, count, report['requests'],
+                report['errors'], report['restarts'])
+
+
+class LoopMonitor(object):
+    """
+    Measures how late event loop wakes up sleeping coroutine, which is how long loop was blocked
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lags = []
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(loop.time() - start - self.interval)
+
+    def get_stats(self):
+        lags = sorted(self.lags) or [0]
+        return {
+            'p50': lags[len(lags) // 2] * 1000,
+            'p99': lags[int(len(lags) * 0.99)] * 1000,
+            'max': lags[-1] * 1000,
+        }
+
+
+def bench_loopstall(options):
+    """
+    Stalls of event loop when async loader parses big responses in loop compared to hybrid loader with parser processes
+    """
+    departments = range(1, 41)
+    per_department = max(options['objects'] // 20, 1)
+    yield '{} departments, {} courses each, {} connections, {:.0f} ms latency'.format(
+        len(departments), per_department, options['concurrent'], options['latency'])
+    with mock_api(departments, per_department, options['latency'] / 1000) as api_url:
+        loaders = (
+            ('async', lambda fetcher, saver: AsyncLoader(fetcher, saver, connections=options['concurrent'])),
+            ('hybrid', lambda fetcher, saver: HybridLoader(fetcher, saver, connections=options['concurrent'])),
+        )
+        for name, make_loader in loaders:
+            with temporary_database(), override_settings(DEBUG=False):
+                Department.objects.bulk_create(
+                    Department(UID=i, school_id=1, department_id=i) for i in departments
+                )
+                fetcher = CourseFetcher(url_class=AsyncUrl)
+                fetcher.url_template = fetcher.url_template.replace(API_URL, api_url)
+                # writer thread keeps db writes out of loop for both loaders
+                loader = make_loader(fetcher, BackgroundSaver(CourseSaver(save_count=5, raw=True)))
+                monitor = LoopMonitor()
+                task = asyncio.ensure_future(monitor.run(), loop=loader.loop)
+                start = time.perf_counter()
+                loader.load(max_req_count=len(departments))
+                elapsed = time.perf_counter() - start
+                task.cancel()
+                count = Course.objects.count()
+            yield '{:<7} {:7.3f} s  loop lag p50 {p50:6.1f} ms  p99 {p99:6.1f} ms  max {max:6.1f} ms  courses {}'.format(
+                name, elapsed, count, **monitor.get_stats())
+
+
+class SkewedUrl(Url):
+    """
+    Course url of department answered after latency of that department, few departments are much slower
+    """
+    # department id and seconds
+    latencies = {}
+
+    def get_response(self):
+        department_id = int(re.search(r'/department/(\d+)/course/', self.url_string).group(1))
+        time.sleep(self.latencies[department_id])
+        return {'result': {'Course': {department_id: {
+            'UID': department_id, 'school_id': 1, 'department_id': department_id, 'course_id': department_id,
+        }}}}
+
+
+def bench_makespan(options):
+    """
+    Run time of course loading with departments in id order compared to ordering by cost of previous run
+    """
+    departments = range(1, 101)
+    concurrent = options['concurrent']
+    base = options['latency'] / 1000
+    rng = random.Random(7)
+    SkewedUrl.latencies = {i: base * min(rng.paretovariate(1.1), 60) for i in departments}
+    total = sum(SkewedUrl.latencies.values())
+    bound = max(total / concurrent, max(SkewedUrl.latencies.values()))
+    yield '{} departments, {} workers, latency {:.0f} ms to {:.0f} ms, lower bound of run {:.3f} s'.format(
+        len(departments), concurrent, min(SkewedUrl.latencies.values()) * 1000,
+        max(SkewedUrl.latencies.values()) * 1000, bound)
+    with temporary_database():
+        Department.objects.bulk_create(Department(UID=i, school_id=1, department_id=i) for i in departments)
+        tracker = CostTracker(CourseFetcher.stage)
+        baseline = None
+        # the first run records costs for the next ones
+        for name in ('id order', LONGEST_FIRST, INTERLEAVE):
+            Course.objects.all().delete()
+            Department.objects.update(course_scraped=False)
+            schedule = None if name == 'id order' else name
+            fetcher = CourseFetcher(url_class=SkewedUrl, cost_tracker=tracker, schedule=schedule)
+            loader = ThreadedLoader(fetcher=fetcher, saver=CourseSaver(save_count=10), concurrent=concurrent)
+            start = time.perf_counter()
+            loader.load(max_req_count=len(departments))
+            elapsed = time.perf_counter() - start
+            tracker.save()
+            baseline = baseline or elapsed
+            yield '{:<10} {:7.3f} s  x{:.2f}  of lower bound x{:.2f}  courses {}'.format(
+                name, elapsed, baseline / elapsed, elapsed / bound, Course.objects.count())
+
+
+def bench_deadline(options):
+    """
+    Course loading stopped by deadline: finish time against deadline, requests and departments left
+    """
+    departments = range(1, 1001)
+    concurrent = options['concurrent']
+    base = options['latency'] / 1000
+    rng = random.Random(7)
+    SkewedUrl.latencies = {i: base * min(rng.paretovariate(1.5), 20) for i in departments}
+    full = sum(SkewedUrl.latencies.values()) / concurrent
+    yield '{} departments, {} workers, about {:.3f} s for all of them'.format(len(departments), concurrent, full)
+    with temporary_database():
+        Department.objects.bulk_create(Department(UID=i, school_id=1, department_id=i) for i in departments)
+        runs = [(full * share, None) for share in (0.25, 0.5)]
+        # pacing at half of rate workers reach alone
+        runs.append((full * 0.5, len(departments) / full / 2))
+        for deadline, rate in runs:
+            Course.objects.all().delete()
+            Department.objects.update(course_scraped=False)
+            fetcher = CourseFetcher(url_class=SkewedUrl)
+            loader = ThreadedLoader(fetcher=fetcher, saver=CourseSaver(save_count=10), concurrent=concurrent)
+            start = time.perf_counter()
+            loader.load(max_req_count=None, deadline=deadline, rate=rate)
+            elapsed = time.perf_counter() - start
+            yield 'deadline {:6.3f} s  rate {:>5}  finished {:6.3f} s ({:+6.1f} %)  requests {:>3}  backlog {:>3}'.format(
+                deadline, '-' if rate is None else '{:.0f}'.format(rate), elapsed,
+                (elapsed - deadline) / deadline * 100, loader.req_count, loader.backlog)
+
+
+class Command(BaseCommand):
+    help = 'Runs benchmarks of loading steps on synthetic api payloads'
+
+    cases = {
+        'stream': bench_stream,
+        'decode': bench_decode,
+        'bulkload': bench_bulkload,
+        'rawsave': bench_rawsave,
+        'marking': bench_marking,
+        'pipeline': bench_pipeline,
+        'shards': bench_shards,
+        'window': bench_window,
+        'loopstall': bench_loopstall,
+        'makespan': bench_makespan,
+        'deadline': bench_deadline,
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'case',
+            nargs='*',
+            help='Names of benchmark cases, all cases are run if not provided. Choices: {}'.format(
+                ', '.join(sorted(self.cases))),
+        )
+        parser.add_argument(
+            '--objects',
+            type=int,
+            default=20000,
+            help='Set number of objects in synthetic payload',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Set number of runs of timed cases, the fastest run is reported',
+        )
+        parser.add_argument(
+            '--batch',
+            type=int,
+            default=100,
+            help='Set number of rows saved in one transaction by saving cases',
+        )
+        parser.add_argument(
+            '--concurrent',
+            type=int,
+            default=10,
+            help='Set number of fetch workers in loading cases',
+        )
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=20,
+            help='Set milliseconds simulated api takes to answer in loading cases',
+        )
+        parser.add_argument(
+            '--upsert',
+            action='store_true',
+            help='Use upsert mode of saver in saving cases',
+        )
+
+    def handle(self, *args, **options):
+        names = options['case'] or sorted(self.cases)
+        for name in names:
+            if name not in self.cases:
+                raise CommandError('Unknown case {!r}'.format(name))
+        for name in names:
+            self.stdout.write('== {}: {}'.format(name, self.cases[name].__doc__.strip()))
+            for line in self.cases[name](options):
+                self.stdout.write(line)
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+
+from scraper.savers import SchoolSaver, DepartmentSaver, CourseSaver, ProfessorSaver
+
+
+class Command(BaseCommand):
+    """
+    Deletes repeated rows of every natural key, the latest saved row of key is kept
+
+    Tables filled before natural keys got unique indexes could have the same object saved several times,
+    migration 0002 stops on them. Run this command before it, with --dry-run to see what would be deleted.
+    """
+
+    help = 'Delete duplicate rows of natural keys of savers, keeping the latest saved row of every key'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report number of rows that would be deleted',
+        )
+
+    def handle(self, *args, **options):
+        for saver_class in (SchoolSaver, DepartmentSaver, CourseSaver, ProfessorSaver):
+            model, key = saver_class.save_class, saver_class.natural_key
+            duplicates = model.objects.values(*key).annotate(last_id=Max('id'), rows=Count('id')).filter(rows__gt=1)
+            deleted = 0
+            with transaction.atomic():
+                for duplicate in duplicates.iterator():
+                    rows = model.objects.filter(**{name: duplicate[name] for name in key}).exclude(
+                        id=duplicate['last_id']
+                    )
+                    if options['dry_run']:
+                        deleted += rows.count()
+                    else:
+                        deleted += rows.delete()[0]
+            self.stdout.write('{} {} duplicate rows of {}'.format(
+                'Found' if options['dry_run'] else 'Deleted', deleted, model.__name__
+            ))
@@ -1,11 +1,28 @@
+import json
 import logging
+import sys
+import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from scraper.loaders import ThreadedLoader, AsyncLoader, Loader
-from scraper.fetchers import DepartmentFetcher, CourseFetcher, ProfessorFetcher
-from scraper.savers import DepartmentSaver, CourseSaver, ProfessorSaver
-from scraper.utils import AsyncUrl
+from scraper.loaders import ThreadedLoader, AsyncLoader, Loader, ExecutorLoader
+from scraper.fetchers import API_URL, AbstractUrlFetcher, DepartmentFetcher, CourseFetcher, ProfessorFetcher, PaginatedFetcher
+from scraper.savers import SchoolSaver, DepartmentSaver, CourseSaver, ProfessorSaver, FlushPolicy, AdaptiveFlushPolicy, BackgroundSaver
+from scraper.models import Course
+from scraper.cache import ResponseCache
+from scraper.costs import CostTracker, SCHEDULES
+from scraper.db import BulkLoadProfile, get_connection, get_journal_mode, set_journal_mode
+from scraper.retry import RetryPolicy, CircuitBreaker
+from scraper.hedging import HedgePolicy
+from scraper.keyfilters import BloomFilter
+from scraper.tasks import TaskQueue
+from scraper.pipeline import Pipeline, PipelineStage
+from scraper.supervisor import Supervisor, parse_shard, strip_options
+from scraper.limiters import AdaptiveLimiter, AIMDLimit, RateLimiter
+from scraper.utils import AsyncCachedUrl, SessionPool, SessionUrl, CachedUrl, get_decoder, get_decoder_names
+
+# options of supervisor that are not passed to its workers
+SUPERVISOR_OPTIONS = ('--workers', '--max-restarts', '--shard', '--report')
 
 
 class Command(BaseCommand):
@@ -16,9 +33,244 @@ class Command(BaseCommand):
             type=int,
             help='Set maximum request for each loader that should be emitted',
         )
+        parser.add_argument(
+            '--concurrent',
+            type=int,
+            default=5,
+            help='Set number of fetch workers for threaded loader',
+        )
+        parser.add_argument(
+            '--save-workers',
+            type=int,
+            default=1,
+            help='Set number of save workers of threaded loader, each one writes its own batches, '
+                 'use more than one only with db that allows concurrent writes',
+        )
+        parser.add_argument(
+            '--max-concurrent',
+            type=int,
+            help='Adapt number of simultaneous requests between 1 and this value, starting from --concurrent',
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            help='Set max requests per second to api host, shared by all loaders',
+        )
+        parser.add_argument(
+            '--burst',
+            type=int,
+            default=10,
+            help='Set number of requests that could be sent at once above --rate',
+        )
+        parser.add_argument(
+            '--attempts',
+            type=int,
+            default=1,
+            help='Set max number of attempts for url, failed requests are retried with backoff',
+        )
+        parser.add_argument(
+            '--http-cache',
+            help='Path to response cache file, responses are revalidated with conditional requests on next runs',
+        )
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help='Parse response bodies while they are downloaded, response cache is not used in this mode',
+        )
+        parser.add_argument(
+            '--json-decoder',
+            choices=get_decoder_names(),
+            help='Set json decoder of response bodies, the fastest installed one is used by default',
+        )
+        parser.add_argument(
+            '--hedge-budget',
+            type=float,
+            help='Send duplicate of request slower than p95 of its endpoint, at most this ratio of extra requests, '
+                 'e.g. 0.05. Request timeouts follow observed latency in this mode',
+        )
+        parser.add_argument(
+            '--flush-rows',
+            type=int,
+            help='Save fetched objects when this number of rows is buffered, instead of every 100 urls',
+        )
+        parser.add_argument(
+            '--flush-mb',
+            type=float,
+            help='Save fetched objects when their estimated size reaches this number of megabytes',
+        )
+        parser.add_argument(
+            '--flush-interval',
+            type=float,
+            help='Save fetched objects at least once per this number of seconds',
+        )
+        parser.add_argument(
+            '--adaptive-flush',
+            action='store_true',
+            help='Tune number of rows in batch from db write time per row, --flush-rows is initial batch size',
+        )
+        parser.add_argument(
+            '--background-save',
+            action='store_true',
+            help='Save batches in writer thread while next batch is fetched',
+        )
+        parser.add_argument(
+            '--upsert',
+            action='store_true',
+            help='Skip objects which natural key is already saved, so loading could be repeated without duplicates',
+        )
+        parser.add_argument(
+            '--update-existing',
+            action='store_true',
+            help='With --upsert update already saved objects instead of skipping them',
+        )
+        parser.add_argument(
+            '--bloom-capacity',
+            type=int,
+            help='With --upsert screen saved keys with bloom filter of this capacity instead of set of all keys',
+        )
+        parser.add_argument(
+            '--raw-save',
+            action='store_true',
+            help='Write rows with executemany without model instances, unknown keys of api objects are logged '
+                 'and skipped',
+        )
+        parser.add_argument(
+            '--task-queue',
+            action='store_true',
+            help='Claim departments from ScrapeTask table with leases, so several processes could load one backlog',
+        )
+        parser.add_argument(
+            '--lease',
+            type=int,
+            default=600,
+            help='With --task-queue set seconds claimed departments are reserved for this process',
+        )
+        parser.add_argument(
+            '--pipeline',
+            action='store_true',
+            help='Load schools, departments, courses and professors as one pipeline sharing --concurrent workers, '
+                 'courses and professors of saved departments are fetched right away',
+        )
+        parser.add_argument(
+            '--executor',
+            choices=sorted(ExecutorLoader.executor_classes),
+            help='Load courses with concurrent.futures executor of --concurrent workers, process backend decodes '
+                 'responses out of the GIL and could not be used with --rate, --attempts, --hedge-budget '
+                 'and --http-cache',
+        )
+        parser.add_argument(
+            '--bulk-load',
+            action='store_true',
+            help='Trade durability of last commits on power loss for write speed: sqlite WAL, synchronous=NORMAL, '
+                 'bigger page cache and mmap. Tables are analyzed after loading',
+        )
+        parser.add_argument(
+            '--drop-indexes',
+            action='store_true',
+            help='With --bulk-load drop indexes that are not unique before loading and rebuild them after it',
+        )
+        parser.add_argument(
+            '--schedule',
+            choices=SCHEDULES,
+            help='Order departments by cost recorded in earlier runs: longest first, or alternating the longest '
+                 'and the shortest ones, so large departments do not start at the end of run. '
+                 'Not used with --task-queue',
+        )
+        parser.add_argument(
+            '--shard',
+            type=parse_shard,
+            help='Load only departments which id %% N == k, given as k/N, so N processes could split the backlog',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Run this number of worker processes with --shard of their own and the rest of options, '
+                 'restart crashed ones and report their merged counters. Workers parse in parallel, '
+                 'but sqlite takes one commit at a time, so writes of workers wait for each other',
+        )
+        parser.add_argument(
+            '--max-restarts',
+            type=int,
+            default=3,
+            help='With --workers set number of restarts of one crashed worker',
+        )
+        parser.add_argument(
+            '--report',
+            help='Write json with counters of requests, errors and saved rows to this path at the end',
+        )
+        parser.add_argument(
+            '--api-url',
+            help='Replace {} in urls of fetchers, e.g. with address of local mock api'.format(API_URL),
+        )
+        parser.add_argument(
+            '--deadline',
+            type=float,
+            help='Stop taking new departments when they would not be saved within this number of seconds, '
+                 'pages and retries of started ones are finished and number of departments left is reported. '
+                 'Without --reqs number of requests is not limited in this mode',
+        )
+        parser.add_argument(
+            '--target-rate',
+            type=float,
+            help='Spread requests of loader evenly at this number per second, unlike --rate without bursts',
+        )
+
+    def get_worker_command(self):
+        """
+        :return: list of str, command line of this process without supervisor options
+        """
+        if 'scrape_data' not in sys.argv:
+            raise CommandError('--workers could be used only from command line of manage.py scrape_data')
+        position = sys.argv.index('scrape_data') + 1
+        return [sys.executable] + sys.argv[:position] + strip_options(sys.argv[position:], SUPERVISOR_OPTIONS)
+
+    def supervise(self, options, logger):
+        if options['drop_indexes']:
+            raise CommandError('--drop-indexes could not be used with --workers, workers would rebuild indexes at once')
+        supervisor = Supervisor(
+            self.get_worker_command(), options['workers'], max_restarts=options['max_restarts'], logger=logger
+        )
+        connection = get_connection(Course)
+        journal_mode = None
+        if connection.vendor == 'sqlite':
+            # workers share one file, with wal they read while other one commits,
+            # commits still take turns and wait for each other up to timeout of database settings
+            journal_mode = get_journal_mode(connection)
+            set_journal_mode(connection, 'wal')
+            connection.close()
+        try:
+            report = supervisor.run()
+        finally:
+            if journal_mode is not None:
+                set_journal_mode(connection, journal_mode)
+        logger.info('Merged report of workers: {}'.format(report))
+        if options['report']:
+            self.write_report(options['report'], report)
+        if report['failed_shards']:
+            raise CommandError('Workers of shards {} failed'.format(report['failed_shards']))
+
+    @staticmethod
+    def write_report(path, report):
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file)
 
     def handle(self, *args, **options):
         logger = logging.getLogger('import')
+        if options['workers']:
+            return self.supervise(options, logger)
+        if options['shard'] and (options['task_queue'] or options['pipeline']):
+            raise CommandError('--shard could not be used with --task-queue or --pipeline')
+        if options['pipeline'] and (options['deadline'] or options['target_rate']):
+            raise CommandError('--deadline and --target-rate could not be used with --pipeline')
+        if options['pipeline'] and options['task_queue']:
+            raise CommandError('--task-queue could not be used with --pipeline')
+        if options['executor'] and (options['pipeline'] or options['max_concurrent'] or options['save_workers'] > 1):
+            raise CommandError('--executor could not be used with --pipeline, --max-concurrent or --save-workers')
+        if options['executor'] == 'process' and options['http_cache']:
+            raise CommandError('--http-cache could not be used with process executor, cache file is not shared')
+        if options['api_url']:
+            for fetcher_class in (PaginatedFetcher, DepartmentFetcher, CourseFetcher, ProfessorFetcher):
+                fetcher_class.url_template = fetcher_class.url_template.replace(API_URL, options['api_url'].rstrip('/'))
         # todo create saver for this loader with checking before saving if object is already in db
         # PaginatedExecutor(logger=logger, max_req_count=2000).execute()
         common_kwargs = {'logger': logger}
@@ -30,7 +282,128 @@ class Command(BaseCommand):
         # dep_loader.load(max_req_count=reqs)
         # course_loader.load(max_req_count=reqs)
         # prof_loader.load(max_req_count=reqs)
-        course_loader = ThreadedLoader(fetcher=CourseFetcher(), saver=CourseSaver(save_count=100), **common_kwargs)
-        # course_loader = AsyncLoader(fetcher=CourseFetcher(url_class=AsyncUrl), saver=CourseSaver(save_count=100), **common_kwargs)
-        reqs = 1000
-        course_loader.load(max_req_count=reqs)
+        concurrent = options['concurrent']
+        # every worker thread keeps one session, so pool for single api host needs only one connection
+        SessionUrl.session_pool = SessionPool(pool_connections=1, pool_maxsize=1)
+        if options['http_cache']:
+            CachedUrl.response_cache = AsyncCachedUrl.response_cache = ResponseCache(options['http_cache'])
+        if options['rate']:
+            AbstractUrlFetcher.rate_limiter = RateLimiter(
+                rate=options['rate'], burst=options['burst'], adapt_to_headers=True
+            )
+        if options['attempts'] > 1:
+            AbstractUrlFetcher.retry_policy = RetryPolicy(max_attempts=options['attempts'], breaker=CircuitBreaker())
+        if options['stream']:
+            AbstractUrlFetcher.stream = True
+        if options['hedge_budget']:
+            AbstractUrlFetcher.hedge_policy = HedgePolicy(
+                budget=options['hedge_budget'], max_workers=(options['max_concurrent'] or concurrent) * 2
+            )
+        limiter = None
+        if options['max_concurrent']:
+            limiter = AdaptiveLimiter(AIMDLimit(initial=concurrent, max_limit=options['max_concurrent']))
+        decoder = get_decoder(options['json_decoder'])
+        flush_policy = None
+        max_bytes = int(options['flush_mb'] * 2 ** 20) if options['flush_mb'] else None
+        if options['adaptive_flush']:
+            flush_policy = AdaptiveFlushPolicy(
+                initial_rows=options['flush_rows'] or 1000, max_bytes=max_bytes, max_interval=options['flush_interval']
+            )
+        elif options['flush_rows'] or max_bytes or options['flush_interval']:
+            flush_policy = FlushPolicy(
+                max_rows=options['flush_rows'], max_bytes=max_bytes, max_interval=options['flush_interval']
+            )
+        task_queue = None
+        if options['task_queue']:
+            task_queue = TaskQueue(CourseFetcher.stage, lease_seconds=options['lease'])
+        key_filter = BloomFilter(capacity=options['bloom_capacity']) if options['bloom_capacity'] else None
+        saver = CourseSaver(
+            save_count=100, flush_policy=flush_policy, upsert=options['upsert'],
+            update_existing=options['update_existing'], key_filter=key_filter, raw=options['raw_save'],
+            task_queue=task_queue
+        )
+        if options['background_save']:
+            saver = BackgroundSaver(saver)
+        cost_tracker = CostTracker(CourseFetcher.stage)
+        fetcher = CourseFetcher(
+            url_class=CachedUrl, decoder=decoder, task_queue=task_queue, shard=options['shard'],
+            cost_tracker=cost_tracker, schedule=options['schedule']
+        )
+        if task_queue is not None:
+            logger.info('Enqueued {} of departments'.format(fetcher.enqueue_tasks()))
+        if options['pipeline']:
+            course = PipelineStage('course', fetcher, saver)
+            professor = PipelineStage(
+                'professor', ProfessorFetcher(url_class=CachedUrl, decoder=decoder),
+                ProfessorSaver(save_count=100, upsert=options['upsert'], update_existing=options['update_existing'],
+                               raw=options['raw_save'])
+            )
+            # parents save often, so their children get urls soon
+            department = PipelineStage(
+                'department', DepartmentFetcher(url_class=CachedUrl, decoder=decoder),
+                DepartmentSaver(save_count=10, upsert=options['upsert']), children=[course, professor]
+            )
+            school = PipelineStage(
+                'school', PaginatedFetcher(url_class=CachedUrl, decoder=decoder),
+                SchoolSaver(save_count=1, upsert=options['upsert']), children=[department]
+            )
+            course_loader = Pipeline([school], concurrent=concurrent, limiter=limiter, **common_kwargs)
+        elif options['executor']:
+            try:
+                course_loader = ExecutorLoader(
+                    fetcher=fetcher, saver=saver, concurrent=concurrent, backend=options['executor'], **common_kwargs
+                )
+            except ValueError as e:
+                raise CommandError(e)
+        else:
+            course_loader = ThreadedLoader(
+                fetcher=fetcher, saver=saver, concurrent=concurrent, save_workers=options['save_workers'],
+                limiter=limiter, **common_kwargs
+            )
+        # course_loader = AsyncLoader(fetcher=CourseFetcher(url_class=AsyncCachedUrl), saver=CourseSaver(save_count=100), **common_kwargs)
+        reqs = options['reqs'] or (None if options['deadline'] else 1000)
+        profile = None
+        if options['bulk_load']:
+            profile = BulkLoadProfile([CourseSaver.save_class], drop_indexes=options['drop_indexes'], logger=logger)
+            profile.begin()
+        start = time.monotonic()
+        try:
+            if options['pipeline']:
+                course_loader.load(max_req_count=reqs)
+            else:
+                course_loader.load(max_req_count=reqs, deadline=options['deadline'], rate=options['target_rate'])
+        finally:
+            if profile is not None:
+                profile.finish()
+        seconds = time.monotonic() - start
+        logger.info('Saved costs of {} departments'.format(cost_tracker.save()))
+        if flush_policy is not None:
+            logger.info('Flush policy at the end: {!r}'.format(flush_policy))
+        if options['background_save']:
+            logger.info('Writer was behind {} times'.format(saver.stall_count))
+            saver = saver.saver
+        if options['report']:
+            savers = [saver]
+            if options['pipeline']:
+                savers.extend(stage.saver for stage in course_loader.stages if stage.fetcher is not fetcher)
+            self.write_report(options['report'], {
+                'shard': '{}/{}'.format(*options['shard']) if options['shard'] else None,
+                'requests': course_loader.req_count,
+                'errors': course_loader.error_count,
+                'rows': sum(s.row_count for s in savers),
+                'skipped': sum(s.skipped_count for s in savers),
+                'seconds': round(seconds, 3),
+                'backlog': getattr(course_loader, 'backlog', None),
+            })
+        if options['upsert']:
+            logger.info('Skipped {} of already saved objects'.format(saver.skipped_count))
+        if task_queue is not None:
+            logger.info('Tasks of {}: {}'.format(task_queue.stage, task_queue.get_stats()))
+        logger.info('Connection stats: {}'.format(SessionUrl.session_pool.get_stats()))
+        SessionUrl.session_pool.close()
+        if AbstractUrlFetcher.hedge_policy is not None:
+            logger.info('Hedge stats: {}'.format(AbstractUrlFetcher.hedge_policy.get_stats()))
+            AbstractUrlFetcher.hedge_policy.close()
+        if CachedUrl.response_cache is not None:
+            logger.info('Response cache stats: {}'.format(CachedUrl.response_cache.get_stats()))
+            CachedUrl.response_cache.close()
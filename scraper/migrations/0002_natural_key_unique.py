@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+# model name and fields of natural key that get unique index
+NATURAL_KEYS = (
+    ('School', ('school_id',)),
+    ('Department', ('department_id', 'school_id')),
+    ('Course', ('course_id', 'department_id')),
+    ('Professor', ('professor_id', 'department_id')),
+)
+
+
+def check_duplicates(apps, schema_editor):
+    """
+    Unique index could not be created over duplicate rows, they are reported instead of deleted
+    """
+    for model_name, key in NATURAL_KEYS:
+        model = apps.get_model('scraper', model_name)
+        if model.objects.values(*key).annotate(rows=Count('id')).filter(rows__gt=1).exists():
+            raise RuntimeError(
+                '{} has duplicate rows of {}, run "python manage.py remove_duplicates" '
+                'before migrating'.format(model_name, ', '.join(key))
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='school',
+            name='school_id',
+            field=models.PositiveIntegerField(unique=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='department',
+            unique_together={('department_id', 'school_id')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='course',
+            unique_together={('course_id', 'department_id')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='professor',
+            unique_together={('professor_id', 'department_id')},
+        ),
+    ]
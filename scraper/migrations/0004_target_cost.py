@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0003_scrape_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TargetCost',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=50)),
+                ('target_id', models.PositiveIntegerField()),
+                ('seconds', models.FloatField()),
+                ('pages', models.PositiveIntegerField(default=1)),
+                ('object_count', models.PositiveIntegerField(default=0)),
+                ('response_size', models.PositiveIntegerField(null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('stage', 'target_id')},
+            },
+        ),
+    ]
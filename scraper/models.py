@@ -23,6 +23,7 @@ class BaseSchoolModel(BaseScrapeModel):
 
 
 class School(BaseSchoolModel):
+    school_id = models.PositiveIntegerField(unique=True)
 
     # search field but could be null
     abbreviation = models.CharField(max_length=100, null=True)
@@ -73,6 +74,9 @@ class Department(BaseSchoolModel):
     course_scraped = models.BooleanField(default=False)
     professor_scraped = models.BooleanField(default=False)
 
+    class Meta:
+        unique_together = ['department_id', 'school_id']
+
 
 class Professor(BaseSchoolModel):
     department_abbreviation = models.CharField(max_length=100, null=True)
@@ -95,6 +99,9 @@ class Professor(BaseSchoolModel):
     user_id = models.PositiveIntegerField(null=True)
     withdraw_average = models.FloatField(null=True)
 
+    class Meta:
+        unique_together = ['professor_id', 'department_id']
+
 
 class Course(BaseSchoolModel):
     abbreviation = models.CharField(max_length=100, null=True)
@@ -124,3 +131,57 @@ class Course(BaseSchoolModel):
 
     class Meta:
         index_together = ['school_id', 'department_id', 'course_number']
+        unique_together = ['course_id', 'department_id']
+
+
+class ScrapeTask(models.Model):
+    """
+    Unit of work of loading stage, target is school or department which objects are fetched
+
+    Loaders claim pending tasks in batches and hold them with lease until objects are saved,
+    so several processes drain one backlog without fetching the same target twice.
+    Tasks of crashed loader are claimed again when their lease expires.
+    """
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (CLAIMED, 'Claimed'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    # stage name of fetcher, e.g. 'course'
+    stage = models.CharField(max_length=50)
+    # school_id or department_id used in url of stage
+    target_id = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    lease_owner = models.CharField(max_length=200, null=True)
+    lease_expires = models.DateTimeField(null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True)
+
+    class Meta:
+        unique_together = ['stage', 'target_id']
+        index_together = ['stage', 'status', 'lease_expires']
+
+
+class TargetCost(models.Model):
+    """
+    Cost of loading one target of stage measured in the last run that fetched it
+
+    Fetchers order targets by expected cost, so the largest ones do not start at the end of run.
+    """
+    stage = models.CharField(max_length=50)
+    target_id = models.PositiveIntegerField()
+    # seconds of the first request, number of pages, objects and bytes of the first page
+    seconds = models.FloatField()
+    pages = models.PositiveIntegerField(default=1)
+    object_count = models.PositiveIntegerField(default=0)
+    response_size = models.PositiveIntegerField(null=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['stage', 'target_id']
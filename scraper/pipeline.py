@@ -0,0 +1,399 @@
+"""
+Pipeline runs dependent loading stages as one DAG
+
+Objects saved by stage produce urls of its child stages right after their batch is written,
+so courses and professors of the first departments are fetched while departments of other schools are loaded.
+All stages share one pool of fetch workers, so concurrency budget goes to whatever work is ready.
+"""
+
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+from queue import Queue
+from threading import Thread
+
+from django.db import connections
+
+from scraper.loaders import AbstractLoader
+
+# item of save queue that asks save worker to flush all stages
+FLUSH = object()
+
+
+class PipelineStage(object):
+    """
+    Fetcher and saver of one stage with links to stages that depend on it
+
+    Child stage gets url for every object saved by this stage, target of url is value of
+    target_field of child fetcher in saved object.
+
+    name: str used in stats
+    fetcher: fetcher instance
+    saver: saver instance, stage with children needs saver that writes batches before append returns,
+        so children see committed objects, e.g. not BackgroundSaver
+    children: list of PipelineStage
+    seed: bool if True urls from fetcher.get_urls are processed too, e.g. targets left by previous runs
+    """
+
+    def __init__(self, name, fetcher, saver, children=(), seed=True):
+        self.name = name
+        self.fetcher = fetcher
+        self.saver = saver
+        self.children = list(children)
+        self.seed = seed
+        # distance from root, deeper stages are fetched first so finished targets leave memory sooner
+        self.depth = 0
+        # target ids received from parent stage while parent objects are not saved yet
+        self.backlog = []
+        # target ids which urls are submitted
+        self.seen = set()
+        self.req_count = 0
+        self.error_count = 0
+        self.object_count = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(name={!r}, fetcher={}(), saver={}(), children={!r})'.format(
+            self.__class__.__name__, self.name, self.fetcher.get_class_name(), self.saver.get_class_name(),
+            [child.name for child in self.children]
+        )
+
+    def collect(self, fetched_url):
+        """
+        Passes target ids from objects of fetched url to backlogs of children
+        """
+        for child in self.children:
+            field = child.fetcher.target_field
+            child.backlog.extend(obj[field] for obj in fetched_url.fetched_dicts if obj.get(field) is not None)
+
+    def get_stats(self):
+        seconds = self.finished_at - self.started_at if self.started_at is not None else 0
+        return {
+            'requests': self.req_count,
+            'errors': self.error_count,
+            'objects': self.object_count,
+            'seconds': round(seconds, 3),
+            'requests_per_second': round(self.req_count / seconds, 1) if seconds else None,
+        }
+
+
+class Pipeline(AbstractLoader):
+    """
+    Loads stages of DAG concurrently
+
+    Fetch workers take urls of all stages from one queue, urls of deeper stages first.
+    Retries wait in separate queue until their time comes.
+    Single save worker appends fetched urls to savers of their stages, when saver flushes,
+    target ids collected from written objects become urls of child stages.
+    When all work is done savers are flushed in order of stages, which could produce more work.
+
+    stages: root PipelineStage instances, their children are found by links
+    concurrent: number of fetch workers shared by all stages
+    limiter: AdaptiveLimiter instance, if provided number of workers is its ceiling
+        and number of simultaneous requests follows its limit
+    """
+    # multiplier for number of seed urls waiting in queue
+    concurrent_multiplier = 3
+
+    def __init__(self, stages, concurrent=10, limiter=None, logger=None):
+        super().__init__()
+        self.roots = list(stages)
+        self.stages = self.sort_stages(self.roots)
+        self.limiter = limiter
+        self.concurrent = concurrent if limiter is None else limiter.max_limit
+        self.set_logger(logger=logger)
+        for stage in self.stages:
+            stage.saver.set_logger(logger=logger)
+            stage.fetcher.set_logger(logger=logger)
+        # heap of (-depth, sequence number, stage, url) ready to fetch
+        self.work = []
+        # heap of (due time, sequence number, stage, url) deferred for retry
+        self.delayed = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self.sq = Queue()
+        # urls submitted and not handled by save worker yet
+        self.in_progress = 0
+        self.req_count = 0
+        self.error_count = 0
+        self.max_req_count = None
+        self.flush_released = 0
+        self.save_error = None
+        self.closed = False
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(stages={!r}, concurrent={!r})'.format(
+            self.get_class_name(), [stage.name for stage in self.stages], self.concurrent
+        )
+
+    @staticmethod
+    def sort_stages(roots):
+        """
+        :param roots: list of root stages
+        :return: list of all stages, every stage goes after its parents
+        """
+        depths = {}
+
+        def visit(stage, depth):
+            if depths.get(stage, -1) >= depth:
+                return
+            depths[stage] = stage.depth = depth
+            for child in stage.children:
+                visit(child, depth + 1)
+
+        for root in roots:
+            visit(root, 0)
+        return sorted(depths, key=lambda stage: stage.depth)
+
+    def submit(self, stage, url, delay=0, new=True):
+        """
+        Puts url to work queue
+        Request of url is reserved here, so every queued url is fetched and none is dropped at max_req_count.
+
+        :param stage: PipelineStage of url
+        :param url: Instance of url_class
+        :param delay: float seconds before url could be fetched
+        :param new: bool False for urls that are already counted as in progress, e.g. deferred retries
+        :return: bool False if url is not queued, because its target is queued already or max_req_count is reached
+        """
+        with self._condition:
+            # target could come from seed and from parent stage
+            if new and url.page is None and url.id_to_update is not None and url.id_to_update in stage.seen:
+                return False
+            if not self.reserve_request(stage):
+                return False
+            if new:
+                if url.page is None and url.id_to_update is not None:
+                    stage.seen.add(url.id_to_update)
+                self.in_progress += 1
+            if delay > 0:
+                heapq.heappush(self.delayed, (time.monotonic() + delay, next(self._counter), stage, url))
+            else:
+                heapq.heappush(self.work, (-stage.depth, next(self._counter), stage, url))
+            self._condition.notify_all()
+            return True
+
+    def take(self):
+        """
+        Waits for url which time has come
+        :return: tuple of stage and url, or None when pipeline is closed
+        """
+        with self._condition:
+            while not self.closed:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, counter, stage, url = heapq.heappop(self.delayed)
+                    heapq.heappush(self.work, (-stage.depth, counter, stage, url))
+                if self.work:
+                    _, _, stage, url = heapq.heappop(self.work)
+                    # feeder waits for place in queue
+                    self._condition.notify_all()
+                    return stage, url
+                self._condition.wait(self.delayed[0][0] - now if self.delayed else None)
+            return None
+
+    def finish_one(self):
+        with self._condition:
+            self.in_progress -= 1
+            self._condition.notify_all()
+
+    def wait_idle(self):
+        with self._condition:
+            while self.in_progress:
+                self._condition.wait()
+
+    def has_budget(self):
+        with self._condition:
+            return self.max_req_count is None or self.req_count < self.max_req_count
+
+    def reserve_request(self, stage):
+        """
+        :return: bool False if max_req_count is reached and url should not be queued
+        """
+        with self._condition:
+            if not self.has_budget():
+                return False
+            self.req_count += 1
+            stage.req_count += 1
+            return True
+
+    def fetch(self, url, stage):
+        """
+        Fetches url through limiter if it is provided
+        """
+        if self.limiter is None:
+            return stage.fetcher.fetch(url=url)
+        start = self.limiter.acquire()
+        error = True
+        try:
+            furl = stage.fetcher.fetch(url=url)
+            error = furl.error or furl.deferred
+        finally:
+            # slot is returned even if fetch raised, otherwise limit would shrink for good
+            self.limiter.release(start, error=error)
+        return furl
+
+    def fetch_worker(self):
+        while True:
+            item = self.take()
+            if item is None:
+                return
+            stage, url = item
+            with self._condition:
+                if stage.started_at is None:
+                    stage.started_at = time.monotonic()
+            try:
+                furl = self.fetch(url, stage)
+            except Exception as e:
+                # fetcher handles url errors itself, this is failure of fetcher, url goes to saver as failed
+                self.log('Pipeline fetch failure', level=logging.ERROR, exc_info=True)
+                url.handle_error(self.logger, *sys.exc_info())
+                url.failure = repr(e)
+                furl = url
+            # pages over max_req_count are not fetched, their target is not marked and is loaded again next run
+            for page_url in furl.page_urls:
+                self.submit(stage, page_url)
+            furl.page_urls = []
+            if furl.deferred:
+                if self.submit(stage, furl, delay=furl.retry_delay, new=False):
+                    continue
+                furl.retry_delay = None
+                furl.error = True
+                furl.failure = 'Max request count is reached before retry'
+            # failed url goes to saver too, it records failed task
+            self.sq.put((stage, furl))
+
+    def save_worker(self):
+        while True:
+            item = self.sq.get()
+            if item is None:
+                # save worker thread has its own db connection
+                connections.close_all()
+                return
+            try:
+                if item is FLUSH:
+                    self.flush()
+                else:
+                    self.save(*item)
+            except Exception as e:
+                self.log('Pipeline save failure', level=logging.ERROR, exc_info=True)
+                self.save_error = e
+            finally:
+                self.finish_one()
+
+    def save(self, stage, furl):
+        stage.saver.append(fetched_url=furl)
+        stage.finished_at = time.monotonic()
+        if furl.error:
+            with self._condition:
+                self.error_count += 1
+                stage.error_count += 1
+            return
+        stage.collect(furl)
+        stage.object_count += len(furl.fetched_dicts)
+        # buffer is empty after flush, so objects of collected targets are saved
+        if stage.children and not stage.saver.not_saved_count:
+            self.release(stage)
+
+    def release(self, stage):
+        """
+        Submits urls of targets collected by stage to its children
+        :return: int number of submitted urls
+        """
+        released = 0
+        for child in stage.children:
+            target_ids, child.backlog = child.backlog, []
+            for target_id in target_ids:
+                # targets over max_req_count are left for seed of next run
+                if self.submit(child, child.fetcher.make_target_url(target_id)):
+                    released += 1
+                elif not self.has_budget():
+                    break
+        return released
+
+    def flush(self):
+        """
+        Saves buffers of all stages, parents first, so their children get the rest of targets
+        """
+        self.flush_released = 0
+        for stage in self.stages:
+            stage.saver.update_db()
+            self.flush_released += self.release(stage)
+
+    def request_flush(self):
+        with self._condition:
+            self.in_progress += 1
+        self.sq.put(FLUSH)
+
+    def create_workers(self):
+        for i in range(self.concurrent):
+            Thread(target=self.fetch_worker, daemon=True).start()
+        Thread(target=self.save_worker, daemon=True).start()
+
+    def feed(self):
+        """
+        Submits urls of seeded stages keeping bounded number of them in queue
+        """
+        window = self.concurrent * self.concurrent_multiplier
+        for stage in self.stages:
+            if not stage.seed:
+                continue
+            urls = iter(stage.fetcher.get_urls())
+            try:
+                while True:
+                    with self._condition:
+                        while len(self.work) >= window:
+                            self._condition.wait()
+                    # url is not taken when it could not be queued, so its target stays for next run
+                    if not self.has_budget():
+                        return
+                    url = next(urls, None)
+                    if url is None:
+                        break
+                    self.submit(stage, url)
+            finally:
+                # claimed targets which were not taken are released by their generator
+                if hasattr(urls, 'close'):
+                    urls.close()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        self.sq.put(None)
+
+    def log_stats(self, seconds):
+        for stage in self.stages:
+            self.log('Stage {}: {}'.format(stage.name, stage.get_stats()))
+        self.log('Requests issued {}. Errors {}. Finished in {:.2f}s'.format(self.req_count, self.error_count, seconds))
+
+    def load(self, max_req_count=None):
+        """
+        Runs stages until there is no work left
+        :param max_req_count: int number of requests that should be emmited, None for no limit
+        """
+        self.log('Start data loading')
+        self.log('Pipeline: {}'.format(self))
+        for stage in self.stages:
+            self.log('Stage: {!r}'.format(stage))
+        self.max_req_count = max_req_count
+        start = time.monotonic()
+        self.create_workers()
+        try:
+            self.feed()
+            self.wait_idle()
+            while True:
+                self.request_flush()
+                self.wait_idle()
+                if not self.flush_released or self.save_error is not None:
+                    break
+        finally:
+            self.close()
+        if self.save_error is not None:
+            raise self.save_error
+        self.log_stats(time.monotonic() - start)
+        self.log('Finish data loading')
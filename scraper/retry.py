@@ -0,0 +1,187 @@
+"""
+Classes decide what to do with failed requests
+
+RetryPolicy classifies errors and calculates jittered exponential backoff,
+CircuitBreaker stops requests to host that keeps failing.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+
+from scraper.limiters import TOO_MANY_REQUESTS
+
+CONNECT_ERROR = 'connect'
+TIMEOUT_ERROR = 'timeout'
+SERVER_ERROR = '5xx'
+CLIENT_ERROR = '4xx'
+OTHER_ERROR = 'other'
+
+
+def classify_error(exc, status_code=None):
+    """
+    Maps exception raised by url.get_response to error kind
+
+    :param exc: exception instance
+    :param status_code: int status of response if it was received
+    :return: str one of *_ERROR constants
+    """
+    if isinstance(exc, (requests.ConnectTimeout, aiohttp.ClientConnectorError)):
+        return CONNECT_ERROR
+    if isinstance(exc, (requests.Timeout, asyncio.TimeoutError)):
+        return TIMEOUT_ERROR
+    if isinstance(exc, (requests.HTTPError, aiohttp.ClientResponseError)) and status_code is not None:
+        return SERVER_ERROR if status_code >= 500 else CLIENT_ERROR
+    if isinstance(exc, (requests.ConnectionError, aiohttp.ClientConnectionError)):
+        return CONNECT_ERROR
+    return OTHER_ERROR
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failures of every host
+
+    After failure_threshold failures host circuit opens and requests to it are not sent for reset_timeout seconds.
+    Then circuit becomes half open and single probe request is allowed, its success closes circuit,
+    its failure opens circuit again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # seconds other requests wait while probe request is in flight
+    probe_interval = 1.0
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(failure_threshold={!r}, reset_timeout={!r})'.format(
+            self.__class__.__name__, self.failure_threshold, self.reset_timeout
+        )
+
+    def get_host_state(self, url_string):
+        host = urlsplit(url_string).netloc
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = {'state': self.CLOSED, 'failures': 0, 'opened_at': 0, 'probing': False}
+        return state
+
+    def get_state(self, url_string):
+        with self._lock:
+            return self.get_host_state(url_string)['state']
+
+    def get_wait(self, url_string):
+        """
+        Checks if request to url_string could be sent now
+
+        :param url_string: str
+        :return: float seconds to wait before request, 0 if request is allowed
+        """
+        with self._lock:
+            state = self.get_host_state(url_string)
+            if state['state'] == self.CLOSED:
+                return 0
+            if state['state'] == self.OPEN:
+                wait = state['opened_at'] + self.reset_timeout - time.monotonic()
+                if wait > 0:
+                    return wait
+                state['state'] = self.HALF_OPEN
+                state['probing'] = False
+            if state['probing']:
+                return self.probe_interval
+            state['probing'] = True
+            return 0
+
+    def on_success(self, url_string):
+        with self._lock:
+            state = self.get_host_state(url_string)
+            state['state'] = self.CLOSED
+            state['failures'] = 0
+            state['probing'] = False
+
+    def on_failure(self, url_string):
+        with self._lock:
+            state = self.get_host_state(url_string)
+            state['failures'] += 1
+            if state['state'] == self.HALF_OPEN or state['failures'] >= self.failure_threshold:
+                state['state'] = self.OPEN
+                state['opened_at'] = time.monotonic()
+                state['probing'] = False
+
+
+class RetryPolicy(object):
+    """
+    Decides if failed url should be requested again and when
+
+    max_attempts: max number of requests for one url
+    base_delay, max_delay: bounds of exponential backoff in seconds, actual delay is random in [0, backoff]
+    retry_on: error kinds that are retried
+    retry_statuses: statuses of client errors that are retried anyway
+    breaker: CircuitBreaker instance or None
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=30,
+                 retry_on=(CONNECT_ERROR, TIMEOUT_ERROR, SERVER_ERROR), retry_statuses=(TOO_MANY_REQUESTS,),
+                 breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.retry_statuses = retry_statuses
+        self.breaker = breaker
+        self.retry_count = 0
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(max_attempts={!r}, base_delay={!r}, max_delay={!r}, breaker={!r})'.format(
+            self.__class__.__name__, self.max_attempts, self.base_delay, self.max_delay, self.breaker
+        )
+
+    def get_backoff(self, attempt):
+        """
+        :param attempt: int number of failed attempts
+        :return: float seconds to wait before next attempt
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def get_wait(self, url_string):
+        """
+        :return: float seconds before request to url_string is allowed by circuit breaker
+        """
+        if self.breaker is None:
+            return 0
+        return self.breaker.get_wait(url_string)
+
+    def on_success(self, url):
+        if self.breaker is not None:
+            self.breaker.on_success(url.url_string)
+
+    def on_failure(self, url, exc):
+        """
+        Registers failed attempt of url
+
+        :param url: url instance, url.attempts should include failed attempt
+        :param exc: exception raised by request
+        :return: float seconds to wait before retry or None if url should not be retried
+        """
+        kind = classify_error(exc, url.status_code)
+        if self.breaker is not None:
+            if kind == CLIENT_ERROR:
+                # client errors mean that host is alive, it also ends probe of half open circuit
+                self.breaker.on_success(url.url_string)
+            else:
+                self.breaker.on_failure(url.url_string)
+
+        retryable = kind in self.retry_on or url.status_code in self.retry_statuses
+        if not retryable or url.attempts >= self.max_attempts:
+            return None
+        self.retry_count += 1
+        return self.get_backoff(url.attempts)
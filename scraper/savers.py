@@ -6,14 +6,112 @@ All necessary logic is in AbstractSaver class
 Classes SchoolSaver, DepartmentSaver, CourseSaver, ProfessorSaver are derived from this abstract class
 """
 
+import asyncio
+import copy
+import logging
+import sys
+import time
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter, itemgetter
 
-from django.db import transaction
+from django.db import connections, transaction
 
+from scraper.db import ColumnProjection, get_saved_keys, insert_rows, mark_rows, upsert, upsert_rows
+from scraper.keyfilters import KeySet
 from scraper.models import School, Department, Course, Professor
 from scraper.utils import LoggingMixin
 
 
+class FlushPolicy(object):
+    """
+    Decides when saver buffer should be written to db
+
+    Buffer is flushed when any of limits is reached, None disables limit.
+
+    max_urls: number of appended urls
+    max_rows: number of objects in buffer
+    max_bytes: estimated size of objects in buffer
+    max_interval: seconds since last flush, checked when url is appended
+    """
+
+    def __init__(self, max_urls=None, max_rows=None, max_bytes=None, max_interval=None):
+        self.max_urls = max_urls
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(max_urls={!r}, max_rows={!r}, max_bytes={!r}, max_interval={!r})'.format(
+            self.__class__.__name__, self.max_urls, self.max_rows, self.max_bytes, self.max_interval
+        )
+
+    def should_flush(self, urls, rows, size, elapsed):
+        """
+        :param urls: int number of urls appended since last flush
+        :param rows: int number of objects in buffer
+        :param size: int estimated bytes of objects in buffer
+        :param elapsed: float seconds since last flush
+        :return: bool
+        """
+        return any(limit is not None and value >= limit for value, limit in (
+            (urls, self.max_urls),
+            (rows, self.max_rows),
+            (size, self.max_bytes),
+            (elapsed, self.max_interval),
+        ))
+
+    def on_flush(self, rows, seconds):
+        """
+        Takes measurement of finished flush
+        :param rows: int number of saved objects
+        :param seconds: float duration of update_db
+        """
+        pass
+
+
+class AdaptiveFlushPolicy(FlushPolicy):
+    """
+    Tunes max_rows to keep update_db cost per row low
+
+    After every full batch max_rows moves by step factor in current direction,
+    direction reverses when cost per row becomes worse than cost of previous batch by more than tolerance.
+    So batch size climbs while bigger transactions are cheaper per row and settles around the sweet spot.
+    max_bytes and max_interval still cap batches, such batches are too small to be measured.
+
+    history contains (max_rows, seconds per row) pairs of measured batches.
+    """
+
+    def __init__(self, initial_rows=1000, min_rows=100, max_rows=100000, step=1.5, tolerance=0.05,
+                 max_bytes=None, max_interval=None, history_size=100):
+        super().__init__(max_rows=initial_rows, max_bytes=max_bytes, max_interval=max_interval)
+        self.min_rows = min_rows
+        self.upper_rows = max_rows
+        self.step = step
+        self.tolerance = tolerance
+        self.direction = 1
+        self.last_cost = None
+        self.history = deque(maxlen=history_size)
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(max_rows={!r}, min_rows={!r}, upper_rows={!r}, max_bytes={!r}, max_interval={!r})'.format(
+            self.__class__.__name__, self.max_rows, self.min_rows, self.upper_rows, self.max_bytes, self.max_interval
+        )
+
+    def on_flush(self, rows, seconds):
+        # batch cut by bytes, time or end of loading tells little about cost of full batch
+        if rows < self.max_rows / 2:
+            return
+        cost = seconds / rows
+        self.history.append((self.max_rows, cost))
+        if self.last_cost is not None and cost > self.last_cost * (1 + self.tolerance):
+            self.direction = -self.direction
+        self.last_cost = cost
+        new_rows = self.max_rows * self.step ** self.direction
+        self.max_rows = int(max(self.min_rows, min(self.upper_rows, new_rows)))
+
+
 class AbstractSaver(LoggingMixin, metaclass=ABCMeta):
     """
         Contains all necessary save methods
@@ -21,55 +119,312 @@ class AbstractSaver(LoggingMixin, metaclass=ABCMeta):
         update_fetched_objects method is abstract and should be implemented by child.
 
         save_class: model class that have all attributes for mapping fetched object and db instance
+        natural_key: tuple of fields of save_class that identify object in api, they have unique index together
+        save_count: number of urls after which objects are saved, used if flush_policy is not provided
+        flush_policy: FlushPolicy instance
+        upsert: if True objects which natural key is already saved are skipped, so loading could be repeated
+        update_existing: if True upsert updates existing rows instead of skipping them
+        key_filter: KeySet or BloomFilter with saved keys, it is loaded from table before the first upsert
+        raw: if True fetched objects are kept as tuples of ColumnProjection and written with executemany,
+            without model instances and orm insert compiler, keys that are not fields of save_class are skipped
+        task_queue: TaskQueue of fetcher, its tasks are completed in the same transaction as fetched objects,
+            failed tasks are recorded with the next batch
         """
 
     save_class = None
+    natural_key = None
 
-    def __init__(self, save_count=1):
+    def __init__(self, save_count=1, flush_policy=None, upsert=False, update_existing=False, key_filter=None,
+                 raw=False, task_queue=None):
         super().__init__()
         self.save_count = save_count
+        self.flush_policy = flush_policy
+        self.upsert = upsert
+        self.update_existing = update_existing
+        self.key_filter = key_filter
+        self.key_filter_loaded = False
+        self.raw = raw
+        self.task_queue = task_queue
+        # unknown keys of fetched objects that are already logged
+        self.reported_keys = set()
+        # number of objects skipped because their key was already saved
+        self.skipped_count = 0
+        # number of objects written to db
+        self.row_count = 0
         self.success_ids = []
+        # (id of fetch_class object, error) of failed urls
+        self.failed_tasks = []
         self.save_list = []
         self.work_with_db = False
         self.not_saved_count = 0
+        # estimated bytes of objects in save_list
+        self.buffer_size = 0
+        self.flushed_at = time.monotonic()
+        # the longest write of batch, loaders keep time for final flush before deadline
+        self.max_flush_seconds = 0
 
     @abstractmethod
-    def update_fetched_objects(self):
+    def update_fetched_objects(self, ids):
         """
         Marks successfully fetched objects as processed
+        :param ids: list of ids of fetch_class objects
         """
         pass
 
     def __repr__(self, *args, **kwargs):
-        return '{}(save_count={!r})'.format(self.get_class_name(), self.save_count)
+        if self.flush_policy is not None:
+            args = 'flush_policy={!r}'.format(self.flush_policy)
+        else:
+            args = 'save_count={!r}'.format(self.save_count)
+        if self.upsert:
+            args += ', upsert=True, update_existing={!r}'.format(self.update_existing)
+        if self.raw:
+            args += ', raw=True'
+        return '{}({})'.format(self.get_class_name(), args)
 
     def update_db(self):
         """
         Saves objects fetched from urls to db
         """
-        self.work_with_db = True
-        with transaction.atomic():
-            self.update_fetched_objects()
-            self.save_class.objects.bulk_create(objs=self.save_list)
+        self.write_batch(*self.take_batch())
+
+    def clone(self):
+        """
+        Creates saver with the same configuration and empty buffer, e.g. for concurrent save workers
+        Key filter, flush policy and task queue are shared with this saver.
+        :return: AbstractSaver instance
+        """
+        if self.upsert:
+            # filter is loaded once and clones see keys saved by each other
+            self.get_key_filter()
+        saver = copy.copy(self)
+        saver.take_batch()
+        saver.reported_keys = set()
+        saver.skipped_count = 0
+        saver.row_count = 0
+        return saver
+
+    def merge_counters(self, saver):
+        """
+        Adds counters of clone to counters of this saver
+        :param saver: AbstractSaver instance created by clone
+        """
+        self.skipped_count += saver.skipped_count
+        self.row_count += saver.row_count
+        self.max_flush_seconds = max(self.max_flush_seconds, saver.max_flush_seconds)
+
+    def take_batch(self):
+        """
+        Swaps filled buffer for empty one
+        :return: tuple of objects to save, ids to mark as processed and failed tasks
+        """
+        batch = self.save_list, self.success_ids, self.failed_tasks
         self.save_list = []
         self.success_ids = []
+        self.failed_tasks = []
+        self.not_saved_count = 0
+        self.buffer_size = 0
+        self.flushed_at = time.monotonic()
+        return batch
+
+    def write_batch(self, save_list, success_ids, failed_tasks=()):
+        """
+        Saves batch taken from buffer in one transaction
+        :param save_list: list of save_class instances
+        :param success_ids: list of ids of fetch_class objects
+        :param failed_tasks: list of (id of fetch_class object, error) of failed urls
+        """
+        self.work_with_db = True
+        start = time.monotonic()
+        skipped_count = self.skipped_count
+        with transaction.atomic():
+            self.update_fetched_objects(success_ids)
+            if self.task_queue is not None:
+                self.task_queue.complete(success_ids)
+                for target_id, error in failed_tasks:
+                    self.task_queue.fail(target_id, error)
+            saved_keys = self.save_objects(save_list)
+        self.row_count += len(save_list) - (self.skipped_count - skipped_count)
+        # keys are remembered only after commit, so rolled back rows are not skipped later
+        for key in saved_keys:
+            self.key_filter.add(key)
+        seconds = time.monotonic() - start
+        self.max_flush_seconds = max(self.max_flush_seconds, seconds)
+        if self.flush_policy is not None and save_list:
+            self.flush_policy.on_flush(len(save_list), seconds)
         self.work_with_db = False
 
-    def append(self, fetched_url):
+    def save_objects(self, save_list):
+        """
+        Writes objects to db, should be called inside transaction
+        :param save_list: list of save_class instances or rows in raw mode
+        :return: list of natural keys that should be added to key filter
+        """
+        if not self.upsert:
+            # rows of repeated urls, e.g. pages saved before target failed, are left as they are
+            self.skipped_count += len(save_list) - self.insert_objects(save_list)
+            return []
+        get_key = self.get_key_getter()
+        # the last object wins if batch has the same key twice
+        objs = {get_key(obj): obj for obj in save_list}
+        if self.update_existing:
+            self.upsert_objects(list(objs.values()), update=True)
+            return []
+        objs = self.screen_objects(objs)
+        self.upsert_objects(list(objs.values()))
+        return list(objs)
+
+    def insert_objects(self, objs):
+        """
+        Inserts objects without screening of saved keys, rows which key is already in table are skipped
+        :return: int number of written rows
+        """
+        if self.natural_key is not None:
+            return self.upsert_objects(objs)
+        if self.raw:
+            return insert_rows(self.save_class, self.get_projection().fields, objs)
+        self.save_class.objects.bulk_create(objs=objs)
+        return len(objs)
+
+    def upsert_objects(self, objs, update=False):
+        if self.raw:
+            return upsert_rows(self.save_class, self.get_projection().fields, objs, self.natural_key, update=update)
+        return upsert(self.save_class, objs, self.natural_key, update=update)
+
+    def get_projection(self):
+        return ColumnProjection.for_model(self.save_class)
+
+    def get_key_getter(self):
+        """
+        :return: callable that takes natural key from object of buffer, tuple if key has several fields
+        """
+        if self.raw:
+            projection = self.get_projection()
+            return itemgetter(*(projection.get_position(name) for name in self.natural_key))
+        return attrgetter(*self.natural_key)
+
+    def wrap(self, obj):
+        """
+        :param obj: dict fetched from api
+        :return: object stored in buffer, save_class instance or row in raw mode
+        """
+        if self.raw:
+            return self.get_projection().to_row(obj)
+        return self.save_class(**obj)
+
+    def report_unknown_keys(self):
+        unknown_keys = self.get_projection().unknown_keys
+        if len(unknown_keys) == len(self.reported_keys):
+            return
+        for key in sorted(set(unknown_keys) - self.reported_keys):
+            self.log('Skip unknown key {!r} of {} objects'.format(key, self.save_class.__name__), level=logging.WARNING)
+        self.reported_keys.update(unknown_keys)
+
+    def get_key_filter(self):
+        """
+        :return: key filter filled with keys that are already in table
+        """
+        if self.key_filter is None:
+            self.key_filter = KeySet()
+        if not self.key_filter_loaded:
+            keys = self.save_class.objects.values_list(*self.natural_key, flat=len(self.natural_key) == 1)
+            for key in keys.iterator():
+                self.key_filter.add(key)
+            self.key_filter_loaded = True
+        return self.key_filter
+
+    def screen_objects(self, objs, chunk_size=500):
+        """
+        Drops objects which keys are already saved
+
+        Exact filter answers alone, positive answers of bloom filter are confirmed with one query per chunk.
+
+        :param objs: dict of natural key and save_class instance
+        :return: dict of objects that should be written
+        """
+        key_filter = self.get_key_filter()
+        known = [key for key in objs if key_filter.might_contain(key)]
+        if not key_filter.exact:
+            known = get_saved_keys(self.save_class, self.natural_key, known, chunk_size)
+        self.skipped_count += len(known)
+        known = set(known)
+        return {key: obj for key, obj in objs.items() if key not in known}
+
+    def estimate_size(self, obj):
+        """
+        :param obj: dict fetched from api or row
+        :return: int approximate bytes object takes in memory
+        """
+        values = obj.values() if isinstance(obj, dict) else obj
+        return sys.getsizeof(obj) + sum(sys.getsizeof(value) for value in values)
+
+    def should_flush(self):
+        """
+        :return: bool True if objects in buffer should be saved now
+        """
+        if self.flush_policy is None:
+            return self.not_saved_count >= self.save_count
+        return self.flush_policy.should_flush(
+            urls=self.not_saved_count,
+            rows=len(self.save_list),
+            size=self.buffer_size,
+            elapsed=time.monotonic() - self.flushed_at,
+        )
+
+    def add(self, fetched_url):
         """
         Wraps fetched object in save class and stores result in list for bulk saving
         :param fetched_url: url instance from fetcher with populated fetched_dicts attribute
         """
-        # errors in fetched urls should be handled by executors not savers
-        for obj in fetched_url.fetched_dicts:
-            self.save_list.append(self.save_class(**obj))
-        self.success_ids.append(fetched_url.id_to_update)
+        if fetched_url.error:
+            # loaders count errors, saver only records failed task in the same writer that completes tasks
+            if self.task_queue is not None and fetched_url.id_to_update is not None:
+                self.failed_tasks.append((fetched_url.id_to_update, fetched_url.failure))
+            return
+        if fetched_url.fetched_rows is not None:
+            if not self.raw:
+                raise ValueError('{} got rows built out of process, it should be in raw mode'.format(
+                    self.get_class_name()))
+            objs = fetched_url.fetched_rows
+            self.save_list.extend(objs)
+        else:
+            objs = fetched_url.fetched_dicts
+            self.save_list.extend(self.wrap(obj) for obj in objs)
+        if self.flush_policy is not None and self.flush_policy.max_bytes is not None:
+            self.buffer_size += sum(self.estimate_size(obj) for obj in objs)
+        # paginated target is marked with its last page, so target with lost page is fetched again
+        if fetched_url.page_group is not None:
+            if fetched_url.page_group.done():
+                self.success_ids.append(fetched_url.page_group.target_id)
+        elif fetched_url.id_to_update is not None:
+            self.success_ids.append(fetched_url.id_to_update)
         self.not_saved_count += 1
-        if self.not_saved_count > 0 and self.not_saved_count % self.save_count == 0:
+        if self.raw:
+            self.report_unknown_keys()
+
+    def append(self, fetched_url):
+        """
+        Stores objects of fetched url and saves buffer to db when flush policy says so
+        :param fetched_url: url instance from fetcher with populated fetched_dicts attribute
+        """
+        self.add(fetched_url)
+        if self.should_flush():
             count_to_save = len(self.save_list)
+            url_count = self.not_saved_count
             self.update_db()
-            self.log('Save {} of objects, from {} urls'.format(count_to_save, self.save_count))
-            self.not_saved_count = 0
+            self.log('Save {} of objects, from {} urls'.format(count_to_save, url_count))
+
+    async def async_append(self, fetched_url):
+        """
+        Appends fetched url from event loop, plain savers write to db right in the loop
+        """
+        self.append(fetched_url)
+
+    async def async_wait(self):
+        """
+        Waits until saver could take more objects, called by asynchronous loader before each request
+        """
+        pass
 
     @classmethod
     def get_saver(cls, config):
@@ -81,31 +436,147 @@ class AbstractSaver(LoggingMixin, metaclass=ABCMeta):
         return cls(**config)
 
 
+class BackgroundSaver(LoggingMixin):
+    """
+    Writes batches of wrapped saver in dedicated writer thread
+
+    When flush is due, filled buffer is swapped for empty one and handed to writer,
+    so fetching goes on and fills next buffer while previous one is saved.
+    If writer falls behind and max_pending batches are not saved yet, append blocks
+    and asynchronous loader stops issuing requests until writer catches up.
+
+    saver: AbstractSaver instance, its flush policy decides when batch is ready
+    max_pending: number of batches handed to writer and not saved yet, 1 means double buffering
+    """
+
+    def __init__(self, saver, max_pending=1):
+        super().__init__()
+        self.saver = saver
+        self.max_pending = max_pending
+        self.in_flight = deque()
+        self.executor = None
+        # number of times buffer was full while writer was busy
+        self.stall_count = 0
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(saver={!r}, max_pending={!r})'.format(self.get_class_name(), self.saver, self.max_pending)
+
+    @property
+    def max_flush_seconds(self):
+        # final flush waits for batches handed to writer before the last one
+        return self.saver.max_flush_seconds * (self.max_pending + 1)
+
+    def set_logger(self, logger=None):
+        super().set_logger(logger=logger)
+        self.saver.set_logger(logger=logger)
+
+    def get_executor(self):
+        # single thread keeps batches in order and uses one db connection
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        return self.executor
+
+    def collect(self):
+        """
+        Removes saved batches, raises exception of batch that failed to save
+        """
+        while self.in_flight and self.in_flight[0].done():
+            self.in_flight.popleft().result()
+
+    def is_behind(self):
+        """
+        :return: bool True if buffer is ready to flush but writer has no place for it
+        """
+        self.collect()
+        return len(self.in_flight) >= self.max_pending and self.saver.should_flush()
+
+    def submit(self):
+        """
+        Hands filled buffer to writer, should be called when writer has place for batch
+        """
+        count = len(self.saver.save_list)
+        url_count = self.saver.not_saved_count
+        save_list, success_ids, failed_tasks = self.saver.take_batch()
+        if not (save_list or success_ids or failed_tasks):
+            return
+        self.in_flight.append(
+            self.get_executor().submit(self.saver.write_batch, save_list, success_ids, failed_tasks)
+        )
+        self.log('Hand {} of objects, from {} urls to writer'.format(count, url_count))
+
+    def append(self, fetched_url):
+        """
+        Stores objects of fetched url, blocks while writer is behind
+        :param fetched_url: url instance from fetcher with populated fetched_dicts attribute
+        """
+        self.saver.add(fetched_url)
+        if self.is_behind():
+            self.stall_count += 1
+        while self.is_behind():
+            self.in_flight[0].result()
+        if self.saver.should_flush():
+            self.submit()
+
+    async def async_append(self, fetched_url):
+        """
+        Stores objects of fetched url, waits without blocking loop while writer is behind
+        """
+        self.saver.add(fetched_url)
+        if self.is_behind():
+            self.stall_count += 1
+        await self.async_wait()
+        if self.saver.should_flush():
+            self.submit()
+
+    async def async_wait(self):
+        while self.is_behind():
+            await asyncio.wrap_future(self.in_flight[0])
+
+    def update_db(self):
+        """
+        Hands the rest of objects to writer and waits until everything is saved
+        """
+        self.submit()
+        try:
+            while self.in_flight:
+                self.in_flight.popleft().result()
+        finally:
+            if self.executor is not None:
+                # writer thread has its own db connection
+                self.executor.submit(connections.close_all)
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
 class SchoolSaver(AbstractSaver):
     save_class = School
+    natural_key = ('school_id',)
 
-    def update_fetched_objects(self):
+    def update_fetched_objects(self, ids):
         return []
 
 
 class DepartmentSaver(AbstractSaver):
     save_class = Department
+    natural_key = ('department_id', 'school_id')
 
-    def update_fetched_objects(self):
-        return School.objects.filter(school_id__in=self.success_ids).update(department_scraped=True)
+    def update_fetched_objects(self, ids):
+        return mark_rows(School, 'school_id', ids, {'department_scraped': True})
 
 
 class CourseSaver(AbstractSaver):
     save_class = Course
+    natural_key = ('course_id', 'department_id')
 
-    def update_fetched_objects(self):
-        return Department.objects.filter(department_id__in=self.success_ids).update(course_scraped=True)
+    def update_fetched_objects(self, ids):
+        return mark_rows(Department, 'department_id', ids, {'course_scraped': True})
 
 
 class ProfessorSaver(AbstractSaver):
     save_class = Professor
+    natural_key = ('professor_id', 'department_id')
 
-    def update_fetched_objects(self):
-        return Department.objects.filter(department_id__in=self.success_ids).update(professor_scraped=True)
+    def update_fetched_objects(self, ids):
+        return mark_rows(Department, 'department_id', ids, {'professor_scraped': True})
 
 
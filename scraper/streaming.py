@@ -0,0 +1,190 @@
+"""
+Incremental extraction of objects from json documents
+
+JsonStreamExtractor is fed with chunks of response body and returns objects found under key path
+as soon as each of them is complete, so the whole document is never kept in memory.
+"""
+
+import codecs
+import json
+
+WHITESPACE = ' \t\n\r'
+
+# parser states
+START = 'start'
+KEY_OR_END = 'key_or_end'
+COMMA_OR_END = 'comma_or_end'
+DONE = 'done'
+
+
+class NeedMoreData(Exception):
+    """Raised when buffer ends in the middle of token"""
+
+
+class JsonStreamExtractor(object):
+    """
+    Push parser that yields values of object found by key path
+
+    Only objects on the key path are walked, all other values are decoded one by one and dropped,
+    except top level keys listed in capture, which values are stored in captured dict.
+
+    key: str levels separated by dot, the same as AbstractUrlFetcher.key
+    capture: iterable of top level keys which values should be kept
+    """
+
+    def __init__(self, key, capture=()):
+        self.path = key.split('.')
+        self.capture = set(capture)
+        self.captured = {}
+        self.decoder = json.JSONDecoder()
+        # keys of extracted objects, every raw_decode call has its own memo, so keys are shared here
+        self.keys = {}
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        # number of path levels parser is inside
+        self.depth = -1
+        self.state = START
+        self.closed = False
+
+    def feed(self, chunk):
+        """
+        Parses next chunk of document
+
+        :param chunk: bytes
+        :return: list of objects completed by this chunk
+        """
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(chunk)
+        self.pos = 0
+        return self.parse()
+
+    def close(self):
+        """
+        Finishes parsing, raises ValueError if document is incomplete
+
+        :return: list of objects completed by the end of document
+        """
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(b'', final=True)
+        self.pos = 0
+        self.closed = True
+        objs = self.parse()
+        if self.state != DONE or self.buffer[self.pos:].strip(WHITESPACE):
+            raise ValueError('Incomplete json document')
+        return objs
+
+    def skip_whitespace(self):
+        while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+            self.pos += 1
+        if self.pos >= len(self.buffer):
+            raise NeedMoreData
+
+    def decode_value(self):
+        """
+        Decodes value starting at current position
+
+        Value ending at the very end of buffer is not trusted until document is closed,
+        because number could continue in next chunk.
+        """
+        self.skip_whitespace()
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.pos)
+        except ValueError:
+            if self.closed:
+                raise
+            raise NeedMoreData
+        if end >= len(self.buffer) and not self.closed:
+            raise NeedMoreData
+        self.pos = end
+        return value
+
+    def decode_key(self):
+        self.skip_whitespace()
+        if self.buffer[self.pos] != '"':
+            raise ValueError('Expecting property name at {}'.format(self.pos))
+        try:
+            key, end = json.decoder.scanstring(self.buffer, self.pos + 1)
+        except ValueError:
+            if self.closed:
+                raise
+            raise NeedMoreData
+        self.pos = end
+        self.skip_whitespace()
+        if self.buffer[self.pos] != ':':
+            raise ValueError('Expecting : delimiter at {}'.format(self.pos))
+        self.pos += 1
+        return key
+
+    def share_keys(self, value):
+        """
+        Replaces keys of extracted object with equal strings seen before, so objects do not keep own copies
+        """
+        if not isinstance(value, dict):
+            return value
+        keys = self.keys
+        return {keys.setdefault(key, key): item for key, item in value.items()}
+
+    def close_object(self):
+        self.pos += 1
+        self.depth -= 1
+        self.state = DONE if self.depth < 0 else COMMA_OR_END
+
+    def parse_member(self, objs):
+        """
+        Parses one member of object on the key path, state is changed only if member is complete
+        """
+        key = self.decode_key()
+        if self.depth < len(self.path) and key == self.path[self.depth]:
+            self.skip_whitespace()
+            if self.buffer[self.pos] == '{':
+                self.pos += 1
+                self.depth += 1
+                self.state = KEY_OR_END
+                return
+            value = self.decode_value()
+            # e.g. empty list instead of empty object
+            if self.depth + 1 == len(self.path) and isinstance(value, dict):
+                objs.extend(value.values())
+        elif self.depth == len(self.path):
+            objs.append(self.share_keys(self.decode_value()))
+        else:
+            value = self.decode_value()
+            if self.depth == 0 and key in self.capture:
+                self.captured[key] = value
+        self.state = COMMA_OR_END
+
+    def parse(self):
+        objs = []
+        try:
+            while self.state != DONE:
+                self.skip_whitespace()
+                char = self.buffer[self.pos]
+                if self.state == START:
+                    if char != '{':
+                        # document is not an object, there is nothing to extract
+                        self.decode_value()
+                        self.state = DONE
+                        continue
+                    self.pos += 1
+                    self.depth = 0
+                    self.state = KEY_OR_END
+                elif self.state == KEY_OR_END:
+                    if char == '}':
+                        self.close_object()
+                        continue
+                    member_start = self.pos
+                    try:
+                        self.parse_member(objs)
+                    except NeedMoreData:
+                        self.pos = member_start
+                        raise
+                elif self.state == COMMA_OR_END:
+                    if char == ',':
+                        self.pos += 1
+                        self.state = KEY_OR_END
+                    elif char == '}':
+                        self.close_object()
+                    else:
+                        raise ValueError('Expecting , delimiter at {}'.format(self.pos))
+        except NeedMoreData:
+            pass
+        return objs
@@ -0,0 +1,164 @@
+"""
+Multi-process loading
+
+Every worker process runs its own loader on deterministic shard of targets, target_field % count == index,
+so json decoding and model building of shards run on separate cores.
+Supervisor starts workers, restarts crashed ones and merges their reports.
+
+Workers write to the same database. sqlite has one writer at a time: scrape_data switches it to wal,
+so workers read while other one commits, and commits wait for lock up to timeout of database settings.
+Savers write in batches, so lock is taken once per batch. Only parsing scales with workers on sqlite,
+database with concurrent writers, e.g. postgresql, is needed for writes to scale too.
+Gain was measured only on one cpu host so far, where start of interpreters makes more workers slower,
+benchmark case shards should be run on multi-core host before choosing number of workers.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from scraper.utils import LoggingMixin
+
+
+def parse_shard(value):
+    """
+    :param value: str 'k/N'
+    :return: tuple of int index and count of shards
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError('Shard should look like k/N, got {!r}'.format(value))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('Shard index should be from 0 to {}, got {!r}'.format(count - 1, value))
+    return index, count
+
+
+def strip_options(args, options):
+    """
+    Removes options with their values from command line arguments
+
+    :param args: list of str
+    :param options: iterable of option names, e.g. '--workers'
+    :return: list of str
+    """
+    result = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        elif arg.split('=', 1)[0] not in options:
+            result.append(arg)
+    return result
+
+
+def merge_reports(reports):
+    """
+    :param reports: list of dicts with counters
+    :return: dict of summed numeric counters
+    """
+    merged = {}
+    for report in reports:
+        for key, value in report.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+class Supervisor(LoggingMixin):
+    """
+    Runs worker process per shard until all of them finish
+
+    Worker gets --shard k/N and --report path arguments and should write json dict of counters to report
+    path before successful exit. Crashed worker is started again up to max_restarts times, it continues
+    with targets which are not marked as processed yet, counters of crashed attempts are lost.
+
+    command: list of str, command line of worker without shard arguments
+    workers: number of worker processes and shards
+    max_restarts: number of restarts of one shard
+    poll_interval: seconds between checks of workers
+    """
+
+    def __init__(self, command, workers, max_restarts=3, poll_interval=0.5, logger=None):
+        super().__init__()
+        self.command = list(command)
+        self.workers = workers
+        self.max_restarts = max_restarts
+        self.poll_interval = poll_interval
+        self.set_logger(logger=logger)
+        # shard index and running process
+        self.processes = {}
+        self.restarts = dict.fromkeys(range(workers), 0)
+        self.failed = []
+        self.report_dir = None
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(workers={!r}, max_restarts={!r})'.format(self.get_class_name(), self.workers, self.max_restarts)
+
+    def get_report_path(self, index):
+        return os.path.join(self.report_dir, 'shard-{}-{}.json'.format(index, self.restarts[index]))
+
+    def get_worker_command(self, index):
+        return self.command + ['--shard', '{}/{}'.format(index, self.workers), '--report', self.get_report_path(index)]
+
+    def start(self, index):
+        self.processes[index] = subprocess.Popen(self.get_worker_command(index))
+        self.log('Start worker of shard {}/{}, pid {}'.format(index, self.workers, self.processes[index].pid))
+
+    def check(self):
+        """
+        Collects finished workers, restarts crashed ones
+        """
+        for index, process in list(self.processes.items()):
+            code = process.poll()
+            if code is None:
+                continue
+            del self.processes[index]
+            if code == 0:
+                self.log('Worker of shard {}/{} finished'.format(index, self.workers))
+            elif self.restarts[index] < self.max_restarts:
+                self.restarts[index] += 1
+                self.log('Worker of shard {}/{} exited with {}, restart {}'.format(
+                    index, self.workers, code, self.restarts[index]))
+                self.start(index)
+            else:
+                self.failed.append(index)
+                self.log('Worker of shard {}/{} exited with {}, give up'.format(index, self.workers, code))
+
+    def read_reports(self):
+        reports = []
+        for name in sorted(os.listdir(self.report_dir)):
+            with open(os.path.join(self.report_dir, name)) as report_file:
+                reports.append(json.load(report_file))
+        return reports
+
+    def run(self):
+        """
+        :return: dict of merged counters of workers
+        """
+        start = time.monotonic()
+        self.report_dir = tempfile.mkdtemp(prefix='scrape-reports-')
+        try:
+            for index in range(self.workers):
+                self.start(index)
+            while self.processes:
+                time.sleep(self.poll_interval)
+                self.check()
+            report = merge_reports(self.read_reports())
+        finally:
+            for process in self.processes.values():
+                process.terminate()
+            shutil.rmtree(self.report_dir)
+        seconds = time.monotonic() - start
+        report.update({
+            'workers': self.workers,
+            'restarts': sum(self.restarts.values()),
+            'failed_shards': self.failed,
+            'wall_seconds': round(seconds, 3),
+        })
+        return report
@@ -0,0 +1,169 @@
+"""
+Work queue of loading stages backed by ScrapeTask table
+
+Fetcher with task queue claims batches of targets instead of scanning *_scraped flags,
+saver completes tasks in the same transaction as fetched objects.
+Claimed tasks are leased, so loaders in other processes skip them until lease expires.
+"""
+
+import os
+import socket
+import uuid
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from scraper.db import get_connection, mark_rows
+from scraper.models import ScrapeTask
+
+
+def make_owner():
+    """
+    :return: str lease owner unique for every queue instance
+    """
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class TaskQueue(object):
+    """
+    Hands out targets of one stage to loaders and tracks their progress
+
+    Claim takes up to batch_size available tasks in one transaction: pending tasks and claimed tasks
+    which lease has expired. Rows are selected with SKIP LOCKED where backend supports it and are
+    claimed by update that checks availability again, so concurrent claims never get the same task.
+
+    stage: name of stage, fetcher sets it from its class
+    lease_seconds: time claimed task is reserved for owner
+    batch_size: number of tasks taken by one claim
+    max_attempts: tasks which fetch failed so many times are not claimed again
+    owner: str lease owner, unique one is generated if not provided
+    """
+
+    def __init__(self, stage, lease_seconds=600, batch_size=100, max_attempts=3, owner=None):
+        self.stage = stage
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.owner = owner or make_owner()
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(stage={!r}, lease_seconds={!r}, batch_size={!r}, owner={!r})'.format(
+            self.__class__.__name__, self.stage, self.lease_seconds, self.batch_size, self.owner
+        )
+
+    def get_queryset(self):
+        return ScrapeTask.objects.filter(stage=self.stage)
+
+    def enqueue(self, target_ids, chunk_size=500):
+        """
+        Creates pending tasks for targets which have no task of this stage yet
+
+        :param target_ids: iterable of int ids
+        :return: int number of created tasks
+        """
+        target_ids = list(target_ids)
+        created = 0
+        for start in range(0, len(target_ids), chunk_size):
+            chunk = target_ids[start:start + chunk_size]
+            try:
+                with transaction.atomic():
+                    existing = set(self.get_queryset().filter(target_id__in=chunk).values_list('target_id', flat=True))
+                    tasks = [ScrapeTask(stage=self.stage, target_id=target_id)
+                             for target_id in set(chunk) - existing]
+                    ScrapeTask.objects.bulk_create(tasks)
+            except IntegrityError:
+                # other process enqueued some of targets meanwhile
+                created += sum(
+                    ScrapeTask.objects.get_or_create(stage=self.stage, target_id=target_id)[1] for target_id in chunk
+                )
+            else:
+                created += len(tasks)
+        return created
+
+    def claim(self, count=None):
+        """
+        Leases available tasks to owner of queue
+
+        :param count: int max number of tasks, batch_size if None
+        :return: list of int target ids
+        """
+        now = timezone.now()
+        expires = now + timedelta(seconds=self.lease_seconds)
+        available = self.get_queryset().filter(
+            Q(status=ScrapeTask.PENDING) | Q(status=ScrapeTask.CLAIMED, lease_expires__lt=now),
+            attempts__lt=self.max_attempts,
+        )
+        with transaction.atomic():
+            candidates = available.order_by('id')
+            if get_connection(ScrapeTask).features.has_select_for_update_skip_locked:
+                candidates = candidates.select_for_update(skip_locked=True)
+            ids = list(candidates.values_list('id', flat=True)[:count or self.batch_size])
+            if not ids:
+                return []
+            available.filter(id__in=ids).update(
+                status=ScrapeTask.CLAIMED, lease_owner=self.owner, lease_expires=expires, attempts=F('attempts') + 1
+            )
+            return list(ScrapeTask.objects.filter(
+                id__in=ids, lease_owner=self.owner, lease_expires=expires
+            ).order_by('id').values_list('target_id', flat=True))
+
+    def iter_claimed(self):
+        """
+        Claims batches of tasks while there are available ones
+        Targets claimed but not consumed when generator is closed are released.
+
+        :return: Iterable of int target ids
+        """
+        while True:
+            target_ids = self.claim()
+            if not target_ids:
+                return
+            for position, target_id in enumerate(target_ids):
+                try:
+                    yield target_id
+                except GeneratorExit:
+                    self.release(target_ids[position + 1:])
+                    raise
+
+    def complete(self, target_ids):
+        """
+        Marks tasks as done, should be called inside transaction that saves their objects
+        :param target_ids: list of int ids
+        """
+        return mark_rows(ScrapeTask, 'target_id', target_ids, {
+            'status': ScrapeTask.DONE, 'lease_owner': None, 'lease_expires': None, 'last_error': None,
+        }, filters={'stage': self.stage})
+
+    def fail(self, target_id, error):
+        """
+        Records error of failed fetch, task keeps its lease and is claimed again when lease expires,
+        so the same run does not retry it right away. Task fails for good after max_attempts.
+
+        :param target_id: int id
+        :param error: str description of error
+        """
+        tasks = self.get_queryset().filter(target_id=target_id, lease_owner=self.owner)
+        tasks.filter(attempts__lt=self.max_attempts).update(last_error=error)
+        tasks.filter(attempts__gte=self.max_attempts).update(
+            status=ScrapeTask.FAILED, lease_owner=None, lease_expires=None, last_error=error
+        )
+
+    def release(self, target_ids):
+        """
+        Returns claimed tasks which were not fetched, their attempt is not counted
+        :param target_ids: list of int ids
+        """
+        if not target_ids:
+            return
+        self.get_queryset().filter(
+            target_id__in=target_ids, lease_owner=self.owner, status=ScrapeTask.CLAIMED
+        ).update(status=ScrapeTask.PENDING, lease_owner=None, lease_expires=None, attempts=F('attempts') - 1)
+
+    def get_stats(self):
+        """
+        :return: dict of status and number of tasks of stage
+        """
+        counts = self.get_queryset().values('status').annotate(count=Count('id')).order_by()
+        return {row['status']: row['count'] for row in counts}
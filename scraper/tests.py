@@ -1,13 +1,43 @@
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
 import requests
 
-from django.test import TestCase, mock
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.backends.signals import connection_created
+from django.test import TestCase, TransactionTestCase, mock
+from django.utils import timezone
 from model_mommy import mommy
 
-from scraper.models import School, Department
-from scraper.fetchers import DepartmentFetcher, PaginatedFetcher
-from scraper.savers import DepartmentSaver, SchoolSaver
-from scraper.loaders import Loader
-from scraper.utils import Url
+from scraper.models import School, Department, Course, Professor, ScrapeTask, TargetCost
+from scraper.fetchers import DepartmentFetcher, CourseFetcher, ProfessorFetcher, PaginatedFetcher
+from scraper.savers import DepartmentSaver, SchoolSaver, CourseSaver, ProfessorSaver, FlushPolicy, AdaptiveFlushPolicy, BackgroundSaver
+from scraper.loaders import Loader, AsyncLoader, ExecutorLoader, HybridLoader, ThreadedLoader
+from scraper.cache import ResponseCache
+from scraper.retry import RetryPolicy, CircuitBreaker, classify_error, CONNECT_ERROR, SERVER_ERROR, CLIENT_ERROR
+from scraper.streaming import JsonStreamExtractor
+from scraper.hedging import HedgePolicy, LatencyTracker
+from scraper.keyfilters import KeySet, BloomFilter
+from scraper.tasks import TaskQueue
+from scraper.costs import CostTracker, INTERLEAVE, LONGEST_FIRST
+from scraper.budget import LoadBudget
+from scraper.pipeline import Pipeline, PipelineStage
+from scraper.supervisor import Supervisor, parse_shard, strip_options
+from scraper.db import build_upsert_sql, get_insert_fields, mark_rows, BulkLoadProfile, ColumnProjection
+from scraper.management.commands.benchmark import Command as BenchmarkCommand
+from scraper.limiters import AIMDLimit, GradientLimit, AdaptiveLimiter, AsyncAdaptiveLimiter, TokenBucket, RateLimiter
+from scraper.utils import (
+    Url, SessionPool, SessionUrl, AsyncUrl, CachedUrl, AsyncCachedUrl, JsonDecoder, get_decoder, get_decoder_names
+)
 
 DEPARTMENT_RESPONSE_DICT = {
     24542: {
@@ -286,6 +316,47 @@ SCHOOL_RESPONSE_DICT = {
     }
 }
 
+# the same schools under other ids, pages of paginated response do not repeat objects
+SCHOOL_PAGE_2_RESPONSE_DICT = {
+    key + 100: dict(value, UID=value['UID'] + 100, school_id=value['school_id'] + 100)
+    for key, value in SCHOOL_RESPONSE_DICT.items()
+}
+
+
+def make_department_dicts(offset):
+    """
+    :param offset: int added to department ids
+    :return: copy of DEPARTMENT_RESPONSE_DICT with other departments
+    """
+    return {
+        key + offset: dict(value, UID=value['UID'] + offset, department_id=value['department_id'] + offset)
+        for key, value in DEPARTMENT_RESPONSE_DICT.items()
+    }
+
+
+def make_department_url(offset=0):
+    """
+    :param offset: int added to department ids
+    :return: Url of school 2 fetched with departments of make_department_dicts
+    """
+    url = Url('test', id_to_update=2)
+    url.append_fetched_dicts(objs=make_department_dicts(offset))
+    return url
+
+
+def save_departments(*urls, **kwargs):
+    """
+    :param urls: fetched urls saved in one batch
+    :param kwargs: options of DepartmentSaver
+    :return: DepartmentSaver after update_db
+    """
+    saver = DepartmentSaver(save_count=10, **kwargs)
+    for url in urls:
+        saver.append(fetched_url=url)
+    saver.update_db()
+    return saver
+
+
 PAGINATION_DICT = {
     'results': 10,
     'page': 1,
@@ -300,6 +371,8 @@ def mocked_requests_get(*args, **kwargs):
             self.json_data = json_data
             self.status_code = status_code
             self.ok = (status_code < 400)
+            self.headers = {}
+            self.content = json.dumps(json_data).encode('utf-8')
 
         def json(self):
             return self.json_data
@@ -307,6 +380,13 @@ def mocked_requests_get(*args, **kwargs):
         def raise_for_status(self):
             raise requests.HTTPError
 
+        def iter_content(self, chunk_size=1):
+            body = self.content
+            return (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+
+        def close(self):
+            pass
+
     if args[0] == 'http://t.com/t':
         return MockResponse({'success': True}, 200)
     elif args[0] == 'http://t.com/at':
@@ -343,7 +423,7 @@ def mocked_requests_get(*args, **kwargs):
             'status': 200,
             'message': 'OK',
             'result': {
-                'School': SCHOOL_RESPONSE_DICT
+                'School': SCHOOL_RESPONSE_DICT if args[0].endswith('1') else SCHOOL_PAGE_2_RESPONSE_DICT
             },
             'pagination': PAGINATION_DICT
         }, 200)
@@ -507,6 +587,109 @@ class LoaderTest(TestCase):
         self.assertEqual(Department.objects.count(), 4)
 
 
+class ThreadedLoaderTest(TransactionTestCase):
+    def setUp(self):
+        for school_id in (1, 2, 3):
+            mommy.make(School, school_id=school_id)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_load(self, mocked_get):
+        threads = threading.active_count()
+        loader = ThreadedLoader(fetcher=DepartmentFetcher(), saver=DepartmentSaver(save_count=1), concurrent=2)
+        self.assertEqual(loader.sq.maxsize, 6)
+        loader.load()
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertEqual(loader.req_count, 3)
+        self.assertEqual(loader.error_count, 1)
+        self.assertEqual(loader.saver.row_count, 4)
+        self.assertEqual(loader.get_queue_stats()['save_queue'], 0)
+        # workers exit, loader could be used again
+        self.assertEqual(threading.active_count(), threads)
+        loader.load()
+        self.assertEqual(loader.req_count, 4)
+        self.assertEqual(threading.active_count(), threads)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_save_workers(self, mocked_get):
+        # shared cache of in-memory test db does not wait for lock of concurrent writer, so batches are recorded
+        batches = []
+
+        class RecordingSaver(DepartmentSaver):
+            def write_batch(self, save_list, success_ids, failed_tasks=()):
+                batches.append((self, len(save_list), success_ids))
+                self.row_count += len(save_list)
+
+        loader = ThreadedLoader(fetcher=DepartmentFetcher(), saver=RecordingSaver(save_count=1), concurrent=2,
+                                save_workers=2)
+        loader.load()
+        self.assertEqual(sorted(ids for _, _, ids in batches if ids), [[1], [2]])
+        self.assertEqual(loader.saver.row_count, 4)
+        # every save worker flushes its own saver at the end
+        self.assertEqual(len({saver for saver, _, _ in batches}), 2)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_save_error(self, mocked_get):
+        threads = threading.active_count()
+        saver = DepartmentSaver()
+        loader = ThreadedLoader(fetcher=DepartmentFetcher(), saver=saver, concurrent=2)
+        with mock.patch.object(saver, 'append', side_effect=ValueError('broken')):
+            with self.assertRaises(ValueError):
+                loader.load()
+        self.assertEqual(loader.req_count, 3)
+        self.assertEqual(threading.active_count(), threads)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_deadline(self, mocked_get):
+        loader = ThreadedLoader(fetcher=DepartmentFetcher(), saver=DepartmentSaver(), concurrent=2)
+        loader.load(max_req_count=None, deadline=0)
+        self.assertEqual(loader.req_count, 0)
+        self.assertEqual(loader.backlog, 3)
+        self.assertEqual(loader.budget.get_stats()['budget_seconds'], 0)
+        loader.load(max_req_count=None, deadline=60)
+        self.assertEqual(loader.req_count, 3)
+        self.assertIsNone(loader.budget.stopped_at)
+        self.assertEqual(loader.backlog, 1)
+        self.assertEqual(loader.in_flight, 0)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_pace_outside_limiter(self, mocked_get):
+        limiter = AdaptiveLimiter(AIMDLimit(initial=2, max_limit=2))
+        loader = ThreadedLoader(fetcher=DepartmentFetcher(), saver=DepartmentSaver(), limiter=limiter)
+        latencies = []
+        on_sample = limiter.on_sample
+
+        def record(latency, error):
+            latencies.append(latency)
+            on_sample(latency, error)
+
+        with mock.patch.object(limiter, 'on_sample', side_effect=record):
+            loader.load(max_req_count=None, rate=10)
+        # turns of rate are 0.1s apart, but only quick requests are sampled
+        self.assertEqual(len(latencies), 3)
+        self.assertLess(max(latencies), 0.05)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_pages_count_against_max_req_count(self, mocked_get):
+        loader = ThreadedLoader(fetcher=PaginatedFetcher(), saver=SchoolSaver(), concurrent=2)
+        loader.load(max_req_count=1)
+        self.assertEqual(mocked_get.call_count, 1)
+        # page of started target is not dropped, it waits for next load
+        self.assertTrue(loader.fetcher.has_pending())
+
+    def test_clone(self):
+        saver = DepartmentSaver(save_count=10)
+        saver.skipped_count = 1
+        saver.save_list.append(Department())
+        clone = saver.clone()
+        self.assertEqual(clone.save_count, 10)
+        self.assertEqual((clone.save_list, clone.skipped_count), ([], 0))
+        clone.row_count = 3
+        saver.merge_counters(clone)
+        self.assertEqual((saver.row_count, saver.skipped_count, len(saver.save_list)), (3, 1, 1))
+        with self.assertRaises(ValueError):
+            ThreadedLoader(fetcher=DepartmentFetcher(), saver=BackgroundSaver(saver), save_workers=2)
+
+
 class PaginatedFetcherTest(TestCase):
     def setUp(self):
         self.tdg = PaginatedFetcher()
@@ -515,24 +698,12 @@ class PaginatedFetcherTest(TestCase):
         School.objects.all().delete()
         del self.tdg
 
-    @mock.patch('requests.get', side_effect=mocked_requests_get)
-    def test_paginated(self, mock_get):
-        paginated = 'https://www.myedu.com/adms/school/paginated'
-        self.assertEqual(self.tdg.pages, 1)
-        self.assertTrue(self.tdg.is_paginated(url_string=paginated))
-        self.assertEqual(self.tdg.pages, 2)
-
-    @mock.patch('requests.get', side_effect=mocked_requests_get)
-    def test_not_paginated(self, mock_get):
-        not_paginated = 'https://www.myedu.com/adms/school/notpaginated'
-        self.assertEqual(self.tdg.pages, 1)
-        self.assertFalse(self.tdg.is_paginated(url_string=not_paginated))
-        self.assertEqual(self.tdg.pages, 1)
-
     @mock.patch('requests.get', side_effect=mocked_requests_get)
     def test_get_urls(self, mock_get):
         urls = list(self.tdg.get_urls())
-        self.assertEqual(len(urls), self.tdg.pages)
+        # remaining pages come from the first response
+        self.assertEqual(len(urls), 1)
+        self.assertFalse(mock_get.called)
         for url in urls:
             self.assertIsInstance(url, Url)
             self.assertIn('page', url.url_string)
@@ -546,3 +717,1553 @@ class PaginatedLoaderTest(TestCase):
         Loader(fetcher=PaginatedFetcher(), saver=SchoolSaver()).load()
         self.assertTrue(School.objects.exists())
         self.assertEqual(School.objects.count(), 10)
+        # first page is not requested twice
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_async_process_urls(self):
+        async def request(url, session):
+            return mocked_requests_get(url.url_string).json()
+
+        loader = AsyncLoader(fetcher=PaginatedFetcher(), saver=SchoolSaver())
+        loader.fetcher.url_class = AsyncUrl
+        with mock.patch.object(AsyncUrl, 'request', new=request):
+            loader.load()
+        self.assertEqual(loader.req_count, 2)
+        self.assertEqual(School.objects.count(), 10)
+
+    def test_pages_count_against_max_req_count(self):
+        async def request(url, session):
+            return mocked_requests_get(url.url_string).json()
+
+        # every loader takes urls from iter_urls, so remaining pages are requests of the same budget
+        with mock.patch('requests.get', side_effect=mocked_requests_get) as mock_get:
+            Loader(fetcher=PaginatedFetcher(), saver=SchoolSaver()).load(max_req_count=1)
+            ExecutorLoader(fetcher=PaginatedFetcher(), saver=SchoolSaver(), concurrent=2).load(max_req_count=1)
+        self.assertEqual(mock_get.call_count, 2)
+        loader = AsyncLoader(fetcher=PaginatedFetcher(url_class=AsyncUrl), saver=SchoolSaver())
+        with mock.patch.object(AsyncUrl, 'request', side_effect=request, autospec=True) as mock_request:
+            loader.load(max_req_count=1)
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(loader.req_count, 1)
+        self.assertTrue(loader.fetcher.has_pending())
+
+
+class PaginationTest(TestCase):
+    def setUp(self):
+        self.tdg = DepartmentFetcher()
+
+    def test_get_page_url(self):
+        self.assertEqual(self.tdg.get_page_url('http://t.com/t/', 2), 'http://t.com/t/?page=2')
+        self.assertEqual(self.tdg.get_page_url('http://t.com/t/?a=1&page=1', 3), 'http://t.com/t/?a=1&page=3')
+
+    def test_page_urls(self):
+        data = {'result': {'Department': DEPARTMENT_RESPONSE_DICT}, 'pagination': {'pages': 3}}
+        url = self.tdg.make_url('http://t.com/dep/', id_to_update=1)
+        self.tdg.process_response(url, resp_data=data)
+        self.assertEqual(len(url.fetched_dicts), 4)
+        self.assertEqual([u.url_string for u in url.page_urls], ['http://t.com/dep/?page=2', 'http://t.com/dep/?page=3'])
+        self.assertEqual([u.id_to_update for u in url.page_urls], [None, None])
+        self.assertEqual({u.page_group for u in url.page_urls}, {url.page_group})
+        self.assertFalse(self.tdg.reschedule(url))
+        self.assertEqual(self.tdg.pop_pending().page, 2)
+
+        # pages do not produce pages again
+        page_url = self.tdg.pop_pending()
+        self.tdg.process_response(page_url, resp_data=data)
+        self.assertFalse(page_url.page_urls)
+
+        self.tdg.paginate = False
+        url = self.tdg.make_url('http://t.com/dep/', id_to_update=1)
+        self.tdg.process_response(url, resp_data=data)
+        self.assertFalse(url.page_urls)
+
+    def test_target_marked_with_last_page(self):
+        data = {'result': {'Department': DEPARTMENT_RESPONSE_DICT}, 'pagination': {'pages': 3}}
+        saver = DepartmentSaver()
+        url = self.tdg.make_url('http://t.com/dep/', id_to_update=1)
+        self.tdg.process_response(url, resp_data=data)
+        second, third = url.page_urls
+        saver.add(url)
+        saver.add(third)
+        self.assertEqual(saver.success_ids, [])
+        saver.add(second)
+        self.assertEqual(saver.success_ids, [1])
+        # target with failed page is not marked
+        url = self.tdg.make_url('http://t.com/dep/', id_to_update=2)
+        self.tdg.process_response(url, resp_data=data)
+        saver.add(url)
+        saver.add(url.page_urls[0])
+        self.assertEqual(saver.success_ids, [1])
+
+
+class SessionUrlTest(TestCase):
+    def setUp(self):
+        self.pool = SessionPool(pool_maxsize=2, connect_timeout=1, read_timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_get_session_per_thread(self):
+        session = self.pool.get_session()
+        self.assertIs(self.pool.get_session(), session)
+        other = []
+        t = threading.Thread(target=lambda: other.append(self.pool.get_session()))
+        t.start()
+        t.join()
+        self.assertIsNot(other[0], session)
+        self.assertEqual(self.pool.get_stats()['sessions'], 2)
+        self.pool.close()
+        self.assertEqual(self.pool.get_stats()['sessions'], 0)
+        self.assertIsNot(self.pool.get_session(), session)
+
+    @mock.patch('requests.Session.get', side_effect=mocked_requests_get)
+    def test_get_response(self, mock_get):
+        class PooledUrl(SessionUrl):
+            session_pool = self.pool
+
+        result = PooledUrl('http://t.com/t').get_response()
+        self.assertTrue(result['success'])
+        self.assertEqual(mock_get.call_args[1]['timeout'], (1, 5))
+        self.assertRaises(requests.HTTPError, lambda: PooledUrl('http://t.com/404').get_response())
+
+
+class AsyncLoaderTest(TestCase):
+    def setUp(self):
+        mommy.make(School, school_id=1)
+        mommy.make(School, school_id=2)
+        mommy.make(School, school_id=3)
+        self.ter = AsyncLoader(fetcher=DepartmentFetcher(url_class=AsyncUrl), saver=DepartmentSaver(), limit_per_host=2)
+
+    def test_load_shares_session(self):
+        sessions = []
+
+        async def request(url, session):
+            sessions.append(session)
+            return mocked_requests_get(url.url_string).json()
+
+        with mock.patch.object(AsyncUrl, 'request', new=request):
+            self.ter.load()
+        self.assertEqual(len(sessions), 3)
+        self.assertEqual(len(set(sessions)), 1)
+        self.assertTrue(sessions[0].closed)
+        self.assertIsNone(self.ter.session)
+        self.assertEqual(self.ter.req_count, 3)
+        self.assertEqual(self.ter.error_count, 1)
+        self.assertEqual(Department.objects.count(), 4)
+
+    def test_window(self):
+        loader = AsyncLoader(fetcher=DepartmentFetcher(url_class=AsyncUrl), saver=DepartmentSaver(), window=1)
+        get_urls = loader.fetcher.get_urls
+        pulled = []
+        in_flight = []
+
+        def counted_urls():
+            for url in get_urls():
+                pulled.append(url)
+                yield url
+
+        async def request(url, session):
+            in_flight.append(len(pulled))
+            return mocked_requests_get(url.url_string).json()
+
+        with mock.patch.object(AsyncUrl, 'request', new=request), \
+                mock.patch.object(loader.fetcher, 'get_urls', new=counted_urls):
+            loader.load()
+        # next url is taken only after previous one is handled
+        self.assertEqual(in_flight, [1, 2, 3])
+        self.assertEqual(loader.max_in_flight, 1)
+        self.assertEqual(loader.req_count, 3)
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertEqual(self.ter.window, 200)
+
+    def test_deadline(self):
+        loader = AsyncLoader(fetcher=DepartmentFetcher(url_class=AsyncUrl), saver=DepartmentSaver(), connections=1)
+
+        async def request(url, session):
+            await asyncio.sleep(0.1)
+            return mocked_requests_get(url.url_string).json()
+
+        with mock.patch.object(AsyncUrl, 'request', new=request):
+            loader.load(max_req_count=None, deadline=0.15)
+            self.assertEqual(loader.req_count, 1)
+            self.assertEqual(loader.backlog, 2)
+            loader = AsyncLoader(fetcher=DepartmentFetcher(url_class=AsyncUrl), saver=DepartmentSaver())
+            start = time.monotonic()
+            loader.load(max_req_count=None, rate=5)
+        # requests of the other schools are not sent at once
+        self.assertGreaterEqual(time.monotonic() - start, 0.29)
+        self.assertEqual(loader.backlog, 1)
+
+    def test_retries(self):
+        attempts = []
+
+        async def request(url, session):
+            attempts.append(url.url_string)
+            if attempts.count(url.url_string) == 1 and '/1/' in url.url_string:
+                raise aiohttp.ServerDisconnectedError()
+            return mocked_requests_get(url.url_string).json()
+
+        fetcher = DepartmentFetcher(url_class=AsyncUrl, retry_policy=RetryPolicy(max_attempts=2, base_delay=0.01))
+        loader = AsyncLoader(fetcher=fetcher, saver=DepartmentSaver())
+        with mock.patch.object(AsyncUrl, 'request', new=request):
+            loader.load(max_req_count=None)
+        # retries wait in pending queue of fetcher, every url is counted once as handled url
+        self.assertEqual(len(attempts), 5)
+        self.assertEqual((loader.req_count, loader.error_count), (3, 1))
+        self.assertEqual(Department.objects.count(), 4)
+
+        # retry is a request of max_req_count budget too
+        School.objects.update(department_scraped=False)
+        attempts.clear()
+        loader = AsyncLoader(fetcher=fetcher, saver=DepartmentSaver(), connections=1)
+        with mock.patch.object(AsyncUrl, 'request', new=request):
+            loader.load(max_req_count=2)
+        self.assertEqual(len(attempts), 2)
+
+
+async def read_mocked_body(url, session):
+    response = mocked_requests_get(url.url_string)
+    if not response.ok:
+        response.raise_for_status()
+    return response.content
+
+
+class CrashingParserFetcher(DepartmentFetcher):
+    """
+    Kills parser process on body of the first school, so process pool breaks
+    """
+
+    def parse_body(self, url_string, body, projection):
+        if url_string.endswith('/1/department/'):
+            os._exit(1)
+        return super().parse_body(url_string, body, projection)
+
+
+class HybridLoaderTest(TestCase):
+    def setUp(self):
+        for school_id in (1, 2, 3):
+            mommy.make(School, school_id=school_id)
+
+    def make_loader(self):
+        return HybridLoader(fetcher=DepartmentFetcher(url_class=AsyncUrl), saver=DepartmentSaver(raw=True),
+                            processes=1, chunk_size=2)
+
+    @mock.patch.object(AsyncUrl, 'read_body', new=read_mocked_body)
+    def test_load(self):
+        loader = self.make_loader()
+        tracker = loader.fetcher.cost_tracker = CostTracker(DepartmentFetcher.stage)
+        loader.load()
+        self.assertEqual(loader.req_count, 3)
+        self.assertEqual(loader.error_count, 1)
+        self.assertIsNone(loader.pool)
+        self.assertGreaterEqual(loader.chunk_count, 1)
+        self.assertEqual(Department.objects.count(), 4)
+        department = Department.objects.get(department_id=24542)
+        self.assertEqual(department.source_url, 'https://www.myedu.com/adms/school/1/department/')
+        self.assertEqual(School.objects.filter(department_scraped=True).count(), 2)
+        # costs of bodies parsed in pool are recorded as well, objects are counted by rows
+        self.assertEqual(sorted(tracker.measured), [1, 2])
+        self.assertEqual(tracker.measured[1][1:3], (1, 4))
+        self.assertGreater(tracker.measured[1][0], 0)
+
+    def test_parse_error(self):
+        async def read_body(url, session):
+            if url.url_string.endswith('/2/department/'):
+                return b'{"result": '
+            return await read_mocked_body(url, session)
+
+        loader = self.make_loader()
+        with mock.patch.object(AsyncUrl, 'read_body', new=read_body):
+            loader.load()
+        self.assertEqual(loader.error_count, 2)
+        self.assertEqual(loader.parse_error_count, 1)
+        self.assertEqual(list(School.objects.filter(department_scraped=True).values_list('school_id', flat=True)), [1])
+
+    def test_parse_error_keeps_circuit(self):
+        async def read_body(url, session):
+            return b'{"result": '
+
+        loader = self.make_loader()
+        breaker = CircuitBreaker(failure_threshold=1)
+        loader.fetcher.retry_policy = RetryPolicy(max_attempts=3, base_delay=0, breaker=breaker)
+        with mock.patch.object(AsyncUrl, 'read_body', new=read_body):
+            loader.load()
+        # responses arrived, host is not blamed and broken bodies are not requested again
+        self.assertEqual(loader.req_count, 3)
+        self.assertEqual(loader.parse_error_count, 3)
+        self.assertEqual(loader.fetcher.retry_policy.retry_count, 0)
+        self.assertEqual(breaker.get_state(loader.fetcher.make_target_url(1).url_string), CircuitBreaker.CLOSED)
+
+    def test_broken_pool(self):
+        async def read_body(url, session):
+            if not url.url_string.endswith('/1/department/'):
+                # chunks sent to pool that is already broken fail with it
+                await asyncio.sleep(0.5)
+            return await read_mocked_body(url, session)
+
+        loader = HybridLoader(fetcher=CrashingParserFetcher(url_class=AsyncUrl), saver=DepartmentSaver(raw=True),
+                              processes=1, chunk_size=1, connections=1)
+        with mock.patch.object(AsyncUrl, 'read_body', new=read_body):
+            loader.load()
+        self.assertEqual(loader.req_count, 3)
+        self.assertEqual(loader.pool_restarts, 1)
+        self.assertIsNone(loader.pool)
+        # school after the crash is parsed by new pool
+        self.assertEqual(list(School.objects.filter(department_scraped=True).values_list('school_id', flat=True)), [2])
+
+
+class ExecutorLoaderTest(TestCase):
+    def setUp(self):
+        mommy.make(School, school_id=1)
+        mommy.make(School, school_id=2)
+        mommy.make(School, school_id=3)
+
+    def assert_loaded(self, loader):
+        self.assertEqual(loader.req_count, 3)
+        self.assertEqual(loader.error_count, 1)
+        self.assertEqual(School.objects.get(department_scraped=False).school_id, 3)
+        self.assertEqual(Department.objects.count(), 4)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_load_thread(self, mocked_get):
+        loader = ExecutorLoader(fetcher=DepartmentFetcher(), saver=DepartmentSaver(), concurrent=2)
+        loader.load()
+        self.assert_loaded(loader)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_load_process(self, mocked_get):
+        loader = ExecutorLoader(fetcher=DepartmentFetcher(), saver=DepartmentSaver(), concurrent=2, backend='process')
+        loader.load()
+        self.assert_loaded(loader)
+
+    def test_max_req_count(self):
+        loader = ExecutorLoader(fetcher=DepartmentFetcher(), saver=DepartmentSaver(), concurrent=1)
+        with mock.patch('requests.get', side_effect=mocked_requests_get):
+            loader.load(max_req_count=2)
+        self.assertEqual(loader.req_count, 2)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, ExecutorLoader, DepartmentFetcher(), DepartmentSaver(), backend='fiber')
+
+    def test_process_policies(self):
+        # children would get their own copies of shared policies
+        for fetcher in (DepartmentFetcher(rate_limiter=RateLimiter(5)), DepartmentFetcher(retry_policy=RetryPolicy())):
+            with self.assertRaises(ValueError):
+                ExecutorLoader(fetcher, DepartmentSaver(), backend='process')
+            ExecutorLoader(fetcher, DepartmentSaver(), backend='thread')
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_process_costs(self, mocked_get):
+        tracker = CostTracker(DepartmentFetcher.stage)
+        loader = ExecutorLoader(DepartmentFetcher(cost_tracker=tracker), DepartmentSaver(), backend='process')
+        loader.load(max_req_count=None, deadline=60)
+        self.assert_loaded(loader)
+        self.assertEqual(sorted(tracker.measured), [1, 2])
+        self.assertIsNotNone(loader.budget.request_seconds)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_executor_failure(self, mocked_get):
+        queue = TaskQueue(DepartmentFetcher.stage)
+        fetcher = DepartmentFetcher(task_queue=queue)
+        fetcher.enqueue_tasks()
+        fetch = fetcher.fetch
+
+        def broken_fetch(url):
+            if url.id_to_update == 1:
+                raise RuntimeError('broken worker')
+            return fetch(url)
+
+        loader = ExecutorLoader(fetcher, DepartmentSaver(task_queue=queue), concurrent=2)
+        with mock.patch.object(fetcher, 'fetch', side_effect=broken_fetch):
+            loader.load(max_req_count=None)
+        self.assertEqual((loader.req_count, loader.error_count), (3, 2))
+        # url of failed future is passed to saver, which records failure of its task
+        self.assertEqual(queue.get_stats(), {ScrapeTask.DONE: 1, ScrapeTask.CLAIMED: 2})
+        self.assertEqual(ScrapeTask.objects.get(target_id=1).last_error, "RuntimeError('broken worker')")
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(os.path.join(self.tmp_dir.name, 'responses.sqlite3'))
+        self.body = json.dumps({'result': {'Department': DEPARTMENT_RESPONSE_DICT}}).encode('utf-8')
+
+        class TestCachedUrl(CachedUrl):
+            session_pool = SessionPool()
+            response_cache = self.cache
+
+        class TestAsyncCachedUrl(AsyncCachedUrl):
+            response_cache = self.cache
+
+        self.url_class = TestCachedUrl
+        self.async_url_class = TestAsyncCachedUrl
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def make_response(self, status_code, body=b'', headers=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = body
+        response._content_consumed = True
+        response.headers.update(headers or {})
+        return response
+
+    def test_store_and_revalidate(self):
+        url = 'http://t.com/dep'
+        with mock.patch('requests.Session.get', return_value=self.make_response(200, self.body, {'ETag': '"v1"'})):
+            data = self.url_class(url).get_response()
+        self.assertIn('Department', data['result'])
+        self.assertEqual(self.cache.get_conditional_headers(self.cache.get(url)), {'If-None-Match': '"v1"'})
+
+        with mock.patch('requests.Session.get', return_value=self.make_response(304)) as mock_get:
+            cached_url = self.url_class(url)
+            self.assertEqual(cached_url.get_response(), data)
+        self.assertEqual(cached_url.response_size, len(self.body))
+        self.assertEqual(mock_get.call_args[1]['headers'], {'If-None-Match': '"v1"'})
+        self.assertEqual(self.cache.revalidated, 1)
+
+    def test_fresh_entry_served_without_request(self):
+        self.cache.max_age = 60
+        self.cache.store('http://t.com/dep', {}, self.body)
+        with mock.patch('requests.Session.get') as mock_get:
+            cached_url = self.url_class('http://t.com/dep')
+            data = cached_url.get_response()
+        self.assertFalse(mock_get.called)
+        self.assertEqual(cached_url.response_size, len(self.body))
+        self.assertEqual(len(data['result']['Department']), 4)
+
+    def test_async_revalidate(self):
+        url = 'http://t.com/dep'
+        self.cache.store(url, {'Last-Modified': 'Mon, 01 Jan 2017 00:00:00 GMT'}, self.body)
+
+        class MockResponse:
+            status = 304
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+            headers = {}
+
+        session = mock.Mock()
+        session.get.return_value = MockResponse()
+        cached_url = self.async_url_class(url, session=session)
+        data = asyncio.get_event_loop().run_until_complete(cached_url.get_response())
+        self.assertEqual(len(data['result']['Department']), 4)
+        self.assertEqual(cached_url.response_size, len(self.body))
+        self.assertEqual(session.get.call_args[1]['headers'], {'If-Modified-Since': 'Mon, 01 Jan 2017 00:00:00 GMT'})
+
+    def test_evict(self):
+        self.cache.store('http://t.com/1', {'ETag': '1'}, self.body)
+        self.cache.store('http://t.com/2', {'ETag': '2'}, self.body)
+        self.cache.get('http://t.com/1')
+        self.cache.max_size = self.cache.size
+        self.cache.store('http://t.com/3', {'ETag': '3'}, self.body)
+        self.assertIsNone(self.cache.get('http://t.com/2'))
+        self.assertIsNotNone(self.cache.get('http://t.com/1'))
+        self.assertIsNotNone(self.cache.get('http://t.com/3'))
+
+
+class AdaptiveLimiterTest(TestCase):
+    def test_aimd(self):
+        algorithm = AIMDLimit(initial=4, min_limit=2, max_limit=5, backoff_ratio=0.5, timeout=1)
+        self.assertEqual(algorithm.update(4, 0.1, False, in_flight=4), 5)
+        self.assertEqual(algorithm.update(5, 0.1, False, in_flight=5), 5)
+        # limit is not utilized
+        self.assertEqual(algorithm.update(4, 0.1, False, in_flight=1), 4)
+        self.assertEqual(algorithm.update(4, 0.1, True, in_flight=4), 2)
+        self.assertEqual(algorithm.update(4, 2, False, in_flight=4), 2)
+        self.assertEqual(algorithm.update(2, 0.1, True, in_flight=2), 2)
+
+    def test_gradient(self):
+        algorithm = GradientLimit(initial=10, max_limit=50)
+        limit = 10
+        for i in range(20):
+            limit = algorithm.update(limit, 0.1, False, in_flight=int(limit))
+        self.assertGreater(limit, 10)
+        grown = limit
+        for i in range(20):
+            limit = algorithm.update(limit, 1, False, in_flight=int(limit))
+        self.assertLess(limit, grown)
+
+    def test_acquire_release(self):
+        limiter = AdaptiveLimiter(AIMDLimit(initial=2, max_limit=3, backoff_ratio=0.5))
+        start = limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(limiter.in_flight, 2)
+        acquired = threading.Event()
+        t = threading.Thread(target=lambda: limiter.acquire() and acquired.set())
+        t.start()
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release(start)
+        t.join()
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(limiter.get_limit(), 3)
+        limiter.release(start, error=True)
+        self.assertEqual(limiter.get_limit(), 1)
+        self.assertEqual([limit for _, limit in limiter.history], [2, 3, 1])
+        self.assertEqual(limiter.get_stats(), {'limit': 1, 'min': 1, 'max': 3, 'changes': 2})
+
+    def test_release_on_exception(self):
+        limiter = AdaptiveLimiter(AIMDLimit(initial=2, max_limit=3))
+        loader = ThreadedLoader(fetcher=DepartmentFetcher(), saver=DepartmentSaver(), limiter=limiter)
+        with mock.patch.object(loader.fetcher, 'fetch', side_effect=RuntimeError('broken')):
+            with self.assertRaises(RuntimeError):
+                loader.fetch(loader.fetcher.make_target_url(1))
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_async_loader(self):
+        mommy.make(School, school_id=1)
+        mommy.make(School, school_id=2)
+        limiter = AsyncAdaptiveLimiter(AIMDLimit(initial=1, max_limit=4))
+
+        async def request(url, session):
+            return mocked_requests_get(url.url_string).json()
+
+        loader = AsyncLoader(fetcher=DepartmentFetcher(url_class=AsyncUrl), saver=DepartmentSaver(), limiter=limiter)
+        with mock.patch.object(AsyncUrl, 'request', new=request):
+            loader.load()
+        self.assertEqual(loader.req_count, 2)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(Department.objects.count(), 4)
+
+
+class RateLimiterTest(TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+        bucket.pause(5)
+        self.assertAlmostEqual(bucket.reserve(), 5, places=2)
+
+    def test_bucket_per_host(self):
+        limiter = RateLimiter(rate=1, burst=1)
+        bucket = limiter.get_bucket('https://www.myedu.com/adms/school/')
+        self.assertIs(limiter.get_bucket('https://www.myedu.com/adms/department/1/course/'), bucket)
+        self.assertIsNot(limiter.get_bucket('http://t.com/t'), bucket)
+
+    def test_update_from_headers(self):
+        limiter = RateLimiter(rate=10, burst=1, adapt_to_headers=True)
+        url_string = 'http://t.com/t'
+        limiter.update_from_headers(url_string, 200, {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': '5'})
+        self.assertEqual(limiter.get_bucket(url_string).rate, 2)
+        limiter.update_from_headers(url_string, 429, {})
+        self.assertEqual(limiter.get_bucket(url_string).rate, 1)
+        limiter.update_from_headers(url_string, 429, {'Retry-After': '3'})
+        self.assertGreater(limiter.get_bucket(url_string).reserve(), 2)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_fetch_throttled(self, mock_get):
+        limiter = mock.Mock(spec=RateLimiter)
+        fetcher = DepartmentFetcher(rate_limiter=limiter)
+        url = fetcher.fetch(Url('https://www.myedu.com/adms/school/1/department/'))
+        limiter.acquire.assert_called_once_with(url.url_string)
+        limiter.update_from_headers.assert_called_once_with(url.url_string, 200, {})
+        self.assertIsNone(DepartmentFetcher.rate_limiter)
+
+
+class RetryPolicyTest(TestCase):
+    def setUp(self):
+        mommy.make(School, school_id=1)
+        mommy.make(School, school_id=3)
+
+    def test_classify_error(self):
+        self.assertEqual(classify_error(requests.ConnectionError()), CONNECT_ERROR)
+        self.assertEqual(classify_error(requests.HTTPError(), 503), SERVER_ERROR)
+        self.assertEqual(classify_error(requests.HTTPError(), 404), CLIENT_ERROR)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        url_string = 'http://t.com/t'
+        breaker.on_failure(url_string)
+        self.assertEqual(breaker.get_wait(url_string), 0)
+        breaker.on_failure(url_string)
+        self.assertEqual(breaker.get_state(url_string), CircuitBreaker.OPEN)
+        self.assertGreater(breaker.get_wait(url_string), 0)
+        threading.Event().wait(0.06)
+        # single probe is allowed in half open state
+        self.assertEqual(breaker.get_wait(url_string), 0)
+        self.assertEqual(breaker.get_state(url_string), CircuitBreaker.HALF_OPEN)
+        self.assertEqual(breaker.get_wait(url_string), CircuitBreaker.probe_interval)
+        breaker.on_success(url_string)
+        self.assertEqual(breaker.get_state(url_string), CircuitBreaker.CLOSED)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_load_retries(self, mock_get):
+        policy = RetryPolicy(max_attempts=3, base_delay=0.01)
+        loader = Loader(fetcher=DepartmentFetcher(retry_policy=policy), saver=DepartmentSaver())
+        loader.load()
+        error_url = 'https://www.myedu.com/adms/school/3/department/'
+        self.assertEqual([c[0][0] for c in mock_get.call_args_list].count(error_url), 3)
+        self.assertEqual(policy.retry_count, 2)
+        self.assertEqual(loader.req_count, 2)
+        self.assertEqual(loader.error_count, 1)
+        self.assertEqual(Department.objects.count(), 4)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_client_error_not_retried(self, mock_get):
+        policy = RetryPolicy(max_attempts=3, base_delay=0.01)
+        fetcher = DepartmentFetcher(retry_policy=policy)
+        url = fetcher.fetch(Url('http://t.com/404'))
+        self.assertFalse(url.deferred)
+        self.assertTrue(url.error)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_client_error_on_probe(self, mock_get):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        fetcher = DepartmentFetcher(retry_policy=RetryPolicy(max_attempts=1, breaker=breaker))
+        breaker.on_failure('http://t.com/t')
+        threading.Event().wait(0.02)
+        # probe of half open circuit gets 404, host is alive and circuit closes
+        url = fetcher.fetch(Url('http://t.com/404'))
+        self.assertTrue(url.error)
+        self.assertEqual(breaker.get_state('http://t.com/t'), CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.get_wait('http://t.com/t'), 0)
+        self.assertFalse(fetcher.fetch(Url('http://t.com/t')).deferred)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_open_circuit_defers(self, mock_get):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        fetcher = DepartmentFetcher(retry_policy=RetryPolicy(max_attempts=1, breaker=breaker))
+        url = fetcher.fetch(Url('https://www.myedu.com/adms/school/3/department/'))
+        self.assertTrue(url.error)
+        url = fetcher.fetch(Url('https://www.myedu.com/adms/school/1/department/'))
+        self.assertTrue(url.deferred)
+        self.assertEqual(url.attempts, 0)
+        self.assertEqual(mock_get.call_count, 1)
+
+
+class JsonStreamExtractorTest(TestCase):
+    def extract(self, data, key, chunk_size, capture=()):
+        body = json.dumps(data).encode('utf-8')
+        extractor = JsonStreamExtractor(key, capture=capture)
+        objs = []
+        for i in range(0, len(body), chunk_size):
+            objs.extend(extractor.feed(body[i:i + chunk_size]))
+        objs.extend(extractor.close())
+        return objs, extractor.captured
+
+    def test_extract(self):
+        data = {
+            'status': 200,
+            'pagination': PAGINATION_DICT,
+            'result': {'Other': {'1': {'a': 1}}, 'Department': DEPARTMENT_RESPONSE_DICT},
+            'tail': [1.5, 'x}', {'y': None}],
+        }
+        expected = list(json.loads(json.dumps(DEPARTMENT_RESPONSE_DICT)).values())
+        for chunk_size in (1, 7, 64 * 1024):
+            objs, captured = self.extract(data, 'result.Department', chunk_size, capture=('pagination',))
+            self.assertEqual(objs, expected)
+            self.assertEqual(captured, {'pagination': PAGINATION_DICT})
+
+    def test_extract_empty(self):
+        self.assertEqual(self.extract({'result': []}, 'result.Department', 3), ([], {}))
+        self.assertEqual(self.extract({'result': {'Department': []}}, 'result.Department', 3), ([], {}))
+        self.assertEqual(self.extract([], 'result.Department', 3), ([], {}))
+
+    def test_incomplete(self):
+        extractor = JsonStreamExtractor('result.Department')
+        extractor.feed(b'{"result": {"Department": {"1": {"a": 1}')
+        self.assertRaises(ValueError, extractor.close)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_fetch_stream(self, mock_get):
+        fetcher = DepartmentFetcher(stream=True)
+        url = fetcher.fetch(Url('https://www.myedu.com/adms/school/1/department/', id_to_update=1))
+        self.assertFalse(url.error)
+        self.assertTrue(mock_get.call_args[1]['stream'])
+        self.assertEqual(len(url.fetched_dicts), 4)
+        self.assertEqual(url.fetched_dicts[0]['source_url'], url.url_string)
+
+        url = fetcher.fetch(Url('http://t.com/404'))
+        self.assertTrue(url.error)
+        self.assertEqual(url.fetched_dicts, [])
+
+
+class JsonDecoderTest(TestCase):
+    def test_get_decoder(self):
+        self.assertEqual(get_decoder().name, get_decoder_names()[0])
+        self.assertIsInstance(get_decoder('json'), JsonDecoder)
+        self.assertRaises(ValueError, get_decoder, 'unknown')
+        with mock.patch('scraper.utils.orjson', None), mock.patch('scraper.utils.ujson', None):
+            self.assertEqual(get_decoder_names(), ['json'])
+            self.assertEqual(get_decoder().name, 'json')
+            self.assertRaises(ValueError, get_decoder, 'orjson')
+
+    def test_loads(self):
+        data = {'result': {'Department': {str(k): v for k, v in DEPARTMENT_RESPONSE_DICT.items()}}}
+        body = json.dumps(data).encode('utf-8')
+        for name in get_decoder_names():
+            self.assertEqual(get_decoder(name).loads(body), data)
+            self.assertRaises(ValueError, get_decoder(name).loads, body[:-1])
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_fetcher_decoder(self, mock_get):
+        decoder = mock.Mock(wraps=JsonDecoder())
+        fetcher = DepartmentFetcher(decoder=decoder)
+        url = fetcher.fetch(fetcher.make_url('https://www.myedu.com/adms/school/1/department/', id_to_update=1))
+        self.assertEqual(len(url.fetched_dicts), 4)
+        self.assertEqual(decoder.loads.call_count, 1)
+        self.assertIsInstance(decoder.loads.call_args[0][0], bytes)
+        self.assertIsNot(Url.decoder, decoder)
+
+
+class HedgePolicyTest(TestCase):
+    url_string = 'https://www.myedu.com/adms/school/1/department/'
+
+    def make_policy(self, **kwargs):
+        policy = HedgePolicy(min_timeout=0.5, max_timeout=5, min_samples=10, **kwargs)
+        for _ in range(10):
+            policy.record('DepartmentFetcher', 0.05)
+        return policy
+
+    def test_latency_tracker(self):
+        tracker = LatencyTracker(window=100, min_samples=10)
+        for i in range(1, 10):
+            tracker.record('a', i / 100)
+        self.assertIsNone(tracker.get_percentile('a', 95))
+        for i in range(10, 201):
+            tracker.record('a', i / 100)
+        # only last 100 samples are kept
+        self.assertEqual(tracker.get_percentile('a', 95), 1.95)
+        self.assertEqual(tracker.get_percentile('a', 50), 1.5)
+        self.assertIsNone(tracker.get_percentile('b', 50))
+
+    def test_timeout_and_budget(self):
+        policy = HedgePolicy(budget=0.05, min_timeout=1, max_timeout=5, min_samples=10)
+        self.assertEqual(policy.get_timeout('a'), 5)
+        for _ in range(10):
+            policy.record('a', 0.1)
+        self.assertEqual(policy.get_timeout('a'), 1)
+        policy.record('a', 1.5)
+        self.assertEqual(policy.get_timeout('a'), 4.5)
+
+        for _ in range(40):
+            policy.on_request()
+        self.assertTrue(policy.acquire_hedge())
+        self.assertTrue(policy.acquire_hedge())
+        self.assertFalse(policy.acquire_hedge())
+
+    def test_session_url_timeout(self):
+        url = SessionUrl('http://t.com/t')
+        self.assertEqual(url.get_timeout(), SessionUrl.session_pool.timeout)
+        url.timeout = 2
+        self.assertEqual(url.get_timeout(), (SessionUrl.session_pool.connect_timeout, 2))
+
+    def test_fetch_hedged(self):
+        policy = self.make_policy(budget=1)
+        calls = []
+
+        def slow_first(*args, **kwargs):
+            calls.append(kwargs['timeout'])
+            if len(calls) == 1:
+                threading.Event().wait(0.5)
+            return mocked_requests_get(*args, **kwargs)
+
+        tracker = CostTracker(DepartmentFetcher.stage)
+        fetcher = DepartmentFetcher(hedge_policy=policy, cost_tracker=tracker)
+        with mock.patch('requests.get', side_effect=slow_first):
+            url = fetcher.fetch(Url(self.url_string, id_to_update=1))
+        self.assertFalse(url.error)
+        self.assertEqual(len(url.fetched_dicts), 4)
+        self.assertEqual(url.status_code, 200)
+        # size of response of winning request is recorded with cost
+        self.assertGreater(url.response_size, 0)
+        self.assertEqual(tracker.measured[1][3], url.response_size)
+        self.assertEqual(calls, [0.5, 0.5])
+        self.assertEqual(policy.get_stats()['hedges'], 1)
+        self.assertEqual(policy.get_stats()['hedge_wins'], 1)
+        policy.close()
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_fetch_hedge_budget(self, mock_get):
+        policy = self.make_policy(budget=0)
+        fetcher = DepartmentFetcher(hedge_policy=policy)
+        url = fetcher.fetch(Url('https://www.myedu.com/adms/school/3/department/'))
+        self.assertTrue(url.error)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(policy.get_stats()['hedges'], 0)
+        policy.close()
+
+    def test_async_fetch_hedged(self):
+        policy = self.make_policy(budget=1)
+        cancelled = []
+
+        async def request(url, session):
+            if not cancelled:
+                cancelled.append(False)
+                try:
+                    await asyncio.sleep(1)
+                except asyncio.CancelledError:
+                    cancelled[0] = True
+                    raise
+            url.status_code = 200
+            return mocked_requests_get(url.url_string).json()
+
+        fetcher = DepartmentFetcher(url_class=AsyncUrl, hedge_policy=policy)
+        url = AsyncUrl(self.url_string, id_to_update=1, session=mock.Mock())
+        with mock.patch.object(AsyncUrl, 'request', new=request):
+            asyncio.get_event_loop().run_until_complete(fetcher.async_fetch(url))
+        self.assertFalse(url.error)
+        self.assertEqual(len(url.fetched_dicts), 4)
+        self.assertEqual(cancelled, [True])
+        self.assertEqual(policy.get_stats()['hedge_wins'], 1)
+
+
+class FlushPolicyTest(TestCase):
+    def setUp(self):
+        mommy.make(School, school_id=2)
+        self.furl = Url('test', id_to_update=2)
+        self.furl.append_fetched_dicts(objs=DEPARTMENT_RESPONSE_DICT)
+
+    def test_should_flush(self):
+        policy = FlushPolicy(max_urls=10, max_rows=100, max_bytes=1000, max_interval=5)
+        self.assertFalse(policy.should_flush(urls=1, rows=1, size=1, elapsed=0))
+        self.assertTrue(policy.should_flush(urls=10, rows=1, size=1, elapsed=0))
+        self.assertTrue(policy.should_flush(urls=1, rows=100, size=1, elapsed=0))
+        self.assertTrue(policy.should_flush(urls=1, rows=1, size=1000, elapsed=0))
+        self.assertTrue(policy.should_flush(urls=1, rows=1, size=1, elapsed=5))
+        self.assertFalse(FlushPolicy().should_flush(urls=100, rows=100, size=100, elapsed=100))
+
+    def test_saver_flush_on_rows(self):
+        saver = DepartmentSaver(save_count=10, flush_policy=FlushPolicy(max_rows=4))
+        saver.append(fetched_url=self.furl)
+        self.assertFalse(saver.save_list)
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertTrue(School.objects.get(school_id=2).department_scraped)
+
+    def test_saver_flush_on_bytes(self):
+        saver = DepartmentSaver(flush_policy=FlushPolicy(max_bytes=10 ** 6))
+        saver.append(fetched_url=self.furl)
+        self.assertEqual(len(saver.save_list), 4)
+        self.assertGreater(saver.buffer_size, 0)
+        saver.flush_policy.max_bytes = saver.buffer_size * 2
+        saver.append(fetched_url=self.furl)
+        # the same departments again are left as they are
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertEqual(saver.skipped_count, 4)
+        self.assertEqual(saver.buffer_size, 0)
+
+    def test_saver_flush_on_interval(self):
+        saver = DepartmentSaver(flush_policy=FlushPolicy(max_interval=60))
+        saver.append(fetched_url=self.furl)
+        self.assertEqual(len(saver.save_list), 4)
+        saver.flushed_at -= 60
+        saver.append(fetched_url=self.furl)
+        self.assertFalse(saver.save_list)
+
+    def test_adaptive(self):
+        policy = AdaptiveFlushPolicy(initial_rows=1000, min_rows=500, max_rows=3000, step=2)
+        policy.on_flush(1000, 1.0)
+        self.assertEqual(policy.max_rows, 2000)
+        # cheaper per row, keeps growing up to bound
+        policy.on_flush(2000, 1.5)
+        self.assertEqual(policy.max_rows, 3000)
+        # worse per row, goes back
+        policy.on_flush(3000, 3.0)
+        self.assertEqual(policy.max_rows, 1500)
+        # partial batch is not measured
+        policy.on_flush(10, 1.0)
+        self.assertEqual(policy.max_rows, 1500)
+        self.assertEqual(len(policy.history), 3)
+
+    def test_adaptive_saver(self):
+        policy = AdaptiveFlushPolicy(initial_rows=4, min_rows=1, step=2)
+        saver = DepartmentSaver(flush_policy=policy)
+        saver.append(fetched_url=self.furl)
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertEqual(policy.max_rows, 8)
+
+
+class BackgroundSaverTest(TransactionTestCase):
+    def make_url(self, school_id):
+        url = Url('test', id_to_update=school_id)
+        url.append_fetched_dicts(objs={k: dict(v) for k, v in DEPARTMENT_RESPONSE_DICT.items()})
+        return url
+
+    def test_update_db(self):
+        for school_id in range(3):
+            mommy.make(School, school_id=school_id)
+        saver = BackgroundSaver(DepartmentSaver(save_count=1), max_pending=2)
+        for school_id in range(3):
+            saver.append(fetched_url=self.make_url(school_id))
+        saver.update_db()
+        self.assertIsNone(saver.executor)
+        self.assertFalse(saver.in_flight)
+        # every school got the same departments, they are written once
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertEqual(saver.saver.skipped_count, 8)
+        self.assertFalse(School.objects.filter(department_scraped=False).exists())
+
+    def test_backpressure(self):
+        written = threading.Event()
+        release = threading.Event()
+
+        class SlowSaver(DepartmentSaver):
+            def write_batch(self, save_list, success_ids, failed_tasks=()):
+                release.wait(5)
+                written.set()
+
+        saver = BackgroundSaver(SlowSaver(save_count=1), max_pending=1)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(saver.async_append(self.make_url(1)))
+        self.assertEqual(len(saver.in_flight), 1)
+        # buffer is filled again while writer is busy
+        saver.saver.add(self.make_url(2))
+        self.assertTrue(saver.is_behind())
+        self.assertRaises(asyncio.TimeoutError, loop.run_until_complete, asyncio.wait_for(saver.async_wait(), 0.05))
+        release.set()
+        loop.run_until_complete(asyncio.wait_for(saver.async_wait(), 5))
+        self.assertTrue(written.is_set())
+        self.assertFalse(saver.is_behind())
+        saver.update_db()
+
+    def test_async_loader(self):
+        mommy.make(School, school_id=1)
+        mommy.make(School, school_id=2)
+
+        async def request(url, session):
+            return mocked_requests_get(url.url_string).json()
+
+        saver = BackgroundSaver(DepartmentSaver(save_count=1))
+        loader = AsyncLoader(fetcher=DepartmentFetcher(url_class=AsyncUrl), saver=saver)
+        with mock.patch.object(AsyncUrl, 'request', new=request):
+            loader.load()
+        self.assertEqual(loader.req_count, 2)
+        self.assertEqual(Department.objects.count(), 4)
+
+
+class UpsertSaverTest(TestCase):
+    def setUp(self):
+        mommy.make(School, school_id=2)
+
+    def load(self, **kwargs):
+        return save_departments(make_department_url(), make_department_url(1000), upsert=True, **kwargs)
+
+    def test_repeated_load(self):
+        saver = self.load()
+        self.assertEqual(Department.objects.count(), 8)
+        self.assertEqual(saver.skipped_count, 0)
+        # keys of the first load are taken from table
+        saver = self.load()
+        self.assertEqual(Department.objects.count(), 8)
+        self.assertEqual(saver.skipped_count, 8)
+        self.assertEqual(len(saver.key_filter), 8)
+
+    def test_duplicates_in_batch(self):
+        saver = DepartmentSaver(save_count=10, upsert=True)
+        saver.append(fetched_url=make_department_url())
+        saver.append(fetched_url=make_department_url())
+        saver.update_db()
+        self.assertEqual(Department.objects.count(), 4)
+        # keys saved by this saver are skipped without db
+        with self.assertNumQueries(3):
+            saver.append(fetched_url=make_department_url())
+            saver.update_db()
+        self.assertEqual(saver.skipped_count, 4)
+
+    def test_update_existing(self):
+        self.load()
+        url = make_department_url()
+        for obj in url.fetched_dicts:
+            obj['name'] = 'Renamed'
+        saver = DepartmentSaver(save_count=10, upsert=True, update_existing=True)
+        saver.append(fetched_url=url)
+        saver.update_db()
+        self.assertEqual(Department.objects.count(), 8)
+        self.assertEqual(Department.objects.filter(name='Renamed').count(), 4)
+
+    def test_bloom_filter(self):
+        self.load()
+        saver = self.load(key_filter=BloomFilter(capacity=100))
+        self.assertEqual(Department.objects.count(), 8)
+        self.assertEqual(saver.skipped_count, 8)
+
+    def test_fallback(self):
+        with mock.patch('scraper.db.supports_on_conflict', return_value=False):
+            self.load()
+            self.load(update_existing=True)
+        self.assertEqual(Department.objects.count(), 8)
+
+    def test_composite_key(self):
+        self.load()
+        # the same departments under other school are other objects
+        url = make_department_url()
+        for obj in url.fetched_dicts:
+            obj['school_id'] = 3
+        saver = self.load(key_filter=BloomFilter(capacity=100))
+        saver.append(fetched_url=url)
+        saver.update_db()
+        self.assertEqual(Department.objects.count(), 12)
+        self.assertEqual(saver.skipped_count, 8)
+        self.assertTrue(saver.key_filter.might_contain((url.fetched_dicts[0]['department_id'], 3)))
+
+    def test_plain_save_of_repeated_url(self):
+        saver = DepartmentSaver(save_count=10)
+        saver.append(fetched_url=make_department_url())
+        saver.update_db()
+        saver.append(fetched_url=make_department_url())
+        saver.append(fetched_url=make_department_url(1000))
+        saver.update_db()
+        self.assertEqual(Department.objects.count(), 8)
+        self.assertEqual(saver.skipped_count, 4)
+        with mock.patch('scraper.db.supports_on_conflict', return_value=False):
+            saver.append(fetched_url=make_department_url())
+            saver.append(fetched_url=make_department_url())
+            saver.update_db()
+        self.assertEqual(Department.objects.count(), 8)
+
+    def test_key_filters(self):
+        key_set = KeySet()
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for key in range(1000):
+            key_set.add(key)
+            bloom.add(key)
+        self.assertTrue(all(bloom.might_contain(key) for key in range(1000)))
+        false_positives = sum(bloom.might_contain(key) for key in range(1000, 11000))
+        self.assertLess(false_positives, 300)
+        self.assertFalse(key_set.might_contain(1000))
+
+    def test_build_upsert_sql(self):
+        connection = mock.Mock(vendor='postgresql')
+        connection.ops.quote_name = lambda name: '"{}"'.format(name)
+        fields = [Department._meta.get_field('department_id'), Department._meta.get_field('name')]
+        key = ('department_id', 'school_id')
+        sql = build_upsert_sql(connection, Department, fields, 2, key, update=True)
+        self.assertEqual(
+            sql,
+            'INSERT INTO "scraper_department" ("department_id", "name") VALUES (%s, %s), (%s, %s) '
+            'ON CONFLICT ("department_id", "school_id") DO UPDATE SET "name" = excluded."name"'
+        )
+        connection.vendor = 'mysql'
+        sql = build_upsert_sql(connection, Department, fields, 1, key, update=False)
+        self.assertEqual(sql, 'INSERT IGNORE INTO "scraper_department" ("department_id", "name") VALUES (%s, %s)')
+
+
+class RawSaverTest(TestCase):
+    def setUp(self):
+        mommy.make(School, school_id=2)
+
+    def get_rows(self):
+        names = [field.attname for field in get_insert_fields(Department)]
+        return list(Department.objects.order_by('department_id').values_list(*names))
+
+    def test_rows_match_orm(self):
+        url = make_department_url()
+        # values that orm converts on save
+        url.fetched_dicts[0]['UID'] = '24542'
+        url.fetched_dicts[1]['name'] = 17
+        url.fetched_dicts[2].pop('abbreviation')
+        save_departments(url)
+        orm_rows = self.get_rows()
+        Department.objects.all().delete()
+        save_departments(url, raw=True)
+        self.assertEqual(self.get_rows(), orm_rows)
+        self.assertTrue(School.objects.get(school_id=2).department_scraped)
+
+    def test_projection(self):
+        projection = ColumnProjection.for_model(Department)
+        self.assertIs(ColumnProjection.for_model(Department), projection)
+        row = projection.to_row({'department_id': '5', 'name': 'Name', 'unexpected': 1})
+        self.assertEqual(len(row), len(projection.fields))
+        self.assertEqual(row[projection.get_position('department_id')], 5)
+        self.assertEqual(row[projection.get_position('source_url')], '')
+        self.assertIn('unexpected', projection.unknown_keys)
+
+    def test_unknown_keys(self):
+        url = make_department_url()
+        for obj in url.fetched_dicts:
+            obj['unexpected'] = 1
+        with self.assertRaises(TypeError):
+            save_departments(url)
+        saver = save_departments(url, raw=True)
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertEqual(saver.reported_keys, {'unexpected'})
+
+    def test_upsert(self):
+        save_departments(make_department_url(), make_department_url(1000), raw=True, upsert=True)
+        saver = save_departments(make_department_url(), make_department_url(), raw=True, upsert=True)
+        self.assertEqual(Department.objects.count(), 8)
+        self.assertEqual(saver.skipped_count, 4)
+        url = make_department_url()
+        for obj in url.fetched_dicts:
+            obj['name'] = 'Renamed'
+        save_departments(url, raw=True, upsert=True, update_existing=True)
+        self.assertEqual(Department.objects.filter(name='Renamed').count(), 4)
+        with mock.patch('scraper.db.supports_on_conflict', return_value=False):
+            save_departments(make_department_url(2000), make_department_url(), raw=True, upsert=True)
+        self.assertEqual(Department.objects.count(), 12)
+
+
+class MarkRowsTest(TestCase):
+    def setUp(self):
+        Department.objects.bulk_create([Department(UID=i, school_id=2, department_id=i) for i in range(1200)])
+
+    def test_key_table(self):
+        # duplicates and keys without rows are harmless
+        keys = list(range(0, 1200, 2)) + [0, 2, 5000]
+        self.assertEqual(mark_rows(Department, 'department_id', keys, {'course_scraped': True}), 600)
+        self.assertEqual(Department.objects.filter(course_scraped=True).count(), 600)
+        self.assertFalse(Department.objects.filter(course_scraped=True, department_id=1).exists())
+        # table is emptied, so the next update sees only its own keys
+        self.assertEqual(mark_rows(Department, 'department_id', list(range(600)), {'professor_scraped': True}), 600)
+        self.assertEqual(Department.objects.filter(professor_scraped=True, course_scraped=False).count(), 300)
+
+    def test_key_table_after_error(self):
+        with self.assertRaises(DatabaseError):
+            mark_rows(Department, 'department_id', list(range(600)), {'course_scraped': None})
+        # keys of failed update are not marked by the next one
+        self.assertEqual(mark_rows(Department, 'department_id', list(range(600, 1200)), {'course_scraped': True}), 600)
+        self.assertFalse(Department.objects.filter(course_scraped=True, department_id__lt=600).exists())
+
+    def test_in_statement(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(mark_rows(Department, 'department_id', [1, 2, 3], {'course_scraped': True}), 3)
+        with mock.patch('scraper.db.get_connection', return_value=mock.Mock(vendor='mysql')):
+            with self.assertNumQueries(3):
+                mark_rows(Department, 'department_id', list(range(1200)), {'course_scraped': True}, chunk_size=500)
+        self.assertEqual(Department.objects.filter(course_scraped=True).count(), 1200)
+
+
+class TaskQueueTest(TestCase):
+    def setUp(self):
+        for school_id in (1, 2, 3):
+            mommy.make(School, school_id=school_id)
+
+    def make_queue(self, **kwargs):
+        return TaskQueue(DepartmentFetcher.stage, **kwargs)
+
+    def test_claim(self):
+        queue = self.make_queue()
+        self.assertEqual(DepartmentFetcher(task_queue=queue).enqueue_tasks(), 3)
+        self.assertEqual(queue.enqueue([1, 2, 3, 4]), 1)
+        first = queue.claim(2)
+        second = self.make_queue().claim()
+        self.assertEqual(len(first), 2)
+        self.assertEqual(sorted(first + second), [1, 2, 3, 4])
+        self.assertEqual(self.make_queue().claim(), [])
+        self.assertEqual(queue.get_stats(), {ScrapeTask.CLAIMED: 4})
+
+    def test_lease_expiry(self):
+        queue = self.make_queue(lease_seconds=-1, max_attempts=2)
+        queue.enqueue([1])
+        self.assertEqual(queue.claim(), [1])
+        # lease of crashed owner has expired
+        self.assertEqual(self.make_queue().claim(), [1])
+        self.assertEqual(ScrapeTask.objects.get().attempts, 2)
+        self.assertEqual(self.make_queue().claim(), [])
+
+    def test_complete_and_fail(self):
+        queue = self.make_queue(max_attempts=2)
+        queue.enqueue([1, 2])
+        queue.claim()
+        queue.complete([1])
+        queue.fail(2, 'error')
+        self.assertEqual(queue.get_stats(), {ScrapeTask.DONE: 1, ScrapeTask.CLAIMED: 1})
+        self.assertEqual(queue.claim(), [])
+        ScrapeTask.objects.filter(target_id=2).update(lease_expires=timezone.now())
+        self.assertEqual(queue.claim(), [2])
+        queue.fail(2, 'error')
+        task = ScrapeTask.objects.get(target_id=2)
+        self.assertEqual((task.status, task.last_error, task.lease_owner), (ScrapeTask.FAILED, 'error', None))
+
+    def test_release_on_close(self):
+        queue = self.make_queue(batch_size=3)
+        queue.enqueue([1, 2, 3])
+        targets = queue.iter_claimed()
+        self.assertEqual(next(targets), 1)
+        targets.close()
+        self.assertEqual(queue.get_stats(), {ScrapeTask.CLAIMED: 1, ScrapeTask.PENDING: 2})
+        self.assertEqual(ScrapeTask.objects.filter(attempts=0).count(), 2)
+
+        # urls of fetcher release their targets on close, even while claimed targets are referenced elsewhere
+        ScrapeTask.objects.all().delete()
+        queue.enqueue([1, 2, 3])
+        targets = queue.iter_claimed()
+        with mock.patch.object(queue, 'iter_claimed', return_value=targets):
+            urls = DepartmentFetcher(task_queue=queue).get_urls()
+            self.assertEqual(next(urls).id_to_update, 1)
+            urls.close()
+        self.assertEqual(queue.get_stats(), {ScrapeTask.CLAIMED: 1, ScrapeTask.PENDING: 2})
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_load(self, mock_get):
+        queue = self.make_queue()
+        fetcher = DepartmentFetcher(task_queue=queue)
+        fetcher.enqueue_tasks()
+        Loader(fetcher=fetcher, saver=DepartmentSaver(task_queue=queue)).load()
+        self.assertEqual(queue.get_stats(), {ScrapeTask.DONE: 2, ScrapeTask.CLAIMED: 1})
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertIn('ConnectionError', ScrapeTask.objects.get(target_id=3).last_error)
+        # the other loader gets only the failed school after its lease expires
+        self.assertEqual(list(DepartmentFetcher(task_queue=self.make_queue()).get_urls()), [])
+        ScrapeTask.objects.filter(target_id=3).update(lease_expires=timezone.now())
+        self.assertEqual([url.id_to_update for url in DepartmentFetcher(task_queue=self.make_queue()).get_urls()], [3])
+
+    def test_fail_by_saver(self):
+        queue = self.make_queue()
+        queue.enqueue([3])
+        queue.claim()
+        fetcher = DepartmentFetcher(task_queue=queue)
+        url = fetcher.make_url('test', id_to_update=3)
+        # fetch worker does not touch db
+        with self.assertNumQueries(0):
+            try:
+                raise ConnectionError('refused')
+            except ConnectionError:
+                fetcher.process_response(url, exc_info=sys.exc_info())
+        saver = DepartmentSaver(save_count=10, task_queue=queue)
+        saver.append(fetched_url=url)
+        self.assertEqual(saver.failed_tasks, [(3, "ConnectionError('refused')")])
+        self.assertEqual(ScrapeTask.objects.get().last_error, None)
+        saver.update_db()
+        self.assertEqual(ScrapeTask.objects.get().last_error, "ConnectionError('refused')")
+        self.assertFalse(saver.failed_tasks)
+
+
+def pipeline_get_response(url):
+    """
+    Responses of all stages, every school has four departments with one course and one professor
+    """
+    if '/school/?page=' in url.url_string:
+        return mocked_requests_get(url.url_string).json()
+    school_id = re.search(r'/school/(\d+)/department/', url.url_string)
+    if school_id:
+        return {'result': {'Department': make_department_dicts(int(school_id.group(1)) * 1000)}}
+    department_id, kind = re.search(r'/department/(\d+)/(course|professor)/', url.url_string).groups()
+    obj = {'UID': int(department_id), 'school_id': 1, 'department_id': int(department_id)}
+    if kind == 'course':
+        return {'result': {'Course': {department_id: dict(obj, course_id=int(department_id))}}}
+    return {'result': {'Professor': {department_id: dict(obj, professor_id=int(department_id), grade_count=0)}}}
+
+
+class PipelineTest(TransactionTestCase):
+    def make_pipeline(self):
+        course = PipelineStage('course', CourseFetcher(), CourseSaver(), seed=False)
+        professor = PipelineStage('professor', ProfessorFetcher(), ProfessorSaver(), seed=False)
+        department = PipelineStage(
+            'department', DepartmentFetcher(), DepartmentSaver(), children=[course, professor], seed=False
+        )
+        school = PipelineStage('school', PaginatedFetcher(), SchoolSaver(), children=[department])
+        return Pipeline([school], concurrent=4)
+
+    def test_load(self):
+        pipeline = self.make_pipeline()
+        self.assertEqual([stage.name for stage in pipeline.stages], ['school', 'department', 'course', 'professor'])
+        with mock.patch.object(Url, 'get_response', new=pipeline_get_response):
+            pipeline.load()
+        self.assertEqual(pipeline.req_count, 2 + 10 + 40 + 40)
+        self.assertEqual(pipeline.error_count, 0)
+        self.assertEqual(School.objects.filter(department_scraped=True).count(), 10)
+        self.assertEqual(Department.objects.filter(course_scraped=True, professor_scraped=True).count(), 40)
+        self.assertEqual(Course.objects.count(), 40)
+        self.assertEqual(Professor.objects.count(), 40)
+        stats = {stage.name: stage.get_stats() for stage in pipeline.stages}
+        self.assertEqual(stats['department']['objects'], 40)
+        self.assertEqual(stats['professor']['requests'], 40)
+
+    def test_max_req_count(self):
+        pipeline = self.make_pipeline()
+        with mock.patch.object(Url, 'get_response', side_effect=pipeline_get_response, autospec=True) as get_response:
+            pipeline.load(max_req_count=5)
+        self.assertEqual(pipeline.req_count, 5)
+        # urls are not queued over max request count, so none is dropped after its request is counted
+        self.assertEqual(get_response.call_count, 5)
+        self.assertEqual(pipeline.in_progress, 0)
+
+    def test_max_req_count_seed(self):
+        # seed stops at max request count, targets claimed and not taken are released
+        for school_id in (1, 2, 3):
+            mommy.make(School, school_id=school_id)
+        queue = TaskQueue(DepartmentFetcher.stage)
+        fetcher = DepartmentFetcher(task_queue=queue)
+        fetcher.enqueue_tasks()
+        # saver writes after feed, shared cache of in-memory test db does not wait for lock of concurrent writer
+        saver = DepartmentSaver(save_count=10, task_queue=queue)
+        pipeline = Pipeline([PipelineStage('department', fetcher, saver)], concurrent=2)
+        with mock.patch.object(Url, 'get_response', new=pipeline_get_response):
+            pipeline.load(max_req_count=1)
+        self.assertEqual(queue.get_stats(), {ScrapeTask.DONE: 1, ScrapeTask.PENDING: 2})
+
+    def test_fetch_failure(self):
+        pipeline = self.make_pipeline()
+        pipeline.limiter = AdaptiveLimiter(AIMDLimit(initial=4, max_limit=8))
+        department = pipeline.stages[1]
+        with mock.patch.object(Url, 'get_response', new=pipeline_get_response):
+            with mock.patch.object(department.fetcher, 'fetch', side_effect=RuntimeError('broken')):
+                pipeline.load()
+        # load is not stuck on urls which fetch raised
+        self.assertEqual(pipeline.in_progress, 0)
+        self.assertEqual(pipeline.error_count, 10)
+        self.assertEqual(department.error_count, 10)
+        self.assertEqual(pipeline.limiter.in_flight, 0)
+        self.assertEqual(School.objects.count(), 10)
+
+    def test_failed_urls_saved(self):
+        pipeline = self.make_pipeline()
+        department = pipeline.stages[1]
+
+        def get_response(url):
+            if '/school/2/' in url.url_string:
+                raise requests.exceptions.ConnectionError('refused')
+            return pipeline_get_response(url)
+
+        with mock.patch.object(Url, 'get_response', side_effect=get_response, autospec=True):
+            with mock.patch.object(department.saver, 'append', wraps=department.saver.append) as append:
+                pipeline.load()
+        # failed url reaches saver, so saver with task queue records its failure
+        failed = [c[1]['fetched_url'] for c in append.call_args_list if c[1]['fetched_url'].error]
+        self.assertEqual([url.id_to_update for url in failed], [2])
+        self.assertIn('refused', failed[0].failure)
+        self.assertEqual((pipeline.error_count, department.error_count), (1, 1))
+        self.assertEqual(Department.objects.filter(school_id=2).count(), 0)
+        self.assertEqual(School.objects.filter(department_scraped=False).count(), 1)
+
+    def test_work_queue(self):
+        pipeline = self.make_pipeline()
+        department, course = pipeline.stages[1:3]
+        pipeline.submit(department, department.fetcher.make_target_url(2))
+        pipeline.submit(department, department.fetcher.make_target_url(2))
+        self.assertEqual(pipeline.in_progress, 1)
+        pipeline.submit(course, course.fetcher.make_target_url(3), delay=60)
+        pipeline.submit(course, course.fetcher.make_target_url(4))
+        # deeper stage goes first, deferred url waits
+        self.assertEqual([url.id_to_update for _, url in (pipeline.take(), pipeline.take())], [4, 2])
+        self.assertEqual(len(pipeline.delayed), 1)
+
+
+class BulkLoadProfileTest(TransactionTestCase):
+    def get_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'scraper_course'")
+            return {row[0] for row in cursor.fetchall()}
+
+    def get_pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA {}'.format(name))
+            return cursor.fetchone()[0]
+
+    def test_profile(self):
+        indexes = self.get_indexes()
+        profile = BulkLoadProfile([Course], drop_indexes=True)
+        with profile:
+            # NORMAL
+            self.assertEqual(self.get_pragma('synchronous'), 1)
+            self.assertEqual(self.get_pragma('temp_store'), 2)
+            remaining = self.get_indexes()
+            self.assertLess(len(remaining), len(indexes))
+            # unique index of natural key is kept for upsert
+            self.assertEqual(len(profile.dropped), len(indexes) - len(remaining))
+            self.assertTrue(all('UNIQUE' not in sql.upper() for _, _, sql in profile.dropped))
+        self.assertEqual(self.get_indexes(), indexes)
+        self.assertFalse(profile.dropped)
+
+        # new connections get pragmas only while profile is active
+        new_connection = mock.MagicMock(vendor='sqlite')
+        with profile:
+            connection_created.send(sender=connection.__class__, connection=new_connection)
+            self.assertTrue(new_connection.cursor.called)
+        new_connection.reset_mock()
+        connection_created.send(sender=connection.__class__, connection=new_connection)
+        self.assertFalse(new_connection.cursor.called)
+
+    def test_journal_mode(self):
+        file_connection = mock.MagicMock(vendor='sqlite', alias='file', connection=None)
+        cursor = file_connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = ('delete',)
+        with mock.patch('scraper.db.connections') as db_connections:
+            db_connections.all.return_value = [file_connection]
+            db_connections.__getitem__.return_value = file_connection
+            profile = BulkLoadProfile([])
+            with profile:
+                self.assertEqual(profile.journal_modes, {'file': 'delete'})
+                cursor.execute.reset_mock()
+        cursor.execute.assert_called_once_with('PRAGMA journal_mode = delete')
+        self.assertFalse(profile.journal_modes)
+
+
+class CostTrackerTest(TestCase):
+    def test_order(self):
+        tracker = CostTracker('course')
+        for target_id, seconds in ((1, 0.1), (2, 3.0), (3, 0.5), (4, 0.2)):
+            tracker.record(target_id, seconds)
+        # paginated target costs seconds of the first page times pages
+        tracker.record(5, 0.4, pages=10, object_count=100, response_size=2048)
+        self.assertEqual(tracker.save(), 5)
+        self.assertEqual(TargetCost.objects.get(target_id=5).response_size, 2048)
+        ids = [6, 1, 2, 3, 4, 5]
+        # target without history is expected to cost as median
+        self.assertEqual(tracker.order(ids), [5, 2, 6, 3, 4, 1])
+        self.assertEqual(tracker.order(ids, INTERLEAVE), [5, 1, 2, 4, 6, 3])
+        with self.assertRaises(ValueError):
+            tracker.order(ids, 'random')
+
+        # new measurement replaces old one
+        tracker.record(1, 10.0)
+        tracker.save()
+        self.assertEqual(TargetCost.objects.filter(target_id=1).count(), 1)
+        self.assertEqual(CostTracker('course').order([1, 2]), [1, 2])
+        self.assertEqual(CostTracker('professor').order([1, 2]), [1, 2])
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_fetcher(self, mocked_get):
+        for school_id in (1, 2, 3):
+            mommy.make(School, school_id=school_id)
+        tracker = CostTracker(DepartmentFetcher.stage)
+        Loader(fetcher=DepartmentFetcher(cost_tracker=tracker), saver=DepartmentSaver()).load()
+        # failed target has no cost
+        self.assertEqual(sorted(tracker.measured), [1, 2])
+        self.assertEqual(tracker.measured[1][1:3], (1, 4))
+        self.assertGreater(tracker.measured[1][3], 0)
+
+        tracker.save()
+        School.objects.update(department_scraped=False)
+        TargetCost.objects.filter(target_id=1).update(seconds=5)
+        fetcher = DepartmentFetcher(cost_tracker=CostTracker(DepartmentFetcher.stage), schedule=LONGEST_FIRST)
+        self.assertEqual([url.id_to_update for url in fetcher.get_urls()][0], 1)
+        with self.assertRaises(ValueError):
+            DepartmentFetcher(schedule=LONGEST_FIRST)
+
+
+# worker of supervisor test, shard 0 crashes on its first attempt
+SHARD_WORKER = '''
+import json, sys
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+index, count = map(int, args['--shard'].split('/'))
+if index == 0 and args['--report'].endswith('-0.json'):
+    sys.exit(1)
+with open(args['--report'], 'w') as f:
+    json.dump({'shard': args['--shard'], 'requests': index + 1, 'rows': 10}, f)
+'''
+
+
+class ShardTest(TestCase):
+    def test_filter_shard(self):
+        for i in range(1, 11):
+            mommy.make(Department, department_id=i)
+        shards = [set(CourseFetcher(shard=(index, 3)).get_values_queryset()) for index in range(3)]
+        self.assertEqual(shards[1], {1, 4, 7, 10})
+        self.assertEqual(set.union(*shards), set(range(1, 11)))
+        self.assertEqual(sum(map(len, shards)), 10)
+        self.assertEqual(len(CourseFetcher().get_values_queryset()), 10)
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('2/4'), (2, 4))
+        for value in ('4/4', '-1/2', '1', 'a/b', '0/0'):
+            with self.assertRaises(ValueError):
+                parse_shard(value)
+
+    def test_strip_options(self):
+        args = ['--workers', '4', '--concurrent', '5', '--report=r.json', '--raw-save']
+        self.assertEqual(strip_options(args, ('--workers', '--report')), ['--concurrent', '5', '--raw-save'])
+
+    def test_supervisor(self):
+        supervisor = Supervisor([sys.executable, '-c', SHARD_WORKER], 3, poll_interval=0.01)
+        report = supervisor.run()
+        self.assertEqual(report['requests'], 6)
+        self.assertEqual(report['rows'], 30)
+        self.assertEqual(report['restarts'], 1)
+        self.assertEqual(report['failed_shards'], [])
+        self.assertFalse(os.path.exists(supervisor.report_dir))
+
+        supervisor = Supervisor([sys.executable, '-c', SHARD_WORKER], 2, max_restarts=0, poll_interval=0.01)
+        report = supervisor.run()
+        self.assertEqual(report['failed_shards'], [0])
+        self.assertEqual(report['requests'], 2)
+
+
+def slow_requests_get(*args, **kwargs):
+    time.sleep(0.1)
+    return mocked_requests_get(*args, **kwargs)
+
+
+class LoadBudgetTest(TestCase):
+    def test_allow(self):
+        budget = LoadBudget(seconds=1, deviations=0)
+        budget.start()
+        self.assertTrue(budget.allow(in_flight=10))
+        budget.on_request(0.3)
+        budget.on_request(0.1)
+        self.assertAlmostEqual(budget.request_seconds, 0.26)
+        self.assertAlmostEqual(budget.request_deviation, 0.16)
+        self.assertTrue(budget.allow(in_flight=4, concurrent=2))
+        self.assertTrue(budget.allow(in_flight=0, flush_seconds=0.5))
+        # two waves of urls ahead and flush of saver
+        self.assertFalse(budget.allow(in_flight=4, concurrent=2, flush_seconds=0.5))
+        self.assertIsNotNone(budget.stopped_at)
+        # budget stays exhausted
+        self.assertFalse(budget.allow())
+        self.assertTrue(LoadBudget().allow(in_flight=100))
+
+        # duration of url itself is taken with margin of deviations
+        budget = LoadBudget(seconds=1)
+        budget.start()
+        budget.on_request(0.2)
+        self.assertTrue(budget.allow())
+        self.assertFalse(budget.allow(flush_seconds=0.5))
+
+    def test_holds(self):
+        budget = LoadBudget(seconds=0.1)
+        budget.start()
+        self.assertFalse(budget.holds(in_flight=1, concurrent=2))
+        self.assertTrue(budget.holds(in_flight=2, concurrent=2))
+        # waits not longer than deadline
+        budget.wait_measured()
+        self.assertGreaterEqual(time.monotonic() - budget.started_at, 0.09)
+        budget.on_request(0.01)
+        self.assertFalse(budget.holds(in_flight=2, concurrent=2))
+        self.assertFalse(LoadBudget().holds(in_flight=2))
+
+    def test_rate(self):
+        budget = LoadBudget(seconds=1, rate=10)
+        budget.start()
+        # urls ahead wait for their turns even when requests are quick
+        self.assertTrue(budget.allow(in_flight=8, concurrent=100))
+        self.assertFalse(budget.allow(in_flight=10, concurrent=100))
+        start = time.monotonic()
+        for _ in range(3):
+            budget.pace()
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    @mock.patch('requests.get', side_effect=slow_requests_get)
+    def test_loader(self, mocked_get):
+        for school_id in (1, 2, 3):
+            mommy.make(School, school_id=school_id)
+        loader = Loader(fetcher=DepartmentFetcher(), saver=DepartmentSaver())
+        # the second school would finish after deadline
+        loader.load(max_req_count=None, deadline=0.15)
+        self.assertEqual(loader.req_count, 1)
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertEqual(loader.backlog, 2)
+        self.assertGreater(loader.budget.stopped_at, 0.09)
+
+    def test_iter_urls(self):
+        queue = TaskQueue(DepartmentFetcher.stage)
+        queue.enqueue([1, 2, 3])
+        fetcher = DepartmentFetcher(task_queue=queue)
+        urls = fetcher.iter_urls(allow=iter([True, False]).__next__)
+        self.assertEqual([url.id_to_update for url in urls], [1])
+        # targets claimed and not taken are released
+        self.assertEqual(queue.get_stats(), {ScrapeTask.CLAIMED: 1, ScrapeTask.PENDING: 2})
+        self.assertEqual(fetcher.count_backlog(), 3)
+
+
+class BenchmarkCommandTest(TestCase):
+    def test_cases(self):
+        # every case runs on few objects, so changes of saver or loader api can not break command silently
+        # command swaps default database, so it runs in own process beside test database
+        manage = os.path.join(settings.BASE_DIR, 'manage.py')
+        for name in sorted(BenchmarkCommand.cases):
+            with self.subTest(case=name):
+                result = subprocess.run(
+                    [sys.executable, manage, 'benchmark', name, '--objects', '50', '--repeat', '1', '--batch', '10',
+                     '--concurrent', '2', '--latency', '1'],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertIn('== {}:'.format(name), result.stdout)
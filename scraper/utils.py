@@ -2,11 +2,30 @@
 Utility classes
 """
 
+import asyncio
+import json
 import logging
+import threading
 import traceback
 
 import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+
+from scraper.cache import NOT_MODIFIED
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# seconds request could take if url has no timeout of its own
+DEFAULT_TIMEOUT = 10
 
 
 class LoggingMixin(object):
@@ -40,23 +59,210 @@ class LoggingMixin(object):
         return self.__class__.__name__
 
 
+class JsonDecoder(object):
+    """
+    Decodes json documents with stdlib json module
+
+    Decoders take raw response body, so bytes are not converted to str before parsing.
+    """
+    name = 'json'
+
+    def __repr__(self, *args, **kwargs):
+        return '{}()'.format(self.__class__.__name__)
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def loads(self, body):
+        """
+        :param body: bytes or str of json document
+        :return: decoded object, raises ValueError if document is invalid
+        """
+        # stdlib detects utf-8/16/32 encoding of bytes itself
+        return json.loads(body)
+
+
+class OrjsonDecoder(JsonDecoder):
+    """Decodes json documents with orjson, requires orjson package"""
+    name = 'orjson'
+
+    @classmethod
+    def is_available(cls):
+        return orjson is not None
+
+    def loads(self, body):
+        return orjson.loads(body)
+
+
+class UjsonDecoder(JsonDecoder):
+    """Decodes json documents with ujson, requires ujson package"""
+    name = 'ujson'
+
+    @classmethod
+    def is_available(cls):
+        return ujson is not None
+
+    def loads(self, body):
+        return ujson.loads(body)
+
+
+# decoder classes ordered from the fastest
+JSON_DECODERS = (OrjsonDecoder, UjsonDecoder, JsonDecoder)
+
+
+def get_decoder(name=None):
+    """
+    :param name: str name of decoder, the fastest installed one is chosen if None
+    :return: JsonDecoder instance
+    """
+    for decoder_class in JSON_DECODERS:
+        if name is None and decoder_class.is_available():
+            return decoder_class()
+        if decoder_class.name == name:
+            if not decoder_class.is_available():
+                raise ValueError('Json decoder {!r} is not installed'.format(name))
+            return decoder_class()
+    raise ValueError('Unknown json decoder {!r}'.format(name))
+
+
+def get_decoder_names():
+    """
+    :return: list of names of installed decoders
+    """
+    return [decoder_class.name for decoder_class in JSON_DECODERS if decoder_class.is_available()]
+
+
+class PageGroup(object):
+    """
+    Pages of paginated response of one target
+
+    First page and urls of remaining pages share group, target is marked as processed
+    only with the last of its pages appended to saver, so target with failed page is fetched again.
+
+    target_id: id of fetch_class object of first page
+    pages: int number of pages
+    """
+
+    def __init__(self, target_id, pages):
+        self.target_id = target_id
+        self.remaining = pages
+        self._lock = threading.Lock()
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(target_id={!r}, remaining={!r})'.format(self.__class__.__name__, self.target_id, self.remaining)
+
+    def __getstate__(self):
+        # urls fetched in process pool come back with their groups
+        state = self.__dict__.copy()
+        state.pop('_lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def done(self):
+        """
+        Registers page appended to saver, could be called from several save workers
+        :return: bool True if it was the last page of target
+        """
+        with self._lock:
+            self.remaining -= 1
+            return self.remaining == 0
+
+
 class Url(object):
     """Store all necessary data about url that should be processed"""
 
+    # decodes response bodies, fetcher could set other decoder to its urls
+    decoder = get_decoder()
+    # seconds request could take, set by fetcher from observed latency, DEFAULT_TIMEOUT is used if None
+    timeout = None
+
+    # size of chunks response body is read by in streaming mode
+    chunk_size = 64 * 1024
+
     def __init__(self, url, id_to_update=None):
         self.url_string = url
         self.id_to_update = id_to_update
         self.fetched_dicts = []
         self.error = False
+        # repr of error of failed fetch, saver records it in task queue
+        self.failure = None
+        # status and headers of last response, used by rate limiting
+        self.status_code = None
+        self.response_headers = None
+        # number of requests made to url and seconds to wait before next one if url is deferred for retry
+        self.attempts = 0
+        self.retry_delay = None
+        # page number of paginated response, None for the first request, and urls of remaining pages
+        self.page = None
+        self.page_urls = []
+        # PageGroup of paginated target, None if response has one page
+        self.page_group = None
+        # raw response body waiting to be parsed out of process and rows built from it there,
+        # saver in raw mode takes rows instead of fetched_dicts
+        self.body = None
+        self.fetched_rows = None
+        # seconds raw response body took to download, cost of target is recorded when body is parsed
+        self.body_seconds = None
+        # bytes of last response body, None if body was streamed
+        self.response_size = None
+
+    @property
+    def deferred(self):
+        return self.retry_delay is not None
 
     def get_response(self):
         """
         Makes request to url
         :return: dict from response or raises if not successful
         """
-        response = requests.get(self.url_string, timeout=10)
+        response = self.request()
+        return self.handle_response(response)
+
+    def get_timeout(self):
+        return DEFAULT_TIMEOUT if self.timeout is None else self.timeout
+
+    def request(self, headers=None, stream=False):
+        """
+        Sends request to url_string
+        :param headers: dict of additional request headers
+        :param stream: bool if True response body is not downloaded immediately
+        :return: requests.Response instance
+        """
+        return requests.get(self.url_string, timeout=self.get_timeout(), headers=headers, stream=stream)
+
+    def feed_body(self, feed):
+        """
+        Makes request to url and passes response body to feed chunk by chunk
+
+        :param feed: callable that takes bytes
+        """
+        response = self.request(stream=True)
+        try:
+            self.status_code = response.status_code
+            self.response_headers = response.headers
+            if not response.ok:
+                response.raise_for_status()
+            for chunk in response.iter_content(self.chunk_size):
+                feed(chunk)
+        finally:
+            response.close()
+
+    def handle_response(self, response):
+        """
+        Extracts data from response of requests library
+
+        :param response: requests.Response instance
+        :return: dict from response or raises if not successful
+        """
+        self.status_code = response.status_code
+        self.response_headers = response.headers
         if response.ok:
-            return response.json()
+            self.response_size = len(response.content)
+            return self.decoder.loads(response.content)
         else:
             response.raise_for_status()
 
@@ -67,9 +273,16 @@ class Url(object):
         :param objs: dict
         """
         for key in objs.keys():
-            obj = objs[key]
-            obj.update({'source_url': self.url_string})
-            self.fetched_dicts.append(obj)
+            self.append_fetched_dict(objs[key])
+
+    def append_fetched_dict(self, obj):
+        """
+        Adds source_url to object and stores it for further processing.
+
+        :param obj: dict
+        """
+        obj.update({'source_url': self.url_string})
+        self.fetched_dicts.append(obj)
 
     # arguments are sys.exc_info() unpacked
     def handle_error(self, logger, exc_type, exc_value, exc_traceback):
@@ -84,12 +297,283 @@ class Url(object):
         self.error = True
 
 
+class SessionPool(object):
+    """
+    Hands out pooled keep-alive requests.Session instances, one per thread
+
+    Each fetch worker thread gets its own session, so connections are reused between requests of the same worker
+    without sharing session state between threads.
+
+    pool_connections: number of hosts which connection pools are cached
+    pool_maxsize: max number of connections kept alive for one host
+    connect_timeout, read_timeout: timeouts in seconds passed to every request
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, connect_timeout=3.05, read_timeout=10, max_retries=0):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions = []
+
+    def __repr__(self, *args, **kwargs):
+        return '{}(pool_connections={!r}, pool_maxsize={!r}, connect_timeout={!r}, read_timeout={!r})'.format(
+            self.__class__.__name__, self.pool_connections, self.pool_maxsize, self.connect_timeout, self.read_timeout
+        )
+
+    @property
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+    def create_session(self):
+        """
+        Creates session with connection pool configured from this pool settings
+
+        :return: requests.Session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, max_retries=self.max_retries
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self):
+        """
+        Returns session of current thread, creates it on first call
+
+        :return: requests.Session
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self.create_session()
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def get_stats(self):
+        """
+        Collects connection reuse counters from all sessions created by this pool
+
+        connections is a number of opened sockets, requests is a number of requests sent through them.
+
+        :return: dict
+        """
+        with self._lock:
+            sessions = list(self._sessions)
+        connections = 0
+        requests_count = 0
+        for session in sessions:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    try:
+                        pool = pools[key]
+                    except KeyError:
+                        # pool was evicted by other thread
+                        continue
+                    connections += pool.num_connections
+                    requests_count += pool.num_requests
+        return {
+            'sessions': len(sessions),
+            'connections': connections,
+            'requests': requests_count,
+            'reused': requests_count - connections,
+        }
+
+    def close(self):
+        """
+        Closes all sessions, next get_session call in any thread creates new one
+        """
+        with self._lock:
+            sessions = self._sessions
+            self._sessions = []
+            self._local = threading.local()
+        for session in sessions:
+            session.close()
+
+
+class SessionUrl(Url):
+    """
+    Requests url_string through keep-alive session of current thread
+
+    session_pool could be replaced in subclass or on class itself to change pool settings.
+    """
+
+    session_pool = SessionPool()
+
+    def get_timeout(self):
+        if self.timeout is None:
+            return self.session_pool.timeout
+        return self.session_pool.connect_timeout, self.timeout
+
+    def request(self, headers=None, stream=False):
+        return self.session_pool.get_session().get(
+            self.url_string, timeout=self.get_timeout(), headers=headers, stream=stream
+        )
+
+    def get_response(self):
+        response = self.request()
+        try:
+            return self.handle_response(response)
+        finally:
+            # returns connection to pool even if body was not consumed
+            response.close()
+
+
 class AsyncUrl(Url):
     """
     Requests url_string in asynchronous way
+
+    session: aiohttp.ClientSession shared by loader, if None session is created for this request only
     """
 
+    def __init__(self, url, id_to_update=None, session=None):
+        super().__init__(url, id_to_update=id_to_update)
+        self.session = session
+
     async def get_response(self):
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.get(self.url_string, timeout=10) as resp:
-                return await resp.json()
+        return await self.with_session(self.request)
+
+    async def feed_body(self, feed):
+        """
+        Makes request to url and passes response body to feed chunk by chunk
+
+        :param feed: callable that takes bytes
+        """
+        return await self.with_session(lambda session: self.request_body(session, feed))
+
+    async def with_session(self, func):
+        """
+        Calls coroutine function with loader session or with session created for this call
+        """
+        if self.session is None:
+            async with aiohttp.ClientSession() as session:
+                return await func(session)
+        return await func(self.session)
+
+    async def get_body(self):
+        return await self.with_session(self.read_body)
+
+    async def request(self, session):
+        """
+        Makes request to url through provided session
+        :param session: aiohttp.ClientSession
+        :return: dict from response or raises if not successful
+        """
+        return self.decoder.loads(await self.read_body(session))
+
+    async def read_body(self, session):
+        """
+        Makes request to url through provided session
+        :param session: aiohttp.ClientSession
+        :return: bytes of response body or raises if not successful
+        """
+        async with session.get(self.url_string, timeout=self.get_timeout()) as resp:
+            self.status_code = resp.status
+            self.response_headers = resp.headers
+            resp.raise_for_status()
+            body = await resp.read()
+            self.response_size = len(body)
+            return body
+
+    async def request_body(self, session, feed):
+        """
+        Reads response body through provided session chunk by chunk
+        :param session: aiohttp.ClientSession
+        :param feed: callable that takes bytes
+        """
+        async with session.get(self.url_string, timeout=self.get_timeout()) as resp:
+            self.status_code = resp.status
+            self.response_headers = resp.headers
+            resp.raise_for_status()
+            while True:
+                chunk = await resp.content.read(self.chunk_size)
+                if not chunk:
+                    break
+                feed(chunk)
+
+
+class CachedUrl(SessionUrl):
+    """
+    Serves response from response_cache if it is still fresh or server answers 304 Not Modified
+
+    Does plain request if response_cache is None.
+    """
+
+    response_cache = None
+
+    def load_entry(self, entry):
+        """
+        Decodes body of cache entry, its size is recorded as size of response
+        :param entry: CacheEntry instance
+        :return: dict from cached body
+        """
+        body = entry.get_body()
+        self.response_size = len(body)
+        return self.decoder.loads(body)
+
+    def get_response(self):
+        cache = self.response_cache
+        if cache is None:
+            return super().get_response()
+
+        entry = cache.get(self.url_string)
+        if entry is not None and entry.fresh:
+            return self.load_entry(entry)
+
+        response = self.request(headers=cache.get_conditional_headers(entry))
+        try:
+            if entry is not None and response.status_code == NOT_MODIFIED:
+                cache.revalidate(self.url_string, response.headers)
+                return self.load_entry(entry)
+            data = self.handle_response(response)
+            cache.store(self.url_string, response.headers, response.content)
+            return data
+        finally:
+            response.close()
+
+
+class AsyncCachedUrl(AsyncUrl):
+    """
+    Asynchronous version of CachedUrl, uses the same response_cache
+    Cache is sqlite file, its reads and writes run in default executor of loop, so they do not block other requests.
+    """
+
+    response_cache = None
+
+    def load_entry(self, entry):
+        """
+        The same as load_entry of CachedUrl
+        """
+        body = entry.get_body()
+        self.response_size = len(body)
+        return self.decoder.loads(body)
+
+    async def request(self, session):
+        cache = self.response_cache
+        if cache is None:
+            return await super().request(session)
+
+        loop = asyncio.get_event_loop()
+        entry = await loop.run_in_executor(None, cache.get, self.url_string)
+        if entry is not None and entry.fresh:
+            return self.load_entry(entry)
+
+        headers = cache.get_conditional_headers(entry)
+        async with session.get(self.url_string, timeout=self.get_timeout(), headers=headers) as resp:
+            self.status_code = resp.status
+            self.response_headers = resp.headers
+            if entry is not None and resp.status == NOT_MODIFIED:
+                await loop.run_in_executor(None, cache.revalidate, self.url_string, resp.headers)
+                return self.load_entry(entry)
+            resp.raise_for_status()
+            body = await resp.read()
+            self.response_size = len(body)
+            await loop.run_in_executor(None, cache.store, self.url_string, resp.headers, body)
+            return self.decoder.loads(body)